@@ -0,0 +1,200 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""A StatsD client for applications running on an C{asyncio} event loop,
+or a C{trollius} one on Python 2."""
+
+import socket
+from collections import deque
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+
+class StatsDDatagramProtocol(asyncio.DatagramProtocol):
+    """Hands the datagram transport events to an L{AsyncioStatsDClient}."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def connection_made(self, transport):
+        self.client.connection_made(transport)
+
+    def connection_lost(self, exc):
+        self.client.connection_lost()
+
+    def error_received(self, exc):
+        self.client.errors += 1
+
+    def pause_writing(self):
+        self.client.paused = True
+
+    def resume_writing(self):
+        self.client.paused = False
+        self.client.schedule_flush()
+
+
+class AsyncioStatsDClient(object):
+    """A connection for L{Metrics} and L{ExtendedMetrics} that sends
+    metrics over UDP from an C{asyncio} event loop.
+
+    The host is resolved in the loop's executor. Metrics written during a
+    loop iteration are packed into newline separated datagrams of up to
+    C{max_size} bytes, sent on the next iteration; the StatsD server must
+    accept several metrics per datagram. Metrics wait in a buffer of up to
+    C{buffer_size} entries while the host is resolved or the transport is
+    paused, and are dropped, and counted, when it's full. L{write} never
+    blocks and must be called from the loop's thread.
+    """
+
+    def __init__(self, host, port, loop=None, max_size=512,
+                 buffer_size=10000):
+        """
+        @param host: The StatsD host.
+        @param port: The StatsD port.
+        @param loop: The event loop, the current one if not given.
+        @param max_size: The maximum datagram size, 0 to send a datagram
+            per metric.
+        @param buffer_size: The number of metrics waiting to be sent after
+            which new ones are dropped.
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.buffer_size = buffer_size
+
+        self.address = None
+        self.transport = None
+        self.paused = False
+        self.buffer = deque()
+        self.scheduled = False
+
+        self.messages = 0
+        self.packets = 0
+        self.drops = 0
+        self.errors = 0
+        self.resolve_failures = 0
+
+    def __str__(self):
+        return "%s:%d" % (self.host, self.port)
+
+    def connect(self):
+        """Resolve the host and open the datagram endpoint, without
+        blocking the loop."""
+        resolving = asyncio.ensure_future(self.loop.getaddrinfo(
+            self.host, self.port, family=socket.AF_INET,
+            type=socket.SOCK_DGRAM), loop=self.loop)
+        resolving.add_done_callback(self.host_resolved)
+        return resolving
+
+    def host_resolved(self, resolving):
+        """Callback used when the host resolution is done."""
+        try:
+            self.address = resolving.result()[0][4]
+        except (IndexError, OSError, socket.error, socket.gaierror):
+            self.resolve_failures += 1
+            return
+        connecting = asyncio.ensure_future(
+            self.loop.create_datagram_endpoint(
+                lambda: StatsDDatagramProtocol(self),
+                remote_addr=self.address),
+            loop=self.loop)
+        connecting.add_done_callback(self.endpoint_created)
+
+    def endpoint_created(self, connecting):
+        """Callback used when the datagram endpoint is created."""
+        if connecting.exception() is not None:
+            self.errors += 1
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.schedule_flush()
+
+    def connection_lost(self):
+        self.transport = None
+
+    def disconnect(self):
+        """Send the buffered metrics and close the endpoint."""
+        self.flush()
+        if self.transport is not None:
+            self.transport.close()
+        self.transport = None
+
+    def write(self, data, callback=None):
+        """Buffer the metric, to be sent on the next loop iteration.
+
+        @param callback: Ignored, accepted for compatibility with the
+            other clients.
+        @return: C{True} if the metric was buffered, C{None} if it was
+            dropped.
+        """
+        if len(self.buffer) >= self.buffer_size:
+            self.drops += 1
+            return None
+        self.buffer.append(data)
+        self.messages += 1
+        if not self.scheduled:
+            self.schedule_flush()
+        return True
+
+    def schedule_flush(self):
+        if self.buffer and not self.scheduled and self.transport is not None:
+            self.scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        """Send the buffered metrics, unless the transport is paused."""
+        self.scheduled = False
+        if self.transport is None or self.paused:
+            return
+        buffer = self.buffer
+        sendto = self.transport.sendto
+        if not self.max_size:
+            while buffer:
+                sendto(buffer.popleft())
+                self.packets += 1
+            return
+        while buffer:
+            batch = [buffer.popleft()]
+            size = len(batch[0])
+            while buffer and size + 1 + len(buffer[0]) <= self.max_size:
+                data = buffer.popleft()
+                batch.append(data)
+                size += 1 + len(data)
+            sendto(b"\n".join(batch))
+            self.packets += 1
+
+    def report_stats(self):
+        """Return and reset the message, packet, drop, error and resolution
+        failure counters."""
+        stats = {"messages": self.messages,
+                 "packets": self.packets,
+                 "drops": self.drops,
+                 "errors": self.errors,
+                 "resolve_failures": self.resolve_failures}
+        self.messages = self.packets = self.drops = 0
+        self.errors = self.resolve_failures = 0
+        return stats
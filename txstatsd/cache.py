@@ -0,0 +1,87 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""A small least recently used cache, with no dependencies on Twisted."""
+
+
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """A bounded mapping that discards the least recently used items.
+
+    Entries are kept in a circular doubly linked list, so lookups and
+    insertions are constant time.
+    """
+
+    def __init__(self, size):
+        """
+        @param size: The maximum number of entries. A size of C{0} disables
+            the cache.
+        """
+        self.size = size
+        self.data = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        """Return the value for C{key}, marking it as recently used."""
+        link = self.data.get(key)
+        if link is None:
+            return default
+        link_prev, link_next = link[PREV], link[NEXT]
+        link_prev[NEXT] = link_next
+        link_next[PREV] = link_prev
+        root = self.root
+        last = root[PREV]
+        last[NEXT] = root[PREV] = link
+        link[PREV] = last
+        link[NEXT] = root
+        return link[VALUE]
+
+    def __setitem__(self, key, value):
+        if self.size <= 0:
+            return
+        data = self.data
+        link = data.get(key)
+        if link is not None:
+            link[VALUE] = value
+            self.get(key)
+            return
+        root = self.root
+        if len(data) >= self.size:
+            oldest = root[NEXT]
+            del data[oldest[KEY]]
+            root[NEXT] = oldest[NEXT]
+            oldest[NEXT][PREV] = root
+        last = root[PREV]
+        link = [last, root, key, value]
+        last[NEXT] = root[PREV] = data[key] = link
+
+    def clear(self):
+        """Discard all entries."""
+        self.data.clear()
+        self.root[:] = [self.root, self.root, None, None]
@@ -19,12 +19,20 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import atexit
+import os
 import socket
+import threading
+import time
+import weakref
 
 try:
     import twisted
+    from twisted.internet.task import LoopingCall
     from txstatsd.protocol import (
+        BatchingClient,
         StatsDClientProtocol,
+        TCPStatsDClient,
         TwistedStatsDClient,
     )
 except (ImportError, IOError):
@@ -39,56 +47,293 @@ except (ImportError, IOError):
     # http://twistedmatrix.com/trac/ticket/6244 for more details.
     pass
 
-from txstatsd.hashing import ConsistentHashRing
+from txstatsd.hashing import RING_STRATEGIES, HealthTrackedRing
 
 
 class UdpStatsDClient(object):
 
-    def __init__(self, host=None, port=None):
+    def __init__(self, host=None, port=None, max_size=0, delay=0.05,
+                 resolve_interval=0):
         """Build a connection that reports to C{host} and C{port})
         using UDP.
 
+        If C{max_size} is given, metrics are packed into newline separated
+        datagrams of up to C{max_size} bytes, sent when full, C{delay}
+        seconds after their first metric was written, on L{flush} or when
+        the interpreter exits. The StatsD server must accept several
+        metrics per datagram.
+
+        If C{resolve_interval} is given, C{host} is resolved again every
+        C{resolve_interval} seconds, in a background thread, while
+        connected. Metrics keep going to the last address resolved.
+
+        A client used in a process forked after it was connected opens its
+        own socket and starts with an empty batch, so that metrics batched
+        by the parent are not sent twice.
+
         @param host: The StatsD host.
         @param port: The StatsD port.
+        @param max_size: The maximum datagram size when batching, 0 to send
+            a datagram per metric.
+        @param delay: The maximum time, in seconds, a metric is held back.
+        @param resolve_interval: The time, in seconds, between resolutions
+            of C{host}, 0 to resolve it only once.
         @raise ValueError: If the C{host} and C{port} cannot be
             resolved (for the case where they are not C{None}).
         """
         self.original_host = self.host = host
         self.port = port
 
+        self.address = None
         if host is not None and port is not None:
-            try:
-                self.host, self.port = socket.getaddrinfo(
-                    host, port, socket.AF_INET,
-                    socket.SOCK_DGRAM, socket.SOL_UDP)[0][4]
-            except (TypeError, IndexError, socket.error, socket.gaierror):
-                raise ValueError("The address cannot be resolved.")
+            self.host, self.port = self.address = self.lookup()
 
         self.socket = None
+        self.resolve_interval = resolve_interval
+        self.resolver_stopped = None
+        self.resolve_failures = 0
+        self.address_changes = 0
+
+        self.max_size = max_size
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.size = 0
+        self.pending = threading.Event()
+        self.flusher = None
+
+        self.messages = 0
+        self.packets = 0
+        self.drops = 0
+        self.pid = os.getpid()
+        if max_size:
+            atexit.register(flush_at_exit, weakref.ref(self))
 
     def __str__(self):
         return "%s:%d" % (self.original_host, self.port)
 
+    def lookup(self):
+        """Resolve the original host and port, blocking.
+
+        @raise ValueError: If they cannot be resolved.
+        """
+        try:
+            return socket.getaddrinfo(
+                self.original_host, self.port, socket.AF_INET,
+                socket.SOCK_DGRAM, socket.SOL_UDP)[0][4]
+        except (TypeError, IndexError, socket.error, socket.gaierror):
+            raise ValueError("The address cannot be resolved.")
+
+    def resolve(self):
+        """Resolve the host again, keeping the last address on failure."""
+        try:
+            host, port = self.lookup()
+        except ValueError:
+            self.resolve_failures += 1
+            return
+        if host != self.host:
+            self.address_changes += 1
+            self.host = host
+            self.address = (host, port)
+
     def connect(self):
         """Connect to the StatsD server."""
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setblocking(0)
+        if (self.resolve_interval and self.host is not None and
+                self.resolver_stopped is None):
+            self.start_resolver()
 
     def disconnect(self):
         """Disconnect from the StatsD server."""
+        if self.resolver_stopped is not None:
+            self.resolver_stopped.set()
+            self.resolver_stopped = None
+        self.flush()
         if self.socket is not None:
             self.socket.close()
         self.socket = None
 
+    def healthy(self):
+        """Whether the client is connected to a resolved address."""
+        return self.address is not None and self.socket is not None
+
     def write(self, data):
-        """Send the metric to the StatsD server."""
-        if self.host is None or self.port is None or self.socket is None:
-            return
+        """Send the metric to the StatsD server.
+
+        @return: The number of bytes sent, or held back when batching;
+            C{None} if the metric, or the full batch it completed, couldn't
+            be sent.
+        """
+        if self.address is None or self.socket is None:
+            return None
+        if self.pid != os.getpid():
+            self.after_fork()
+        if not self.max_size:
+            sent = self.send(data)
+            if sent is None:
+                self.drops += 1
+            return sent
+
+        payload = None
+        with self.lock:
+            size = len(data)
+            if self.buffer and self.size + 1 + size > self.max_size:
+                payload, count = "\n".join(self.buffer), len(self.buffer)
+                self.buffer = []
+            if self.buffer:
+                self.size += 1 + size
+            else:
+                self.size = size
+                self.pending.set()
+                if self.flusher is None:
+                    self.start_flusher()
+            self.buffer.append(data)
+            self.messages += 1
+        if payload is not None and self.send_payload(payload, count) is None:
+            return None
+        return size
+
+    def flush(self):
+        """Send the metrics held back, if any."""
+        if self.pid != os.getpid():
+            self.after_fork()
+        with self.lock:
+            if not self.buffer:
+                return
+            payload, count = "\n".join(self.buffer), len(self.buffer)
+            self.buffer = []
+            self.size = 0
+            self.pending.clear()
+        self.send_payload(payload, count)
+
+    def after_fork(self):
+        """Start over in a forked process: the lock may have been held by
+        a thread that doesn't exist anymore, the batch belongs to the
+        parent, and the flusher and resolver threads weren't forked."""
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.size = 0
+        self.pending = threading.Event()
+        self.flusher = None
+        self.messages = self.packets = self.drops = 0
+        self.resolve_failures = self.address_changes = 0
+        if self.socket is not None:
+            self.socket.close()
+            self.resolver_stopped = None
+            self.connect()
+
+    def send(self, data):
         try:
-            return self.socket.sendto(data, (self.host, self.port))
-        except (socket.error, socket.gaierror):
+            return self.socket.sendto(data, self.address)
+        except (AttributeError, socket.error, socket.gaierror):
             return None
 
+    def send_payload(self, payload, count):
+        sent = self.send(payload)
+        with self.lock:
+            if sent is None:
+                self.drops += count
+            else:
+                self.packets += 1
+        return sent
+
+    def start_flusher(self):
+        """Start the thread sending metrics that were held back for
+        C{delay} seconds. It doesn't keep the client alive."""
+        self.flusher = threading.Thread(
+            target=run_flusher,
+            args=(weakref.ref(self), self.pending, self.delay))
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def start_resolver(self):
+        """Start the thread resolving the host every C{resolve_interval}
+        seconds. It doesn't keep the client alive."""
+        self.resolver_stopped = threading.Event()
+        resolver = threading.Thread(
+            target=run_resolver,
+            args=(weakref.ref(self), self.resolver_stopped,
+                  self.resolve_interval))
+        resolver.daemon = True
+        resolver.start()
+
+    def report_stats(self):
+        """Return and reset the message, packet, drop, resolution failure
+        and address change counters."""
+        with self.lock:
+            stats = {"messages": self.messages,
+                     "packets": self.packets,
+                     "drops": self.drops,
+                     "resolve_failures": self.resolve_failures,
+                     "address_changes": self.address_changes}
+            self.messages = self.packets = self.drops = 0
+            self.resolve_failures = self.address_changes = 0
+        return stats
+
+
+class UnixStatsDClient(UdpStatsDClient):
+
+    def __init__(self, path, max_size=0, delay=0.05):
+        """Build a connection that reports to the Unix datagram socket at
+        C{path}, for a StatsD server on the same host.
+
+        Unlike UDP, a full server receive buffer doesn't silently lose
+        metrics: the write fails and the metrics are counted as drops.
+        Metrics are batched as in L{UdpStatsDClient}.
+
+        @param path: The path of the StatsD server socket.
+        @param max_size: The maximum datagram size when batching, 0 to send
+            a datagram per metric.
+        @param delay: The maximum time, in seconds, a metric is held back.
+        """
+        super(UnixStatsDClient, self).__init__(
+            max_size=max_size, delay=delay)
+        self.original_host = self.host = self.address = path
+
+    def __str__(self):
+        return self.address
+
+    def connect(self):
+        """Connect to the StatsD server."""
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+
+
+def run_flusher(client_ref, pending, delay):
+    """Flush a batching L{UdpStatsDClient} C{delay} seconds after metrics
+    are added to an empty batch, until the client goes away."""
+    while True:
+        pending.wait()
+        time.sleep(delay)
+        client = client_ref()
+        if client is None:
+            return
+        client.flush()
+        del client
+
+
+def run_resolver(client_ref, stopped, interval):
+    """Resolve the host of a L{UdpStatsDClient} every C{interval} seconds,
+    until it's disconnected or goes away."""
+    while True:
+        # Event.wait only returns the flag from Python 2.7 on.
+        stopped.wait(interval)
+        if stopped.is_set():
+            return
+        client = client_ref()
+        if client is None:
+            return
+        client.resolve()
+        del client
+
+
+def flush_at_exit(client_ref):
+    client = client_ref()
+    if client is not None:
+        client.flush()
+
 
 class InternalClient(object):
     """A connection that can be used inside the C{StatsD} daemon itself."""
@@ -102,18 +347,158 @@ class InternalClient(object):
     def write(self, data):
         """Write directly to the C{MessageProcessor}."""
         self._processor.process(data)
+        return True
+
+
+def client_healthy(client):
+    """Tell whether C{client} can send, according to its C{healthy} method.
+    Clients without one are taken as healthy."""
+    healthy = getattr(client, "healthy", None)
+    return healthy is None or healthy()
 
 
 class ConsistentHashingClient(object):
 
-    def __init__(self, clients):
-        self.ring = ConsistentHashRing(clients)
+    def __init__(self, clients, hash_type="md5", strategy="ring",
+                 failure_threshold=3, retry_interval=30,
+                 heartbeat=client_healthy, wall_time_func=time.time):
+        """
+        Clients whose writes fail C{failure_threshold} times in a row, or
+        whose heartbeat fails, are marked down: their metrics go to the
+        next client on the ring until they are marked up again. That
+        happens C{retry_interval} seconds later, if their heartbeat
+        succeeds, or on L{check_health}, which L{start_health_checks}
+        calls periodically.
+
+        @param clients: The clients to spread metrics over.
+        @param hash_type: The hash placing metrics on the ring, C{md5} or
+            the faster C{crc32}, which places metrics on different clients.
+        @param strategy: C{ring} for a L{ConsistentHashRing}, or C{jump} for
+            jump consistent hash over C{clients} in the given order; new
+            clients must then be added at the end.
+        @param failure_threshold: The number of writes in a row returning
+            C{None} or raising an C{EnvironmentError} after which a client
+            is marked down.
+        @param retry_interval: The time, in seconds, after which a client
+            marked down is marked up again.
+        @param heartbeat: A function taking a client and telling whether
+            it is healthy, by default L{client_healthy}, or C{None} to mark
+            clients up again unconditionally.
+        @param wall_time_func: Function for obtaining wall time.
+        """
+        if strategy not in RING_STRATEGIES:
+            raise ValueError("unknown strategy %s" % (strategy,))
+        self.ring = HealthTrackedRing(
+            RING_STRATEGIES[strategy](clients, hash_type=hash_type))
+        self.failure_threshold = failure_threshold
+        self.retry_interval = retry_interval
+        self.heartbeat = heartbeat
+        self.wall_time_func = wall_time_func
+        self.failures = {}
+        self.retries = {}
+        self.next_retry = None
+        self.write_failures = 0
+        self.health_checks = None
 
     def write(self, data):
-        """Hash based on the metric name, then send to the right client."""
+        """Hash based on the metric name, then send to the right client.
+
+        @return: What the client that took the metric returned, C{None} if
+            none did.
+        """
         metric_name, rest = str(data).split(":", 1)
-        client = self.ring.get_node(metric_name)
-        client.write(data)
+        ring = self.ring
+        if ring.down:
+            if self.wall_time_func() >= self.next_retry:
+                self.retry()
+            client = ring.get_node(metric_name)
+        else:
+            client = ring.ring.get_node(metric_name)
+        try:
+            sent = client.write(data)
+        except EnvironmentError:
+            sent = None
+        if sent is None:
+            self.write_failed(client)
+            failover = ring.get_node(metric_name)
+            if failover is not client:
+                try:
+                    sent = failover.write(data)
+                except EnvironmentError:
+                    sent = None
+                if sent is None:
+                    self.write_failed(failover)
+        elif self.failures:
+            self.failures.pop(client, None)
+        return sent
+
+    def write_failed(self, client):
+        """Count a failed write, marking C{client} down after too many in
+        a row."""
+        self.write_failures += 1
+        failures = self.failures.get(client, 0) + 1
+        if failures >= self.failure_threshold:
+            self.mark_down(client)
+        else:
+            self.failures[client] = failures
+
+    def mark_down(self, client):
+        """Send the metrics of C{client} to the next client on the ring
+        for C{retry_interval} seconds."""
+        self.failures.pop(client, None)
+        self.ring.mark_down(client)
+        if client in self.ring.down:
+            self.retries[client] = self.wall_time_func() + self.retry_interval
+            self.next_retry = min(self.retries.values())
+
+    def mark_up(self, client):
+        """Send the metrics of C{client} to it again."""
+        self.ring.mark_up(client)
+        self.retries.pop(client, None)
+        self.next_retry = min(self.retries.values()) if self.retries else None
+
+    def retry(self):
+        """Mark up the clients whose retry interval elapsed, if their
+        heartbeat succeeds, or try again after C{retry_interval}."""
+        now = self.wall_time_func()
+        for client, retry_time in list(self.retries.items()):
+            if retry_time <= now:
+                if self.heartbeat is None or self.heartbeat(client):
+                    self.mark_up(client)
+                else:
+                    self.retries[client] = now + self.retry_interval
+        self.next_retry = min(self.retries.values()) if self.retries else None
+
+    def check_health(self):
+        """Mark the clients up or down according to their heartbeat, to be
+        called periodically when a C{heartbeat} is given."""
+        for client in list(self.ring.nodes):
+            if self.heartbeat(client):
+                self.mark_up(client)
+            else:
+                self.mark_down(client)
+
+    def start_health_checks(self, interval, report_function=None,
+                            clock=None):
+        """Call L{check_health} every C{interval} seconds from the reactor,
+        until L{disconnect}.
+
+        @param interval: The time, in seconds, between health checks.
+        @param report_function: A function called with the name and value
+            of each statistic from L{report_stats} after each check, if
+            given, such as C{Metrics.gauge}.
+        @param clock: The reactor to schedule the checks with, by default
+            the global one.
+        """
+        def run():
+            self.check_health()
+            if report_function is not None:
+                for name, value in self.report_stats().items():
+                    report_function(name, value)
+        self.health_checks = LoopingCall(run)
+        if clock is not None:
+            self.health_checks.clock = clock
+        self.health_checks.start(interval, now=False)
 
     def connect(self):
         """Connect all ring nodes."""
@@ -122,5 +507,18 @@ class ConsistentHashingClient(object):
 
     def disconnect(self):
         """Disconnect all ring nodes"""
+        if self.health_checks is not None:
+            if self.health_checks.running:
+                self.health_checks.stop()
+            self.health_checks = None
         for node in self.ring.nodes:
             node.disconnect()
+
+    def report_stats(self):
+        """Return the number of clients down, and reset the number of
+        failed writes and metrics sent to a failover client."""
+        stats = {"failovers": self.ring.failovers,
+                 "write_failures": self.write_failures,
+                 "nodes_down": len(self.ring.down)}
+        self.ring.failovers = self.write_failures = 0
+        return stats
@@ -19,54 +19,282 @@ This copy is included here so that txstatsd.client doesn't depend on carbon.
 """
 
 import bisect
+import zlib
 
 from hashlib import md5
 
 
+def md5_position(key):
+    big_hash = md5(key.encode('utf-8')).hexdigest()
+    small_hash = int(big_hash[:8], 16)
+    return small_hash
+
+
+def crc32_position(key):
+    return zlib.crc32(key) & 0xffffffff
+
+
+def carbon_position(key):
+    big_hash = md5(str(key)).hexdigest()
+    small_hash = int(big_hash[:4], 16)
+    return small_hash
+
+
+HASH_FUNCTIONS = {"md5": md5_position, "crc32": crc32_position,
+                  "carbon": carbon_position}
+
+
 class ConsistentHashRing:
+    """A ring of C{replica_count} positions per node.
 
-    def __init__(self, nodes, replica_count=1024):
-        self.ring = []
+    The ring is built in a single sort whenever nodes are added or removed,
+    keeping a sorted list of positions next to the list of their nodes. The
+    nodes of up to C{cache_size} keys looked up are cached; the cache is
+    simply emptied when full, which is much cheaper than keeping it in least
+    recently used order.
+
+    Positions are computed from md5 by default. The C{crc32} C{hash_type} is
+    much cheaper, but it places keys differently, so switching an existing
+    deployment to it moves most of its keys to other nodes.
+    """
+
+    def __init__(self, nodes, replica_count=1024, hash_type="md5",
+                 cache_size=10000):
         self.nodes = set()
         self.replica_count = replica_count
-        for node in nodes:
-            self.add_node(node)
+        if hash_type not in HASH_FUNCTIONS:
+            raise ValueError("unknown hash type %s" % (hash_type,))
+        self.hash_type = hash_type
+        self.compute_ring_position = HASH_FUNCTIONS[hash_type]
+        self.positions = []
+        self.ring_nodes = []
+        self.cache = {}
+        self.cache_size = cache_size
+        self.add_nodes(nodes)
+
+    @property
+    def ring(self):
+        """The (position, node) entries of the ring, in order."""
+        return zip(self.positions, self.ring_nodes)
 
-    def compute_ring_position(self, key):
-        big_hash = md5(key.encode('utf-8')).hexdigest()
-        small_hash = int(big_hash[:8], 16)
-        return small_hash
+    def add_nodes(self, nodes):
+        self.nodes.update(nodes)
+        self.build()
 
     def add_node(self, node):
-        self.nodes.add(node)
-        for i in range(self.replica_count):
-            replica_key = "%s:%d" % (node, i)
-            position = self.compute_ring_position(replica_key)
-            entry = (position, node)
-            bisect.insort(self.ring, entry)
+        self.add_nodes([node])
 
     def remove_node(self, node):
         self.nodes.discard(node)
-        self.ring = [entry for entry in self.ring if entry[1] != node]
+        self.build()
+
+    def build(self):
+        compute_ring_position = self.compute_ring_position
+        entries = sorted((compute_ring_position("%s:%d" % (node, i)), node)
+                         for node in self.nodes
+                         for i in xrange(self.replica_count))
+        self.positions = [entry[0] for entry in entries]
+        self.ring_nodes = [entry[1] for entry in entries]
+        self.cache.clear()
 
     def get_node(self, key):
-        assert self.ring
-        position = self.compute_ring_position(key)
-        search_entry = (position, None)
-        index = bisect.bisect_left(self.ring, search_entry) % len(self.ring)
-        entry = self.ring[index]
-        return entry[1]
+        cache = self.cache
+        node = cache.get(key)
+        if node is None:
+            assert self.ring_nodes
+            position = self.compute_ring_position(key)
+            positions = self.positions
+            index = bisect.bisect_left(positions, position)
+            if index == len(positions):
+                index = 0
+            node = self.ring_nodes[index]
+            if self.cache_size:
+                if len(cache) >= self.cache_size:
+                    cache.clear()
+                cache[key] = node
+        return node
 
     def get_nodes(self, key):
         nodes = []
         position = self.compute_ring_position(key)
-        search_entry = (position, None)
-        index = bisect.bisect_left(self.ring, search_entry) % len(self.ring)
-        last_index = (index - 1) % len(self.ring)
+        ring_nodes = self.ring_nodes
+        size = len(ring_nodes)
+        index = bisect.bisect_left(self.positions, position) % size
+        last_index = (index - 1) % size
         while len(nodes) < len(self.nodes) and index != last_index:
-            next_entry = self.ring[index]
-            (position, next_node) = next_entry
+            next_node = ring_nodes[index]
             if next_node not in nodes:
                 nodes.append(next_node)
-            index = (index + 1) % len(self.ring)
+            index = (index + 1) % size
         return nodes
+
+
+class CarbonConsistentHashRing(ConsistentHashRing):
+    """A ring placing keys exactly like carbon.hashing does, so that moving
+    from carbon's client to txstatsd's doesn't re-shard existing metrics."""
+
+    def __init__(self, nodes, replica_count=100, cache_size=10000):
+        ConsistentHashRing.__init__(self, nodes, replica_count=replica_count,
+                                    hash_type="carbon",
+                                    cache_size=cache_size)
+
+
+def jump_hash(key, num_buckets):
+    """Map a 64 bit C{key} to one of C{num_buckets} buckets, with Lamping and
+    Veach's jump consistent hash."""
+    bucket, jump = -1, 0
+    while jump < num_buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        jump = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def md5_key(key):
+    return int(md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def crc32_key(key):
+    return zlib.crc32(key) & 0xffffffff
+
+
+KEY_FUNCTIONS = {"md5": md5_key, "crc32": crc32_key}
+
+
+class JumpHashRing(object):
+    """Spreads keys over an ordered list of nodes with jump consistent hash.
+
+    Lookups don't use any memory per node and keys are spread more evenly
+    than on a ring. Nodes must be kept in the same order: adding a node at
+    the end moves only the keys it takes over, but removing a node other
+    than the last one moves most keys. Same interface as
+    L{ConsistentHashRing}, with the same bounded lookup cache.
+    """
+
+    def __init__(self, nodes, hash_type="md5", cache_size=10000):
+        if hash_type not in KEY_FUNCTIONS:
+            raise ValueError("unknown hash type %s" % (hash_type,))
+        self.hash_type = hash_type
+        self.compute_key = KEY_FUNCTIONS[hash_type]
+        self.nodes = []
+        self.cache = {}
+        self.cache_size = cache_size
+        self.add_nodes(nodes)
+
+    def add_nodes(self, nodes):
+        for node in nodes:
+            if node not in self.nodes:
+                self.nodes.append(node)
+        self.cache.clear()
+
+    def add_node(self, node):
+        self.add_nodes([node])
+
+    def remove_node(self, node):
+        if node in self.nodes:
+            self.nodes.remove(node)
+        self.cache.clear()
+
+    def get_node(self, key):
+        cache = self.cache
+        node = cache.get(key)
+        if node is None:
+            assert self.nodes
+            node = self.nodes[jump_hash(self.compute_key(key),
+                                        len(self.nodes))]
+            if self.cache_size:
+                if len(cache) >= self.cache_size:
+                    cache.clear()
+                cache[key] = node
+        return node
+
+    def get_nodes(self, key):
+        """All the nodes, starting with the one for C{key} and followed by
+        the next ones in order."""
+        index = jump_hash(self.compute_key(key), len(self.nodes))
+        return self.nodes[index:] + self.nodes[:index]
+
+
+RING_STRATEGIES = {"ring": ConsistentHashRing, "jump": JumpHashRing}
+
+
+class HealthTrackedRing(object):
+    """Routes keys around the nodes of a ring that are marked down.
+
+    A key whose node is down goes to the next node of L{get_nodes} that is
+    up, so that only the keys of that node move, and they go back once it
+    is marked up. Neither changes the underlying ring, which is not
+    rebuilt. The failover nodes of up to C{cache_size} keys are cached
+    until a node is marked down or up; lookups are only slower while some
+    node is down.
+    """
+
+    def __init__(self, ring, cache_size=10000):
+        """
+        @param ring: A L{ConsistentHashRing} or a L{JumpHashRing}.
+        """
+        self.ring = ring
+        self.down = set()
+        self.cache = {}
+        self.cache_size = cache_size
+        self.failovers = 0
+
+    @property
+    def nodes(self):
+        return self.ring.nodes
+
+    def add_nodes(self, nodes):
+        self.ring.add_nodes(nodes)
+        self.cache.clear()
+
+    def add_node(self, node):
+        self.add_nodes([node])
+
+    def remove_node(self, node):
+        self.ring.remove_node(node)
+        self.down.discard(node)
+        self.cache.clear()
+
+    def mark_down(self, node):
+        """Route the keys of C{node} to the next nodes that are up."""
+        if node in self.ring.nodes and node not in self.down:
+            self.down.add(node)
+            self.cache.clear()
+
+    def mark_up(self, node):
+        """Route the keys of C{node} back to it."""
+        if node in self.down:
+            self.down.discard(node)
+            self.cache.clear()
+
+    def get_node(self, key):
+        """The node of C{key}, or the first of its next nodes that is up,
+        counting a failover. If all of them are down, the node of C{key}.
+        """
+        node = self.ring.get_node(key)
+        if not self.down or node not in self.down:
+            return node
+        cache = self.cache
+        failover = cache.get(key)
+        if failover is None:
+            failover = node
+            for next_node in self.ring.get_nodes(key):
+                if next_node not in self.down:
+                    failover = next_node
+                    break
+            if self.cache_size:
+                if len(cache) >= self.cache_size:
+                    cache.clear()
+                cache[key] = failover
+        if failover is not node:
+            self.failovers += 1
+        return failover
+
+    def get_nodes(self, key):
+        """The nodes of L{get_nodes} of the ring, the ones that are up
+        first."""
+        nodes = self.ring.get_nodes(key)
+        if not self.down:
+            return nodes
+        return ([node for node in nodes if node not in self.down] +
+                [node for node in nodes if node in self.down])
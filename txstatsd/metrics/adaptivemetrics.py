@@ -0,0 +1,208 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import random
+import time
+
+from txstatsd.metrics.metrics import Metrics
+
+
+class AdaptiveHandle(object):
+    """A metric of L{AdaptiveMetrics} bound to its fully-qualified name."""
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def mark(self, value=1):
+        """Report a sample of C{value}, if it's sampled."""
+        self.record(self.name, value)
+
+
+class AdaptiveMetrics(Metrics):
+
+    def __init__(self, connection=None, namespace="", budget=100,
+                 window=1.0, min_rate=0.001, wall_time_func=time.time):
+        """A L{Metrics} that picks the sample rate of each metric so that
+        no more than about C{budget} samples of it are sent every
+        C{window} seconds.
+
+        While a metric stays within its budget every sample is sent. Once
+        it goes over, its sample rate is lowered to the budget over the
+        rate of samples in the last window, and sampled counters and
+        timings are tagged with it so that the server scales them back up.
+        Meters are sent scaled up instead, as the server ignores their
+        sample rate, and gauges are sent as they are. The rate is raised
+        again as the traffic drops, one window later.
+
+        A spike doesn't wait for the window to end: when a metric sends
+        its whole budget early, its rate is lowered from the rate of
+        samples seen so far. Samples that aren't sent are not formatted.
+        Sample rates given to the reporting methods are ignored.
+
+        @param connection: The connection endpoint representing
+            the StatsD server.
+        @param namespace: The top-level namespace identifying the
+            origin of the samples.
+        @param budget: The number of samples sent per window and metric.
+        @param window: The time, in seconds, over which samples are
+            counted.
+        @param min_rate: The lowest sample rate.
+        @param wall_time_func: Function for obtaining wall time.
+        """
+        super(AdaptiveMetrics, self).__init__(connection, namespace)
+        self.budget = budget
+        self.window = window
+        self.min_rate = min_rate
+        self.wall_time_func = wall_time_func
+        self.random = random.Random()
+        # Per metric: the window start, the samples seen and sent in the
+        # window and the sample rate.
+        self.windows = {}
+
+    def gauge(self, name, value, sample_rate=1):
+        """Report an instantaneous reading of a particular value."""
+        self._send_gauge(self.fully_qualify_name(name), value)
+
+    def meter(self, name, value=1, sample_rate=1):
+        """Mark the occurrence of a given number of events."""
+        self._send_meter(self.fully_qualify_name(name), value)
+
+    def increment(self, name, value=1, sample_rate=1):
+        """Report and increase in name by count."""
+        self._send_counter(self.fully_qualify_name(name), value)
+
+    def decrement(self, name, value=1, sample_rate=1):
+        """Report and decrease in name by count."""
+        self._send_counter(self.fully_qualify_name(name), -value)
+
+    def timing(self, name, duration=None, sample_rate=1):
+        """Report that this sample performed in duration seconds.
+           Default duration is the actual elapsed time since
+           the last call to this method or reset_timing()"""
+        if duration is None:
+            duration = self.calculate_duration()
+        self._send_timing(self.fully_qualify_name(name), duration)
+
+    def counter_handle(self, name, sample_rate=1):
+        """Return a handle whose C{mark(value)} increases name by count."""
+        return AdaptiveHandle(self._send_counter,
+                              self.fully_qualify_name(name))
+
+    def gauge_handle(self, name, sample_rate=1):
+        """Return a handle whose C{mark(value)} reports an instantaneous
+        reading of a particular value."""
+        return AdaptiveHandle(self._send_gauge,
+                              self.fully_qualify_name(name))
+
+    def meter_handle(self, name, sample_rate=1):
+        """Return a handle whose C{mark(value)} marks the occurrence of a
+        given number of events."""
+        return AdaptiveHandle(self._send_meter,
+                              self.fully_qualify_name(name))
+
+    def timing_handle(self, name, sample_rate=1):
+        """Return a handle whose C{mark(duration)} reports that a sample
+        performed in duration seconds."""
+        return AdaptiveHandle(self._send_timing,
+                              self.fully_qualify_name(name))
+
+    def sample_rate(self, name):
+        """Return the current sample rate of the fully-qualified C{name}."""
+        window = self.windows.get(name)
+        if window is None:
+            return 1
+        return window[3]
+
+    def sample(self, name):
+        """Count a sample of the fully-qualified C{name}, and return the
+        rate it was sampled at, or C{None} if it's not to be sent."""
+        now = self.wall_time_func()
+        window = self.windows.get(name)
+        if window is None:
+            window = self.windows[name] = [now, 0, 0, 1]
+        elapsed = now - window[0]
+        if elapsed >= self.window:
+            if elapsed < 2 * self.window:
+                rate = self.rate_for(window[1])
+            else:
+                rate = 1
+            window[:] = [now, 0, 0, rate]
+            elapsed = 0
+        window[1] += 1
+        if window[2] >= self.budget:
+            # The budget is spent before the end of the window: lower the
+            # rate to the one the samples seen so far project to.
+            seen = window[1] * self.window / max(elapsed, self.window / 100.)
+            window[2] = 0
+            window[3] = max(min(window[3] / 2., self.rate_for(seen)),
+                            self.min_rate)
+        rate = window[3]
+        if rate < 1 and self.random.random() >= rate:
+            return None
+        window[2] += 1
+        return rate
+
+    def rate_for(self, seen):
+        """Return the sample rate keeping C{seen} samples within budget."""
+        if seen <= self.budget:
+            return 1
+        # Round the rate to keep messages short.
+        return max(float("%.2g" % (self.budget / float(seen),)),
+                   self.min_rate)
+
+    def _send_gauge(self, name, value):
+        if self.sample(name) is not None:
+            self._write("%s:%s|g" % (name, value))
+
+    def _send_meter(self, name, value):
+        rate = self.sample(name)
+        if rate is not None:
+            if rate < 1:
+                value = value / rate
+            self._write("%s:%s|m" % (name, value))
+
+    def _send_counter(self, name, value):
+        rate = self.sample(name)
+        if rate is not None:
+            if rate < 1:
+                self._write("%s:%s|c|@%s" % (name, value, format_rate(rate)))
+            else:
+                self._write("%s:%s|c" % (name, value))
+
+    def _send_timing(self, name, duration):
+        rate = self.sample(name)
+        if rate is not None:
+            if rate < 1:
+                self._write("%s:%s|ms|@%s" % (name, duration * 1000,
+                                              format_rate(rate)))
+            else:
+                self._write("%s:%s|ms" % (name, duration * 1000))
+
+    def _write(self, data):
+        if self.connection is not None:
+            self.connection.write(data.encode('utf-8'))
+
+
+def format_rate(rate):
+    """Format a sample rate without the exponent notation, which isn't
+    accepted as a sample rate."""
+    return ("%.12f" % rate).rstrip("0").rstrip(".")
@@ -0,0 +1,256 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import atexit
+import os
+import random
+import threading
+import time
+import weakref
+
+from txstatsd.client import flush_at_exit
+from txstatsd.metrics.metric import Metric
+from txstatsd.metrics.metrics import Metrics
+
+
+class AggregatingHandle(object):
+    """A metric of L{AggregatingMetrics} bound to its fully-qualified
+    name."""
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def mark(self, value=1):
+        """Record a sample of C{value}."""
+        self.record(self.name, value)
+
+
+class AggregatingMetrics(Metrics):
+
+    def __init__(self, connection=None, namespace="", flush_interval=1.0,
+                 reservoir_size=100, wall_time_func=time.time):
+        """A L{Metrics} that aggregates samples locally and reports them
+        once every C{flush_interval} seconds.
+
+        Counters and meters are summed, gauges keep their last value and
+        timings are kept in a uniform reservoir of up to C{reservoir_size}
+        samples. When more timings were recorded, the reservoir is reported
+        with the matching sample rate, and the server derives percentiles
+        and the timer count from those samples alone. Sample rates given
+        to the reporting methods are ignored, as every sample is recorded.
+
+        Aggregates are reported every C{flush_interval} seconds by a daemon
+        thread started on the first sample, which doesn't keep the metrics
+        alive, on L{flush} and when the interpreter exits. In a forked
+        process, aggregation starts over, leaving the aggregates inherited
+        from the parent to the parent; each worker of a pre-forking server
+        thus reports its own aggregates.
+
+        @param connection: The connection endpoint representing
+            the StatsD server.
+        @param namespace: The top-level namespace identifying the
+            origin of the samples.
+        @param flush_interval: The time, in seconds, samples are
+            aggregated for.
+        @param reservoir_size: The number of timing samples kept per
+            interval and metric.
+        @param wall_time_func: Function for obtaining wall time.
+        """
+        super(AggregatingMetrics, self).__init__(connection, namespace)
+        self.flush_interval = flush_interval
+        self.reservoir_size = reservoir_size
+        self.wall_time_func = wall_time_func
+        self.random = random.Random()
+        self.lock = threading.Lock()
+        self.next_flush = wall_time_func() + flush_interval
+        self.counters = {}
+        self.gauges = {}
+        self.meters = {}
+        self.timers = {}
+        self.flusher = None
+        self.pid = os.getpid()
+        atexit.register(flush_at_exit, weakref.ref(self))
+
+    def gauge(self, name, value, sample_rate=1):
+        """Record an instantaneous reading of a particular value."""
+        self._set_gauge(self.fully_qualify_name(name), value)
+
+    def meter(self, name, value=1, sample_rate=1):
+        """Record the occurrence of a given number of events."""
+        self._add_meter(self.fully_qualify_name(name), value)
+
+    def increment(self, name, value=1, sample_rate=1):
+        """Record an increase in name by count."""
+        self._add_counter(self.fully_qualify_name(name), value)
+
+    def decrement(self, name, value=1, sample_rate=1):
+        """Record a decrease in name by count."""
+        self._add_counter(self.fully_qualify_name(name), -value)
+
+    def timing(self, name, duration=None, sample_rate=1):
+        """Record that this sample performed in duration seconds.
+           Default duration is the actual elapsed time since
+           the last call to this method or reset_timing()"""
+        if duration is None:
+            duration = self.calculate_duration()
+        self._add_timing(self.fully_qualify_name(name), duration)
+
+    def counter_handle(self, name, sample_rate=1):
+        """Return a handle whose C{mark(value)} records an increase in name
+        by count."""
+        return AggregatingHandle(self._add_counter,
+                                 self.fully_qualify_name(name))
+
+    def gauge_handle(self, name, sample_rate=1):
+        """Return a handle whose C{mark(value)} records an instantaneous
+        reading of a particular value."""
+        return AggregatingHandle(self._set_gauge,
+                                 self.fully_qualify_name(name))
+
+    def meter_handle(self, name, sample_rate=1):
+        """Return a handle whose C{mark(value)} records the occurrence of a
+        given number of events."""
+        return AggregatingHandle(self._add_meter,
+                                 self.fully_qualify_name(name))
+
+    def timing_handle(self, name, sample_rate=1):
+        """Return a handle whose C{mark(duration)} records that a sample
+        performed in duration seconds."""
+        return AggregatingHandle(self._add_timing,
+                                 self.fully_qualify_name(name))
+
+    def _set_gauge(self, name, value):
+        if self.pid != os.getpid():
+            self.after_fork()
+        with self.lock:
+            self.gauges[name] = value
+        self.maybe_flush()
+
+    def _add_meter(self, name, value):
+        if self.pid != os.getpid():
+            self.after_fork()
+        with self.lock:
+            self.meters[name] = self.meters.get(name, 0) + value
+        self.maybe_flush()
+
+    def _add_counter(self, name, value):
+        if self.pid != os.getpid():
+            self.after_fork()
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.maybe_flush()
+
+    def _add_timing(self, name, duration):
+        if self.pid != os.getpid():
+            self.after_fork()
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, []]
+            timer[0] += 1
+            samples = timer[1]
+            if len(samples) < self.reservoir_size:
+                samples.append(duration * 1000)
+            else:
+                index = int(self.random.random() * timer[0])
+                if index < self.reservoir_size:
+                    samples[index] = duration * 1000
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        """Report the aggregates if the flush interval elapsed."""
+        if self.flusher is None:
+            self.start_flusher()
+        if self.wall_time_func() >= self.next_flush:
+            self.flush()
+
+    def start_flusher(self):
+        """Start the thread reporting the aggregates every
+        C{flush_interval} seconds."""
+        self.flusher = threading.Thread(
+            target=run_flusher,
+            args=(weakref.ref(self), self.flush_interval))
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def flush(self):
+        """Report and reset the aggregates."""
+        if self.pid != os.getpid():
+            self.after_fork()
+        with self.lock:
+            self.next_flush = self.wall_time_func() + self.flush_interval
+            counters, self.counters = self.counters, {}
+            gauges, self.gauges = self.gauges, {}
+            meters, self.meters = self.meters, {}
+            timers, self.timers = self.timers, {}
+
+        for name, value in counters.items():
+            self._metric(name).send("%s|c" % value)
+        for name, value in gauges.items():
+            self._metric(name).send("%s|g" % value)
+        for name, value in meters.items():
+            self._metric(name).send("%s|m" % value)
+        for name, (count, samples) in timers.items():
+            metric = self._metric(name)
+            if count > len(samples):
+                # Avoid the exponent notation, which isn't accepted as a
+                # sample rate.
+                rate = "%.12f" % (len(samples) / float(count),)
+                rate = "|@" + rate.rstrip("0").rstrip(".")
+            else:
+                rate = ""
+            for sample in samples:
+                metric.send("%s|ms%s" % (sample, rate))
+
+    def after_fork(self):
+        """Drop the aggregates and the lock inherited from the parent."""
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.next_flush = self.wall_time_func() + self.flush_interval
+        self.counters = {}
+        self.gauges = {}
+        self.meters = {}
+        self.timers = {}
+
+    def _metric(self, name):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = Metric(self.connection, name)
+        return metric
+
+
+def run_flusher(metrics_ref, interval):
+    """Report the aggregates of an L{AggregatingMetrics} once their flush
+    interval elapsed, until it goes away."""
+    while True:
+        metrics = metrics_ref()
+        if metrics is None:
+            return
+        delay = metrics.next_flush - metrics.wall_time_func()
+        del metrics
+        time.sleep(max(0, min(delay, interval)))
+        metrics = metrics_ref()
+        if metrics is None:
+            return
+        metrics.maybe_flush()
+        del metrics
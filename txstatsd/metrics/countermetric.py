@@ -51,6 +51,10 @@ class CounterMetric(Metric):
         self._count -= value
         self._update(self._count)
 
+    def mark(self, value=1):
+        """Increment the counter by C{value}"""
+        self.increment(value)
+
     def count(self):
         """Returns the counter's current value."""
         return self._count
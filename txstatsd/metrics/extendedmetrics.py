@@ -60,6 +60,17 @@ class ExtendedMetrics(Metrics):
             self._metrics[name] = metric
         self._metrics[name].decrement(value)
 
+    def counter_handle(self, name, sample_rate=1):
+        """Return the counter for name, whose C{mark(value)} increases it
+        by count."""
+        name = self.fully_qualify_name(name)
+        if not name in self._metrics:
+            metric = CounterMetric(self.connection,
+                                   name,
+                                   sample_rate)
+            self._metrics[name] = metric
+        return self._metrics[name]
+
     def timing(self, name, duration=None, sample_rate=1):
         """Report this sample performed in duration seconds."""
         if duration is None:
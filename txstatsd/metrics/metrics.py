@@ -19,6 +19,7 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import random
 import time
 from txstatsd.metrics.gaugemetric import GaugeMetric
 from txstatsd.metrics.metermetric import MeterMetric
@@ -38,6 +39,52 @@ class GenericMetric(Metric):
             self.send("%s|%s|%s" % (value, self.key, extra))
 
 
+class MetricHandle(object):
+    """A metric bound to its fully-qualified name, returned by
+    L{Metrics.counter_handle}, L{Metrics.gauge_handle},
+    L{Metrics.meter_handle} and L{Metrics.timing_handle}.
+
+    The name, type and sample rate are formatted and encoded once, so that
+    L{mark} only formats the value.
+    """
+
+    def __init__(self, connection, name, metric_type, sample_rate=1,
+                 scale=1):
+        """
+        @param connection: The connection endpoint representing
+            the StatsD server.
+        @param name: The fully-qualified metric name.
+        @param metric_type: The StatsD type of the metric, as in C{c}.
+        @param sample_rate: Restrict the number of samples sent
+            to the StatsD server based on the supplied C{sample_rate}.
+        @param scale: The factor the marked values are multiplied by.
+        """
+        self.connection = connection
+        self.name = name
+        self.sample_rate = sample_rate
+        self.scale = scale
+        template = name.replace("%", "%%") + ":%s|" + metric_type
+        if sample_rate < 1:
+            template += "|@%s" % (sample_rate,)
+        if not isinstance(template, str):
+            # A unicode name on Python 2.
+            template = template.encode('utf-8')
+        self.template = template
+
+    def mark(self, value=1):
+        """Report a sample of C{value}."""
+        if self.connection is None:
+            return
+        if self.sample_rate < 1 and random.random() > self.sample_rate:
+            return
+        if self.scale != 1:
+            value *= self.scale
+        data = self.template % value
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.connection.write(data)
+
+
 class Metrics(object):
     def __init__(self, connection=None, namespace=""):
         """A convenience class for reporting metric samples
@@ -149,6 +196,29 @@ class Metrics(object):
             self._metrics[name] = metric
         self._metrics[name].send("%s|ms" % (duration * 1000))
 
+    def counter_handle(self, name, sample_rate=1):
+        """Return a handle whose C{mark(value)} increases name by count."""
+        return MetricHandle(self.connection, self.fully_qualify_name(name),
+                            "c", sample_rate)
+
+    def gauge_handle(self, name, sample_rate=1):
+        """Return a handle whose C{mark(value)} reports an instantaneous
+        reading of a particular value."""
+        return MetricHandle(self.connection, self.fully_qualify_name(name),
+                            "g", sample_rate)
+
+    def meter_handle(self, name, sample_rate=1):
+        """Return a handle whose C{mark(value)} marks the occurrence of a
+        given number of events."""
+        return MetricHandle(self.connection, self.fully_qualify_name(name),
+                            "m", sample_rate)
+
+    def timing_handle(self, name, sample_rate=1):
+        """Return a handle whose C{mark(duration)} reports that a sample
+        performed in duration seconds."""
+        return MetricHandle(self.connection, self.fully_qualify_name(name),
+                            "ms", sample_rate, scale=1000)
+
     def distinct(self, name, item):
         name = self.fully_qualify_name(name)
         if not name in self._metrics:
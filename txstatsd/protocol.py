@@ -19,14 +19,23 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
+import shutil
 import socket
+import threading
+from collections import deque
 
-from twisted.internet import abstract
-from twisted.internet.protocol import DatagramProtocol
+from zope.interface import implements
+
+from twisted.internet import abstract, defer, interfaces
+from twisted.internet.protocol import (
+    DatagramProtocol, Protocol, ReconnectingClientFactory)
+from twisted.internet.task import LoopingCall
 from twisted.python import log
 
 
-__all__ = ('StatsDClientProtocol', 'TwistedStatsDClient')
+__all__ = ('StatsDClientProtocol', 'TwistedStatsDClient', 'BatchingClient',
+           'MessageBuffer', 'TCPStatsDClient')
 
 
 class StatsDClientProtocol(DatagramProtocol):
@@ -49,40 +58,130 @@ class StatsDClientProtocol(DatagramProtocol):
 
 class DataQueue(object):
     """Manages the queue of sent data, so that it can be really sent later when
-    the host is resolved."""
+    the host is resolved.
+
+    Data is kept in a fixed-size buffer of C{limit} slots. Counter and meter
+    messages without a sample rate or callback are coalesced into the slot
+    already holding the same metric, so a burst of updates to a few metrics
+    takes a few slots. Data that doesn't fit is dropped and counted. Data
+    can be written from any thread.
+    """
 
     def __init__(self, limit=1000):
         self._limit = limit
-        self._queue = []
+        self._slots = [None] * limit
+        self._count = 0
+        self._coalescing = {}
+        self._lock = threading.Lock()
+
+        self.drops = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return self._count
 
     def write(self, data, callback):
         """Queue the given data, so that it's sent later.
 
         @param data: The data to be queued.
         @param callback: The callback to use when the data is flushed.
+        @return: C{True} if the data was queued, C{None} if it was dropped.
         """
-        if len(self._queue) < self._limit:
-            self._queue.append((data, callback))
+        if callback is None:
+            key, _, rest = data.partition(":")
+            value, _, kind = rest.partition("|")
+            if kind == "c" or kind == "m":
+                try:
+                    value = int(value)
+                except ValueError:
+                    try:
+                        value = float(value)
+                    except ValueError:
+                        kind = None
+                if kind is not None:
+                    with self._lock:
+                        kept = self._coalesce(key, kind, value, data)
+                    return True if kept else None
+        with self._lock:
+            kept = self._append(data, callback)
+        return True if kept else None
+
+    def _coalesce(self, key, kind, value, data):
+        entry = self._coalescing.get((key, kind))
+        if entry is None:
+            if not self._append(data, None):
+                return False
+            self._coalescing[(key, kind)] = [self._count - 1, value]
+            return True
+        entry[1] += value
+        self._slots[entry[0]] = ("%s:%s|%s" % (key, entry[1], kind), None)
+        self.coalesced += 1
+        return True
+
+    def _append(self, data, callback):
+        if self._count >= self._limit:
+            self.drops += 1
+            return False
+        self._slots[self._count] = (data, callback)
+        self._count += 1
+        return True
 
     def flush(self):
         """Flush the queue, returning its items."""
-        items = self._queue
-        self._queue = []
+        with self._lock:
+            items = self._slots[:self._count]
+            self._slots[:self._count] = [None] * self._count
+            self._count = 0
+            self._coalescing.clear()
         return items
 
+    def report_stats(self):
+        """Return and reset the drop and coalesced message counters."""
+        with self._lock:
+            stats = {"drops": self.drops, "coalesced": self.coalesced}
+            self.drops = self.coalesced = 0
+        return stats
+
 
 class TransportGateway(object):
-    """Responsible for sending datagrams to the actual transport."""
+    """Responsible for sending datagrams to the actual transport.
+
+    Metrics written from any thread are appended to a bounded buffer, and
+    the reactor is only woken up when the buffer goes from empty to
+    non-empty. Each wakeup drains the metrics buffered so far, packing them
+    into newline separated datagrams of up to C{max_size} bytes if given.
+    """
 
-    def __init__(self, transport, reactor, host, port):
+    def __init__(self, transport, reactor, host, port, max_size=0,
+                 buffer_size=10000):
         """
         @param transport: DatagramProtocol().transport .
         @param reactor: The Twisted reactor in use.
+        @param max_size: The maximum datagram size when packing metrics, 0
+            to send a datagram per metric.
+        @param buffer_size: The number of metrics waiting for the reactor
+            after which new ones are dropped.
         """
         self.transport = transport
         self.reactor = reactor
         self.host = host
         self.port = port
+        self.max_size = max_size
+        self.buffer_size = buffer_size
+
+        self.buffer = deque()
+        self.scheduled = False
+
+        self.wakeups = 0
+        self.packets = 0
+        self.drops = 0
+        self.overflows = 0
+
+    def after_fork(self):
+        """Drop the metrics buffered for the parent's reactor."""
+        self.buffer = deque()
+        self.scheduled = False
+        self.wakeups = self.packets = self.drops = self.overflows = 0
 
     def write(self, data, callback):
         """Send the metric to the StatsD server.
@@ -91,8 +190,78 @@ class TransportGateway(object):
         @param callback: The callback to which the result should be sent.
             B{Note}: The C{callback} will be called in the C{reactor}
             thread, and not in the thread of the original caller.
+        @return: C{True} if the metric was buffered, C{None} if it was
+            dropped.
+        """
+        if len(self.buffer) >= self.buffer_size:
+            self.overflows += 1
+            if callback is not None:
+                self.reactor.callFromThread(callback, None)
+            return None
+        self.buffer.append((data, callback))
+        if not self.scheduled:
+            self.scheduled = True
+            self.reactor.callFromThread(self._drain)
+        return True
+
+    def write_many(self, items):
+        """Send several metrics with a single wakeup.
+
+        @param items: A list of C{(data, callback)} tuples.
+        """
+        free = max(0, self.buffer_size - len(self.buffer))
+        self.buffer.extend(items[:free])
+        for data, callback in items[free:]:
+            self.overflows += 1
+            if callback is not None:
+                self.reactor.callFromThread(callback, None)
+        if items[:free] and not self.scheduled:
+            self.scheduled = True
+            self.reactor.callFromThread(self._drain)
+
+    def _drain(self):
+        """Send the metrics buffered so far, in the reactor thread.
+
+        Clearing C{scheduled} before draining guarantees that metrics
+        appended after the last one drained schedule another wakeup.
         """
-        self.reactor.callFromThread(self._write, data, callback)
+        self.scheduled = False
+        self.wakeups += 1
+        buffer = self.buffer
+        count = len(buffer)
+        if not self.max_size:
+            for _ in xrange(count):
+                data, callback = buffer.popleft()
+                self._write(data, callback)
+            return
+
+        batch = []
+        size = 0
+        for _ in xrange(count):
+            data, callback = buffer.popleft()
+            if batch and size + 1 + len(data) > self.max_size:
+                self._write_batch(batch)
+                batch = []
+            if batch:
+                size += 1 + len(data)
+            else:
+                size = len(data)
+            batch.append((data, callback))
+        if batch:
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        """Send C{batch} as a single datagram, calling back each metric's
+        callback with its own size, or C{None} if the datagram failed."""
+        if len(batch) == 1:
+            return self._write(*batch[0])
+        payload = "\n".join([data for data, callback in batch])
+
+        def sent(bytes_sent):
+            for data, callback in batch:
+                if callback is not None:
+                    callback(None if bytes_sent is None else len(data))
+        self._write(payload, sent)
 
     def _write(self, data, callback):
         """Send the metric to the StatsD server.
@@ -104,17 +273,31 @@ class TransportGateway(object):
         """
         try:
             bytes_sent = self.transport.write(data, (self.host, self.port))
-            if callback is not None:
-                callback(bytes_sent)
         except (OverflowError, TypeError, socket.error, socket.gaierror):
-            if callback is not None:
-                callback(None)
+            bytes_sent = None
+        if bytes_sent is None:
+            self.drops += 1
+        else:
+            self.packets += 1
+        if callback is not None:
+            callback(bytes_sent)
+
+    def report_stats(self):
+        """Return and reset the wakeup, packet, drop and overflow
+        counters."""
+        stats = {"wakeups": self.wakeups,
+                 "packets": self.packets,
+                 "drops": self.drops,
+                 "overflows": self.overflows}
+        self.wakeups = self.packets = self.drops = self.overflows = 0
+        return stats
 
 
 class TwistedStatsDClient(object):
 
     def __init__(self, host, port, connect_callback=None,
-                 disconnect_callback=None, reactor=None):
+                 disconnect_callback=None, reactor=None, max_size=0,
+                 buffer_size=10000):
         """Avoid using this initializer directly; Instead, use the create()
         static method, otherwise the messages won't be really delivered.
 
@@ -125,21 +308,34 @@ class TwistedStatsDClient(object):
         @param port: The StatsD server port.
         @param connect_callback: The callback to invoke on connection.
         @param disconnect_callback: The callback to invoke on disconnection.
+        @param max_size: The maximum datagram size when packing metrics
+            written between two reactor wakeups, 0 to send a datagram per
+            metric. The StatsD server must then accept several metrics per
+            datagram.
+        @param buffer_size: The number of metrics waiting for the reactor
+            after which new ones are dropped.
         """
         if reactor is None:
             from twisted.internet import reactor
 
         self.reactor = reactor
 
-        self.host = host
+        self.hostname = self.host = host
         self.port = port
         self.connect_callback = connect_callback
         self.disconnect_callback = disconnect_callback
+        self.max_size = max_size
+        self.buffer_size = buffer_size
         self.data_queue = DataQueue()
 
         self.transport = None
         self.transport_gateway = None
 
+        self.resolver = None
+        self.resolve_failures = 0
+        self.address_changes = 0
+        self.pid = os.getpid()
+
         if abstract.isIPAddress(host):
             self.host_resolved(host)
 
@@ -148,10 +344,14 @@ class TwistedStatsDClient(object):
 
     @classmethod
     def create(cls, host, port, connect_callback=None,
-               disconnect_callback=None, resolver_errback=None, reactor=None):
+               disconnect_callback=None, resolver_errback=None, reactor=None,
+               max_size=0, buffer_size=10000, resolve_interval=0):
         """Create an instance that resolves the host to an IP asynchronously.
 
-        Will queue all messages while the host is not yet resolved.
+        Will queue all messages while the host is not yet resolved. With a
+        C{resolve_interval}, the host is resolved again every
+        C{resolve_interval} seconds until disconnected, and messages go to
+        the last address resolved.
 
         Build a connection that reports to the endpoint (on C{host} and
         C{port}) using UDP.
@@ -161,20 +361,32 @@ class TwistedStatsDClient(object):
         @param resolver_errback: The errback to invoke should
             issues occur resolving the supplied C{host}.
         @param connect_callback: The callback to invoke on connection.
-        @param disconnect_callback: The callback to invoke on disconnection."""
+        @param disconnect_callback: The callback to invoke on disconnection.
+        @param max_size: The maximum datagram size when packing metrics.
+        @param buffer_size: The number of metrics waiting for the reactor
+            after which new ones are dropped.
+        @param resolve_interval: The time, in seconds, between resolutions
+            of C{host}, 0 to resolve it only once."""
         if reactor is None:
             from twisted.internet import reactor
 
         instance = cls(
             host=host, port=port, connect_callback=connect_callback,
-            disconnect_callback=disconnect_callback, reactor=reactor)
+            disconnect_callback=disconnect_callback, reactor=reactor,
+            max_size=max_size, buffer_size=buffer_size)
 
         if resolver_errback is None:
             resolver_errback = log.err
 
-        instance.resolve_later = reactor.resolve(host)
-        instance.resolve_later.addCallbacks(instance.host_resolved,
-                                            resolver_errback)
+        if abstract.isIPAddress(host):
+            # The initializer already took the address as resolved.
+            instance.resolve_later = defer.succeed(host)
+        else:
+            instance.resolve_later = reactor.resolve(host)
+            instance.resolve_later.addCallbacks(instance.host_resolved,
+                                                resolver_errback)
+            if resolve_interval:
+                instance.start_resolver(resolve_interval)
 
         return instance
 
@@ -191,6 +403,13 @@ class TwistedStatsDClient(object):
         if self.disconnect_callback is not None:
             self.disconnect_callback()
         self.transport = None
+        if self.resolver is not None and self.resolver.running:
+            self.resolver.stop()
+
+    def healthy(self):
+        """Whether the client is connected and its host resolved."""
+        return (self.transport is not None and
+                self.transport_gateway is not None)
 
     def write(self, data, callback=None):
         """Send the metric to the StatsD server.
@@ -199,25 +418,527 @@ class TwistedStatsDClient(object):
         @param callback: The callback to which the result should be sent.
             B{Note}: The C{callback} will be called in the C{reactor}
             thread, and not in the thread of the original caller.
+        @return: A true value if the metric was sent or queued, C{None} if
+            it was dropped.
         """
+        if self.pid != os.getpid():
+            self.after_fork()
         if self.transport_gateway is not None and self.transport is not None:
             return self.transport_gateway.write(data, callback)
         return self.data_queue.write(data, callback)
 
+    def after_fork(self):
+        """Drop the data queued and buffered by the parent process, so that
+        it's not sent twice."""
+        self.pid = os.getpid()
+        self.data_queue = DataQueue(self.data_queue._limit)
+        if self.transport_gateway is not None:
+            self.transport_gateway.after_fork()
+
     def host_resolved(self, ip):
         """Callback used when the host is resolved to an IP address."""
         self.host = ip
-        self.transport_gateway = TransportGateway(self.transport, self.reactor,
-                                                  self.host, self.port)
+        self.transport_gateway = TransportGateway(
+            self.transport, self.reactor, self.host, self.port,
+            max_size=self.max_size, buffer_size=self.buffer_size)
 
         if self.connect_callback is not None:
             self.connect_callback()
 
         self._flush_items()
 
+    def start_resolver(self, interval):
+        """Resolve the host again every C{interval} seconds."""
+        self.resolver = LoopingCall(self.resolve)
+        self.resolver.clock = self.reactor
+        self.resolver.start(interval, now=False)
+
+    def resolve(self):
+        """Resolve the host again, keeping the last address on failure."""
+        d = self.reactor.resolve(self.hostname)
+        d.addCallbacks(self.address_resolved, self.resolve_failed)
+        return d
+
+    def address_resolved(self, ip):
+        """Callback used when the host is resolved again."""
+        if self.transport_gateway is None:
+            return self.host_resolved(ip)
+        if ip != self.host:
+            self.address_changes += 1
+            self.host = self.transport_gateway.host = ip
+
+    def resolve_failed(self, failure):
+        """Errback used when the host cannot be resolved again."""
+        self.resolve_failures += 1
+
     def _flush_items(self):
         """Flush all items (data, callback) from the DataQueue to the
-        TransportGateway."""
-        for item in self.data_queue.flush():
-            data, callback = item
-            self.write(data, callback)
+        TransportGateway, in a single batch."""
+        if self.transport_gateway is None or self.transport is None:
+            return
+        items = self.data_queue.flush()
+        if items:
+            self.transport_gateway.write_many(items)
+
+    def report_stats(self):
+        """Return and reset the counters of the L{TransportGateway}, the
+        drop and coalesced counters of the L{DataQueue}, and the resolution
+        failure and address change counters."""
+        if self.transport_gateway is None:
+            stats = {"wakeups": 0, "packets": 0, "drops": 0, "overflows": 0}
+        else:
+            stats = self.transport_gateway.report_stats()
+        for name, value in self.data_queue.report_stats().items():
+            stats["queue_" + name] = value
+        stats["resolve_failures"] = self.resolve_failures
+        stats["address_changes"] = self.address_changes
+        self.resolve_failures = self.address_changes = 0
+        return stats
+
+
+class BatchingClient(object):
+    """Packs the messages written to a client into newline-joined payloads.
+
+    A payload is written to the wrapped client when adding a message would
+    make it larger than C{max_size} bytes, or C{delay} seconds after its first
+    message was added, whichever comes first. The receiving end must accept
+    several messages per datagram.
+    """
+
+    def __init__(self, client, max_size=512, delay=0.05, reactor=None):
+        """
+        @param client: The client to write payloads to, usually a
+            L{TwistedStatsDClient}.
+        @param max_size: The maximum size of a payload, in bytes.
+        @param delay: The maximum time, in seconds, a message is held back.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.client = client
+        self.max_size = max_size
+        self.delay = delay
+
+        self.buffer = []
+        self.size = 0
+        self.delayed_flush = None
+
+        self.messages = 0
+        self.packets = 0
+        self.bytes = 0
+        self.drops = 0
+
+    def __str__(self):
+        return str(self.client)
+
+    def healthy(self):
+        """Whether the wrapped client can send."""
+        return self.client.healthy()
+
+    def write(self, data, callback=None):
+        """Add a message to the current payload.
+
+        @param callback: Ignored, accepted for compatibility with the
+            wrapped client.
+        @return: C{True}, as the message is always added.
+        """
+        size = len(data)
+        if self.buffer and self.size + 1 + size > self.max_size:
+            self.flush()
+        if self.buffer:
+            self.size += 1 + size
+        else:
+            self.size = size
+        self.buffer.append(data)
+        self.messages += 1
+        if self.size >= self.max_size:
+            self.flush()
+        elif self.delayed_flush is None:
+            self.delayed_flush = self.reactor.callLater(
+                self.delay, self.flush)
+        return True
+
+    def flush(self):
+        """Write the current payload to the client."""
+        if self.delayed_flush is not None:
+            if self.delayed_flush.active():
+                self.delayed_flush.cancel()
+            self.delayed_flush = None
+        if not self.buffer:
+            return
+        count = len(self.buffer)
+        payload = "\n".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+
+        def sent(bytes_sent):
+            if bytes_sent is None:
+                self.drops += count
+            else:
+                self.packets += 1
+                self.bytes += bytes_sent
+        self.client.write(payload, sent)
+
+    def report_stats(self):
+        """Return and reset the message, packet, byte and drop counters."""
+        stats = {"messages": self.messages,
+                 "packets": self.packets,
+                 "bytes": self.bytes,
+                 "drops": self.drops}
+        self.messages = self.packets = self.bytes = self.drops = 0
+        return stats
+
+
+class MessageBuffer(object):
+    """A bounded buffer for messages that can't be written yet.
+
+    Up to C{limit} messages are kept in memory. If a C{spill_path} is given,
+    messages that don't fit are appended to that file, up to C{spill_limit}
+    bytes; anything else is dropped. Buffered messages are written back, in
+    order, by L{replay}, as fast as the destination takes them, C{replay_batch}
+    messages per reactor iteration so that a long backlog doesn't block the
+    reactor.
+
+    On L{close}, the messages already replayed are removed from the spill
+    file, so that they aren't replayed again after a restart.
+    """
+
+    def __init__(self, limit=10000, spill_path=None,
+                 spill_limit=100 * 1024 * 1024, replay_batch=1000,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.limit = limit
+        self.memory = deque()
+
+        self.spill_path = spill_path
+        self.spill_limit = spill_limit
+        self.spill_file = None
+        self.spill_reader = None
+        self.spill_size = 0
+        self.spill_offset = 0
+        if spill_path is not None:
+            self.spill_file = open(spill_path, "ab")
+            self.spill_reader = open(spill_path, "rb")
+            self.spill_size = os.path.getsize(spill_path)
+
+        self.replay_batch = max(1, replay_batch)
+        self.replaying = None
+
+        self.drops = 0
+        self.replayed = 0
+
+    def __len__(self):
+        """The number of messages held in memory."""
+        return len(self.memory)
+
+    @property
+    def spilled(self):
+        """The number of bytes spilled to disk and not replayed yet."""
+        return self.spill_size - self.spill_offset
+
+    def has_pending(self):
+        """Whether there are messages waiting to be replayed."""
+        return bool(self.memory) or self.spill_size > self.spill_offset
+
+    def append(self, data):
+        """Buffer a message, spilling or dropping it if memory is full."""
+        if len(self.memory) < self.limit and not self.spilled:
+            self.memory.append(data)
+        elif (self.spill_file is not None and
+              self.spilled + len(data) + 1 <= self.spill_limit):
+            self.spill_file.write(data + "\n")
+            self.spill_size += len(data) + 1
+        else:
+            self.drops += 1
+
+    def pop(self):
+        """Remove and return the oldest message, or C{None}."""
+        if self.memory:
+            return self.memory.popleft()
+        if self.spill_size <= self.spill_offset:
+            return None
+        self.spill_file.flush()
+        self.spill_reader.seek(self.spill_offset)
+        line = self.spill_reader.readline()
+        self.spill_offset += len(line)
+        if self.spill_offset >= self.spill_size:
+            self.spill_file.truncate(0)
+            self.spill_size = self.spill_offset = 0
+        return line.rstrip("\n")
+
+    def replay(self, write, writable):
+        """Write the buffered messages with C{write} while C{writable()}.
+
+        Messages are written in batches, one per reactor iteration. Replay
+        stops when the buffer is empty or C{writable()} returns false, and
+        needs to be started again after that.
+        """
+        self.stop_replay()
+        self._replay(write, writable)
+
+    def _replay(self, write, writable):
+        self.replaying = None
+        count = self.replay_batch
+        while count and writable():
+            data = self.pop()
+            if data is None:
+                return
+            write(data)
+            self.replayed += 1
+            count -= 1
+        if writable() and self.has_pending():
+            self.replaying = self.reactor.callLater(
+                0, self._replay, write, writable)
+
+    def stop_replay(self):
+        """Stop replaying messages."""
+        if self.replaying is not None and self.replaying.active():
+            self.replaying.cancel()
+        self.replaying = None
+
+    def close(self):
+        """Stop replaying and close the spill file, keeping the messages
+        not replayed yet."""
+        self.stop_replay()
+        if self.spill_file is not None:
+            if self.spill_offset:
+                self.compact()
+            self.spill_file.close()
+            self.spill_reader.close()
+            self.spill_file = self.spill_reader = None
+            self.spill_size = self.spill_offset = 0
+
+    def compact(self):
+        """Remove the messages already replayed from the spill file."""
+        self.spill_file.flush()
+        self.spill_reader.seek(self.spill_offset)
+        compacted_path = self.spill_path + ".compact"
+        with open(compacted_path, "wb") as compacted:
+            shutil.copyfileobj(self.spill_reader, compacted)
+        os.rename(compacted_path, self.spill_path)
+        self.spill_file.close()
+        self.spill_reader.close()
+        self.spill_file = open(self.spill_path, "ab")
+        self.spill_reader = open(self.spill_path, "rb")
+        self.spill_size -= self.spill_offset
+        self.spill_offset = 0
+
+    def report_stats(self):
+        """Return the buffer depth and spill size, and reset the drop and
+        replay counters."""
+        stats = {"depth": len(self.memory),
+                 "spilled_bytes": self.spilled,
+                 "drops": self.drops,
+                 "replayed": self.replayed}
+        self.drops = self.replayed = 0
+        return stats
+
+
+class TCPStatsDClientProtocol(Protocol):
+    """Writes the payloads of a L{TCPStatsDClient} and lets it know when the
+    transport can't take more."""
+
+    implements(interfaces.IPushProducer)
+
+    def __init__(self, client):
+        self.client = client
+        self.paused = False
+
+    def connectionMade(self):
+        self.transport.bufferSize = self.client.high_water
+        self.transport.registerProducer(self, True)
+        self.client.connection_made()
+
+    def pauseProducing(self):
+        self.paused = True
+        self.client.pause()
+
+    def stopProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.client.resume()
+
+
+class TCPStatsDClient(ReconnectingClientFactory):
+    """A reconnecting connection that reports to a StatsD server over TCP,
+    as accepted by L{StatsDTCPServerProtocol}.
+
+    Messages written during a reactor iteration are joined into a single
+    transport write, flushed early once it reaches C{max_size} bytes, so
+    that many metrics share a TCP segment. Messages written while
+    disconnected or while the transport is paused are kept in a
+    L{MessageBuffer}, optionally spilled to C{spill_path}, and replayed
+    once it can write again. The transport pauses once C{high_water} bytes
+    are waiting to be sent; C{pause_callback} and C{resume_callback} are
+    called as it pauses and resumes, so that applications can hold back;
+    a pause outstanding when the connection is lost ends once the client
+    reconnects. L{write} must be called from the reactor thread.
+    """
+
+    maxDelay = 30
+
+    def __init__(self, host, port, max_size=8192, high_water=1024 * 1024,
+                 buffer_size=10000, spill_path=None,
+                 spill_limit=100 * 1024 * 1024, pause_callback=None,
+                 resume_callback=None, reactor=None):
+        """
+        @param host: The StatsD server host.
+        @param port: The StatsD server port.
+        @param max_size: The size, in bytes, at which a payload is written
+            without waiting for the end of the reactor iteration.
+        @param high_water: The number of bytes waiting to be sent at which
+            the transport pauses.
+        @param buffer_size: The number of messages kept in memory while
+            the connection can't be written to.
+        @param spill_path: The file messages that don't fit in memory are
+            appended to, if any.
+        @param spill_limit: The maximum size of the spill file, in bytes.
+        @param pause_callback: The callback to invoke when the transport
+            pauses.
+        @param resume_callback: The callback to invoke when the transport
+            resumes.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.clock = reactor
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.high_water = high_water
+        self.pause_callback = pause_callback
+        self.resume_callback = resume_callback
+        self.paused = False
+        self.buffer = MessageBuffer(limit=buffer_size, spill_path=spill_path,
+                                    spill_limit=spill_limit, reactor=reactor)
+
+        self.protocol = None
+        self.connector = None
+        self.batch = []
+        self.size = 0
+        self.delayed_flush = None
+
+        self.messages = 0
+        self.writes = 0
+        self.bytes = 0
+        self.connects = 0
+
+    def __str__(self):
+        return "%s:%d" % (self.host, self.port)
+
+    def connect(self):
+        """Connect to the StatsD server, reconnecting when the connection
+        is lost."""
+        self.continueTrying = True
+        self.connector = self.reactor.connectTCP(self.host, self.port, self)
+
+    def disconnect(self):
+        """Write what can be written and disconnect from the StatsD
+        server, closing the buffer so that only the messages not replayed
+        yet are kept in the spill file."""
+        self.stopTrying()
+        self.flush()
+        if self.protocol is not None:
+            self.protocol.transport.loseConnection()
+        elif self.connector is not None:
+            self.connector.disconnect()
+        self.buffer.close()
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        self.connects += 1
+        self.protocol = TCPStatsDClientProtocol(self)
+        self.protocol.factory = self
+        return self.protocol
+
+    def clientConnectionLost(self, connector, reason):
+        self.protocol = None
+        self.buffer.stop_replay()
+        ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason)
+
+    def connection_made(self):
+        self.resume()
+
+    def pause(self):
+        if self.paused:
+            return
+        self.paused = True
+        if self.pause_callback is not None:
+            self.pause_callback()
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            if self.resume_callback is not None:
+                self.resume_callback()
+        self.replay()
+
+    def writable(self):
+        """Whether messages can be written to the connection right now."""
+        return self.protocol is not None and not self.protocol.paused
+
+    def replay(self):
+        """Start writing the buffered messages to the connection."""
+        if self.buffer.has_pending():
+            self.buffer.replay(self._write_payload, self.writable)
+
+    def healthy(self):
+        """Whether the client is connected to the StatsD server."""
+        return self.protocol is not None
+
+    def write(self, data, callback=None):
+        """Add a message to the payload written at the end of the reactor
+        iteration.
+
+        @param callback: Ignored, accepted for compatibility with the
+            other clients.
+        @return: C{True}, as messages that can't be written are buffered.
+        """
+        self.batch.append(data)
+        self.size += len(data) + 2
+        self.messages += 1
+        if self.size >= self.max_size:
+            self.flush()
+        elif self.delayed_flush is None:
+            self.delayed_flush = self.reactor.callLater(0, self.flush)
+        return True
+
+    def flush(self):
+        """Write the current payload, or buffer its messages if the
+        connection can't be written to."""
+        if self.delayed_flush is not None:
+            if self.delayed_flush.active():
+                self.delayed_flush.cancel()
+            self.delayed_flush = None
+        if not self.batch:
+            return
+        batch = self.batch
+        self.batch = []
+        self.size = 0
+        if self.writable() and not self.buffer.has_pending():
+            self._write_payload("\r\n".join(batch))
+        else:
+            for data in batch:
+                self.buffer.append(data)
+
+    def _write_payload(self, payload):
+        payload += "\r\n"
+        self.protocol.transport.write(payload)
+        self.writes += 1
+        self.bytes += len(payload)
+
+    def report_stats(self):
+        """Return the buffer depth and spill size, and reset the message,
+        write, byte, connect, drop and replay counters."""
+        stats = self.buffer.report_stats()
+        stats.update({"messages": self.messages,
+                      "writes": self.writes,
+                      "bytes": self.bytes,
+                      "connects": self.connects})
+        self.messages = self.writes = self.bytes = self.connects = 0
+        return stats
@@ -0,0 +1,60 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Carbon client that hands datapoints over to carbon in bulk."""
+
+from carbon import instrumentation
+from carbon.client import CarbonClientManager
+from carbon.conf import settings
+
+
+class BulkCarbonClientManager(CarbonClientManager):
+    """A L{CarbonClientManager} with a C{sendDatapoints} method, that sends
+    a list of datapoints with one router lookup per metric and one call per
+    destination.
+    """
+
+    def sendDatapoints(self, datapoints):
+        """Send a list of (metric, (timestamp, value)) datapoints.
+
+        Datapoints for a destination that is connected and not backed up
+        are pickled into a single message. Otherwise they go through the
+        destination queue one by one, like C{sendDatapoint} does.
+        """
+        destinations = {}
+        for datapoint in datapoints:
+            for destination in self.router.getDestinations(datapoint[0]):
+                destinations.setdefault(destination, []).append(datapoint)
+        for destination, points in destinations.iteritems():
+            send_to_factory(self.client_factories[destination], points)
+
+
+def send_to_factory(factory, datapoints):
+    """Send C{datapoints} to the destination of C{factory}."""
+    protocol = factory.connectedProtocol
+    if (protocol is None or protocol.paused or
+        factory.hasQueuedDatapoints() or
+        len(datapoints) > settings.MAX_DATAPOINTS_PER_MESSAGE):
+        for metric, datapoint in datapoints:
+            factory.sendDatapoint(metric, datapoint)
+        return
+
+    instrumentation.increment(factory.attemptedRelays, len(datapoints))
+    protocol._sendDatapoints(datapoints)
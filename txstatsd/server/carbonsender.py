@@ -0,0 +1,489 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""A carbon client that doesn't depend on the carbon package.
+
+L{CarbonSenderManager} keeps a persistent connection to each carbon-cache,
+sending datapoints in batches with the pickle or the plaintext protocol.
+Each destination has its own bounded queue for datapoints that can't be
+written yet, either because it is disconnected or because the transport
+write buffer went over its high-water mark and paused it. Queue and latency
+statistics are available per destination through C{report_stats}.
+
+With a L{SegmentSpool}, datapoints that don't fit in the queue are kept on
+disk instead of dropped, and replayed at a bounded rate once the
+destination is back, whenever no live datapoints are waiting.
+"""
+
+import os
+import struct
+from collections import deque
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from zope.interface import implements
+
+from twisted.application.service import Service
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Protocol, ReconnectingClientFactory
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from txstatsd.hashing import CarbonConsistentHashRing, JumpHashRing
+from txstatsd.server.spool import SegmentSpool
+
+
+def encode_pickle(datapoints):
+    """Encode datapoints as a length-prefixed pickle message."""
+    data = pickle.dumps(datapoints, protocol=2)
+    return struct.pack("!L", len(data)) + data
+
+
+def encode_plaintext(datapoints):
+    """Encode datapoints as plaintext protocol lines."""
+    return "".join(["%s %s %s\n" % (metric, value, timestamp)
+                    for metric, (timestamp, value) in datapoints])
+
+
+ENCODERS = {"pickle": encode_pickle, "line": encode_plaintext}
+
+
+def destination_name(destination):
+    """Name a (host, port, instance) destination for stats and paths."""
+    return ("%s:%d:%s" % destination).replace(".", "_").replace(":", "_")
+
+
+def parse_destination(spec):
+    """Parse a host:port[:instance] destination."""
+    parts = spec.split(":")
+    if len(parts) not in (2, 3):
+        raise ValueError("bad destination %s" % (spec,))
+    instance = parts[2] if len(parts) == 3 else None
+    return (parts[0], int(parts[1]), instance)
+
+
+class ConsistentHashingRouter(object):
+    """Routes metrics to destinations like carbon's ConsistentHashingRouter.
+
+    Routers pick the (host, port, instance) destinations of each metric,
+    with the same interface as carbon's routers, so they can be used with
+    either carbon client.
+    """
+
+    def __init__(self, replication_factor=1):
+        self.replication_factor = int(replication_factor)
+        self.instance_ports = {}
+        self.ring = CarbonConsistentHashRing([])
+
+    def addDestination(self, destination):
+        server, port, instance = destination
+        if (server, instance) in self.instance_ports:
+            raise ValueError("destination instance (%s, %s) already "
+                             "configured" % (server, instance))
+        self.instance_ports[(server, instance)] = port
+        self.ring.add_node((server, instance))
+
+    def removeDestination(self, destination):
+        server, port, instance = destination
+        del self.instance_ports[(server, instance)]
+        self.ring.remove_node((server, instance))
+
+    def getDestinations(self, metric):
+        if self.replication_factor == 1:
+            nodes = [self.ring.get_node(metric)]
+        else:
+            nodes = self.ring.get_nodes(metric)[:self.replication_factor]
+        return [(server, self.instance_ports[(server, instance)], instance)
+                for server, instance in nodes]
+
+
+class JumpHashingRouter(object):
+    """Routes metrics with jump consistent hash over the destinations, in
+    the order they were added."""
+
+    def __init__(self, replication_factor=1):
+        self.replication_factor = int(replication_factor)
+        self.ring = JumpHashRing([])
+
+    def addDestination(self, destination):
+        self.ring.add_node(destination)
+
+    def removeDestination(self, destination):
+        self.ring.remove_node(destination)
+
+    def getDestinations(self, metric):
+        if self.replication_factor == 1:
+            return [self.ring.get_node(metric)]
+        return self.ring.get_nodes(metric)[:self.replication_factor]
+
+
+class ReplicatingRouter(object):
+    """Routes every metric to every destination."""
+
+    def __init__(self):
+        self.destinations = []
+
+    def addDestination(self, destination):
+        if destination not in self.destinations:
+            self.destinations.append(destination)
+
+    def removeDestination(self, destination):
+        self.destinations.remove(destination)
+
+    def getDestinations(self, metric):
+        return self.destinations
+
+
+class RelayRulesRouter(object):
+    """Routes metrics by prefix.
+
+    The rules are separated by newlines or semicolons, each one being a
+    prefix followed by the destinations of the metrics starting with it, as
+    host:port[:instance]. The first matching rule wins, and a rule with the
+    C{*} prefix matches any metric; it is required, so that every metric
+    goes somewhere. Destinations that are not configured are skipped.
+    """
+
+    def __init__(self, rules):
+        self.rules = []
+        self.default = None
+        for rule in rules.replace(";", "\n").splitlines():
+            parts = rule.split()
+            if not parts:
+                continue
+            if len(parts) < 2:
+                raise ValueError("bad relay rule %s" % (rule,))
+            destinations = [parse_destination(spec) for spec in parts[1:]]
+            if parts[0] == "*":
+                self.default = destinations
+            else:
+                self.rules.append((parts[0], destinations))
+        if self.default is None:
+            raise ValueError("relay rules need a default * rule")
+        self.destinations = set()
+
+    def addDestination(self, destination):
+        self.destinations.add(destination)
+
+    def removeDestination(self, destination):
+        self.destinations.discard(destination)
+
+    def getDestinations(self, metric):
+        for prefix, destinations in self.rules:
+            if metric.startswith(prefix):
+                break
+        else:
+            destinations = self.default
+        return [destination for destination in destinations
+                if destination in self.destinations]
+
+
+def build_router(name, relay_rules=None):
+    """Build the router called C{name}: C{consistent-hashing}, C{jump},
+    C{relay} with C{relay_rules} or C{replicate}."""
+    if name == "consistent-hashing":
+        return ConsistentHashingRouter()
+    if name == "jump":
+        return JumpHashingRouter()
+    if name == "relay":
+        return RelayRulesRouter(relay_rules or "")
+    if name == "replicate":
+        return ReplicatingRouter()
+    raise ValueError("unknown carbon router %s" % (name,))
+
+
+class CarbonSenderProtocol(Protocol):
+    """Writes batches of datapoints to a carbon-cache.
+
+    The protocol registers itself as the producer for its transport, which
+    pauses it once the write buffer goes over the factory C{high_water}
+    mark, and resumes it when the buffer drains.
+    """
+    implements(IPushProducer)
+
+    paused = False
+
+    def connectionMade(self):
+        self.transport.bufferSize = self.factory.high_water
+        self.transport.registerProducer(self, True)
+        self.factory.connectionMade(self)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.factory.sendQueued()
+
+    def stopProducing(self):
+        self.paused = True
+
+    def sendDatapoints(self, datapoints):
+        self.transport.write(self.factory.encode(datapoints))
+
+
+class CarbonSenderFactory(ReconnectingClientFactory):
+    """Keeps a connection to a carbon-cache and the queue of datapoints
+    waiting to be sent to it."""
+
+    maxDelay = 5
+    replay_interval = 0.1
+
+    def __init__(self, destination, protocol="pickle", max_queue_size=20000,
+                 max_datapoints_per_message=1000, high_water=1024 * 1024,
+                 spool=None, replay_rate=10000, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.destination = destination
+        self.host, self.port, self.instance = destination
+        self.encode = ENCODERS[protocol]
+        self.max_queue_size = max_queue_size
+        self.max_datapoints_per_message = max_datapoints_per_message
+        self.high_water = high_water
+
+        self.connector = None
+        self.connectedProtocol = None
+        # Batches of datapoints, along with the time they were queued.
+        self.queue = deque()
+        self.queue_size = 0
+
+        self.spool = spool
+        self.replay_batch = max(1, int(replay_rate * self.replay_interval))
+        self.replaying = None
+
+        self.sent = 0
+        self.drops = 0
+        self.max_queue_size_seen = 0
+        self.latency_total = 0
+        self.latency_max = 0
+        self.latency_count = 0
+        self.connects = 0
+
+    def buildProtocol(self, addr):
+        protocol = CarbonSenderProtocol()
+        protocol.factory = self
+        return protocol
+
+    def startConnecting(self):
+        self.continueTrying = True
+        self.connector = self.reactor.connectTCP(self.host, self.port, self)
+
+    def stopConnecting(self):
+        self.stopTrying()
+        self.stopReplay()
+        if self.spool is not None:
+            self.spool.close()
+        if self.connectedProtocol is not None:
+            self.connectedProtocol.transport.loseConnection()
+        elif self.connector is not None:
+            self.connector.stopConnecting()
+
+    def connectionMade(self, protocol):
+        log.msg("Connected to carbon at %s:%d:%s" % self.destination)
+        self.resetDelay()
+        self.connects += 1
+        self.connectedProtocol = protocol
+        self.sendQueued()
+
+    def clientConnectionLost(self, connector, reason):
+        log.msg("Lost connection to carbon at %s:%d:%s: %s" % (
+            self.destination + (reason.getErrorMessage(),)))
+        self.connectedProtocol = None
+        self.stopReplay()
+        ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.connectedProtocol = None
+        ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason)
+
+    def writable(self):
+        """Whether datapoints can be written to the connection right now."""
+        return (self.connectedProtocol is not None and
+                not self.connectedProtocol.paused)
+
+    def sendDatapoints(self, datapoints):
+        """Send a list of (metric, (timestamp, value)) datapoints, queueing
+        them if they can't be written now."""
+        if self.writable() and not self.queue:
+            self.write(datapoints)
+            return
+
+        room = self.max_queue_size - self.queue_size
+        if len(datapoints) > room:
+            if self.spool is not None:
+                self.spool.append(datapoints[room:])
+            else:
+                self.drops += len(datapoints) - room
+            datapoints = datapoints[:room]
+        if datapoints:
+            self.queue.append((self.reactor.seconds(), datapoints))
+            self.queue_size += len(datapoints)
+            self.max_queue_size_seen = max(self.max_queue_size_seen,
+                                           self.queue_size)
+
+    def sendDatapoint(self, metric, datapoint):
+        self.sendDatapoints([(metric, datapoint)])
+
+    def sendQueued(self):
+        """Write queued datapoints until the queue is empty or the
+        connection is paused, then start replaying the spool."""
+        now = self.reactor.seconds()
+        while self.queue and self.writable():
+            queued_at, datapoints = self.queue.popleft()
+            self.queue_size -= len(datapoints)
+            latency = now - queued_at
+            self.latency_total += latency
+            self.latency_count += 1
+            self.latency_max = max(self.latency_max, latency)
+            self.write(datapoints)
+        if not self.queue and self.writable():
+            self.startReplay()
+
+    def startReplay(self):
+        """Start replaying the spool, if there is anything in it."""
+        if (self.spool is not None and len(self.spool) and
+            self.replaying is None):
+            self.replaying = LoopingCall(self.replay)
+            self.replaying.clock = self.reactor
+            self.replaying.start(self.replay_interval, now=False)
+
+    def stopReplay(self):
+        if self.replaying is not None:
+            self.replaying.stop()
+            self.replaying = None
+
+    def replay(self):
+        """Write a batch of spooled datapoints, unless live datapoints are
+        waiting or the connection can't take them now."""
+        if self.queue or not self.writable():
+            return
+        datapoints = self.spool.read(self.replay_batch)
+        if datapoints:
+            self.write(datapoints)
+        if not len(self.spool):
+            self.stopReplay()
+
+    def write(self, datapoints):
+        step = self.max_datapoints_per_message
+        for start in range(0, len(datapoints), step):
+            self.connectedProtocol.sendDatapoints(
+                datapoints[start:start + step])
+        self.sent += len(datapoints)
+
+    def report_stats(self):
+        """Return and reset the destination statistics."""
+        stats = {
+            "sent": self.sent,
+            "fullQueueDrops": self.drops,
+            "queued": self.queue_size,
+            "relayMaxQueueLength": self.max_queue_size_seen,
+            "connects": self.connects,
+            "queueLatency": (float(self.latency_total) / self.latency_count
+                             if self.latency_count else 0),
+            "queueLatencyMax": self.latency_max}
+        self.sent = self.drops = self.connects = 0
+        self.max_queue_size_seen = self.queue_size
+        self.latency_total = self.latency_max = self.latency_count = 0
+        if self.spool is not None:
+            stats.update(self.spool.report_stats())
+        return stats
+
+
+class CarbonSenderManager(Service):
+    """Sends datapoints to a set of carbon-caches.
+
+    This has the same interface as carbon's CarbonClientManager, with a
+    C{router} picking the destinations of each metric.
+    """
+
+    def __init__(self, router, reactor=None, spool_path=None,
+                 spool_size=1024 * 1024 * 1024, **factory_options):
+        self.router = router
+        self.reactor = reactor
+        self.spool_path = spool_path
+        self.spool_size = spool_size
+        self.factory_options = factory_options
+        self.client_factories = {}
+
+    def startService(self):
+        Service.startService(self)
+        for factory in self.client_factories.values():
+            factory.startConnecting()
+
+    def stopService(self):
+        Service.stopService(self)
+        for factory in self.client_factories.values():
+            factory.stopConnecting()
+
+    def startClient(self, destination):
+        if destination in self.client_factories:
+            return
+        self.router.addDestination(destination)
+        spool = None
+        if self.spool_path is not None:
+            spool = SegmentSpool(
+                os.path.join(self.spool_path, destination_name(destination)),
+                max_size=self.spool_size)
+        factory = CarbonSenderFactory(destination, spool=spool,
+                                      reactor=self.reactor,
+                                      **self.factory_options)
+        self.client_factories[destination] = factory
+        if self.running:
+            factory.startConnecting()
+
+    def stopClient(self, destination):
+        factory = self.client_factories.pop(destination, None)
+        if factory is not None:
+            self.router.removeDestination(destination)
+            factory.stopConnecting()
+
+    def sendDatapoint(self, metric, datapoint):
+        for destination in self.router.getDestinations(metric):
+            self.client_factories[destination].sendDatapoint(
+                metric, datapoint)
+
+    def sendDatapoints(self, datapoints):
+        """Send a list of (metric, (timestamp, value)) datapoints, with one
+        call per destination.
+
+        Every destination has a queue of its own, so one that is slow or
+        down doesn't hold back the others.
+        """
+        destinations = {}
+        for datapoint in datapoints:
+            for destination in self.router.getDestinations(datapoint[0]):
+                destinations.setdefault(destination, []).append(datapoint)
+        for destination, points in destinations.iteritems():
+            self.client_factories[destination].sendDatapoints(points)
+
+    def report_stats(self):
+        """Return and reset the statistics of every destination."""
+        stats = {}
+        for destination, factory in self.client_factories.iteritems():
+            name = destination_name(destination)
+            for stat, value in factory.report_stats().iteritems():
+                stats["destinations.%s.%s" % (name, stat)] = value
+        return stats
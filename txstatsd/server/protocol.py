@@ -19,6 +19,8 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import socket
+
 from twisted.internet.protocol import (
     DatagramProtocol, Factory)
 from twisted.protocols.basic import LineReceiver
@@ -28,7 +30,7 @@ class StatsDServerProtocol(DatagramProtocol):
     """A Twisted-based implementation of the StatsD server.
 
     Data is received via UDP for local aggregation and then sent to a Graphite
-    server via TCP.
+    server via TCP. A datagram may hold several newline separated messages.
     """
 
     def __init__(self, processor, monitor_message=None,
@@ -37,22 +39,71 @@ class StatsDServerProtocol(DatagramProtocol):
         self.monitor_message = monitor_message
         self.monitor_response = monitor_response
 
-    def datagramReceived(self, data, (host, port)):
+    def datagramReceived(self, data, address):
         """Process received data and store it locally."""
         if data == self.monitor_message:
-            # Send the expected response to the
-            # monitoring agent.
-            return self.transport.write(
-                self.monitor_response, (host, port))
+            # Send the expected response to the monitoring agent, unless
+            # it's on an unbound Unix socket that can't be answered.
+            if address:
+                self.transport.write(self.monitor_response, address)
+            return
+        if "\n" in data:
+            return self.transport.reactor.callLater(
+                0, self.process_lines, data)
         return self.transport.reactor.callLater(
             0, self.processor.process, data)
 
+    def process_lines(self, data):
+        """Process each of the newline separated messages in C{data}."""
+        for line in data.split("\n"):
+            if line:
+                self.processor.process(line)
+
+
+class StatsDUnixServerProtocol(StatsDServerProtocol):
+    """A StatsD server on a Unix datagram socket, for clients on the same
+    host.
+
+    Senders block, or fail to write, when the receive buffer is full, so
+    nothing is lost silently. Its size can be set with C{receive_buffer}.
+    """
+
+    def __init__(self, processor, monitor_message=None,
+                 monitor_response=None, receive_buffer=None):
+        StatsDServerProtocol.__init__(self, processor, monitor_message,
+                                      monitor_response)
+        self.receive_buffer = receive_buffer
+        self.datagrams = 0
+        self.bytes = 0
+
+    def startProtocol(self):
+        if self.receive_buffer:
+            self.transport.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+
+    def datagramReceived(self, data, address):
+        self.datagrams += 1
+        self.bytes += len(data)
+        StatsDServerProtocol.datagramReceived(self, data, address)
+
+    def report_stats(self):
+        """Return the receive buffer size, and reset the datagram and byte
+        counters."""
+        stats = {"unix.datagrams": self.datagrams,
+                 "unix.bytes": self.bytes}
+        if self.transport is not None:
+            stats["unix.receive_buffer"] = self.transport.socket.getsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self.datagrams = self.bytes = 0
+        return stats
+
 
 class StatsDTCPServerProtocol(LineReceiver):
     """A Twisted-based implementation of the StatsD server over TCP.
 
     Data is received via TCP for local aggregation and then sent to a Graphite
-    server via TCP.
+    server via TCP. Lines received together are processed together, on the
+    next reactor iteration.
     """
 
     def __init__(self, processor, monitor_message=None,
@@ -60,15 +111,26 @@ class StatsDTCPServerProtocol(LineReceiver):
         self.processor = processor
         self.monitor_message = monitor_message
         self.monitor_response = monitor_response
+        self.pending = []
 
     def lineReceived(self, data):
         """Process received data and store it locally."""
         if data == self.monitor_message:
             # Send the expected response to the
             # monitoring agent.
-            return self.transport.write(self.monitor_response)
-        return self.transport.reactor.callLater(
-            0, self.processor.process, data)
+            self.transport.write(self.monitor_response)
+            return
+        # Don't return the delayed call: LineReceiver takes a true value as
+        # a reason to drop the connection.
+        if not self.pending:
+            self.transport.reactor.callLater(0, self.process_lines)
+        self.pending.append(data)
+
+    def process_lines(self):
+        """Process the lines received since the last call."""
+        lines, self.pending = self.pending, []
+        for line in lines:
+            self.processor.process(line)
 
 
 class StatsDTCPServerFactory(Factory):
@@ -39,11 +39,44 @@ Conditions supported:
 
 Targets supported:
     drop: will drop the message, stopping any further processing.
-    redirect_udp host port: will send to (host, port) by udp
-    redirect_tcp host port: will send to (host, port) by tcp
+    redirect_udp host port [max_size [delay]]: will send to (host, port) by
+        udp. If max_size is given, messages are packed into newline separated
+        datagrams of up to max_size bytes, sent at most delay milliseconds
+        (50 by default) after their first message. The receiving end needs
+        to support several messages per datagram.
+    redirect_tcp host port [buffer_size [spill_path [replay_batch]]]: will
+        send to (host, port) by tcp. Up to buffer_size messages (10000 by
+        default) are buffered while disconnected or paused; if spill_path is
+        given, messages that don't fit are appended to that file. Buffered
+        messages are replayed as fast as the connection takes them, up to
+        replay_batch messages (1000 by default) per reactor iteration.
+    redirect_hash udp|tcp [ring|jump] host:port [host:port]*: will send to
+        one of the endpoints, chosen by consistent hashing of the path, by udp
+        (packed into datagrams of up to 512 bytes) or tcp. If the chosen
+        endpoint is unavailable, the next one on the hash ring is used
+        instead. With jump, endpoints are picked by jump consistent hash in
+        the order they are listed, so new ones must be added at the end.
+        Messages sent to another endpoint are reported as the failovers of
+        redirect_hash.udp_N or redirect_hash.tcp_N, N counting the
+        redirect_hash rules from 0.
     rewrite pattern repl: will rewrite the path like re.sub
     set_metric_type metric_type: will make the metric of type metric_type
-
+    sample rate: will pass only a rate fraction of the counter and meter
+        messages (0 < rate <= 1) to the message processor, stopping any
+        further processing. The sample rate of counters is adjusted, and
+        meters are scaled up, so both are scaled back. Other metric types
+        are passed on unsampled, as the processor doesn't scale them.
+
+Rules are compiled once when the router is configured: path_like
+expressions are translated to regular expressions up front, metric_type
+checks become set lookups and consecutive drop rules are merged into a
+single condition, so a message that matches none of them is tested once.
+
+Since the outcome of the rules only depends on the metric type and key, the
+routing decision for each (type, key) is kept in a bounded LRU cache and
+repeated keys skip rule evaluation; only the redirects are performed again
+for every message. Messages are passed on as received, and only serialized
+again when a rule rewrites their key.
 """
 import re
 import time
@@ -59,8 +92,13 @@ from twisted.internet.protocol import (
 from twisted.internet import defer
 from twisted.python import log
 
-from txstatsd.server.processor import BaseMessageProcessor
-from txstatsd.client import StatsDClientProtocol, TwistedStatsDClient
+from txstatsd.cache import LRUCache
+from txstatsd.hashing import (
+    ConsistentHashRing, HealthTrackedRing, JumpHashRing)
+from txstatsd.server.processor import BaseMessageProcessor, RATE
+from txstatsd.client import (
+    BatchingClient, StatsDClientProtocol, TwistedStatsDClient)
+from txstatsd.protocol import MessageBuffer
 
 
 class StopProcessingException(Exception):
@@ -68,6 +106,124 @@ class StopProcessingException(Exception):
     pass
 
 
+def compile_globs(patterns):
+    """Compile a sequence of fnmatch C{patterns} into a single regexp.
+
+    The resulting expression matches a path if any of the patterns does.
+    """
+    expressions = []
+    for pattern in patterns:
+        expression = fnmatch.translate(pattern)
+        # Python 2 appends the flags to every translated pattern, which
+        # can't be repeated inside an alternation.
+        if expression.endswith("(?ms)"):
+            expression = expression[:-5]
+        expressions.append("(?:%s)" % (expression,))
+    return re.compile("(?ms)" + "|".join(expressions))
+
+
+# How a target is applied by the rule engine.
+TRANSFORM, REDIRECT, CONSUME = 0, 1, 2
+
+
+def redirect(send):
+    """Mark C{send} as a redirect target.
+
+    Redirects pass the metric through unchanged, and C{send} is called for
+    every message, even when the routing decision comes from the cache, with
+    the metric type, key, fields and the message serialized with that key.
+    """
+    send.mode = REDIRECT
+    return send
+
+
+def consume(send):
+    """Mark C{send} as a target that consumes the metric.
+
+    Like a redirect, C{send} is called for every message, but the metric is
+    not passed on to further rules or to the message processor.
+    """
+    send.mode = CONSUME
+    return send
+
+
+def with_sample_rate(fields, rate):
+    """Returns C{fields} with their sample rate multiplied by C{rate}."""
+    if len(fields) == 3:
+        match = RATE.match(fields[2])
+        if match is not None:
+            rate *= float(match.group(1))
+    # Avoid the exponent notation, which isn't accepted as a sample rate.
+    return [fields[0], fields[1],
+            "@" + ("%.12f" % rate).rstrip("0").rstrip(".")]
+
+
+def is_mergeable(condition):
+    """Whether C{condition} can be merged with others by the rule compiler."""
+    return (getattr(condition, "always", False) or
+            hasattr(condition, "patterns") or
+            hasattr(condition, "metric_types"))
+
+
+class HashRedirect(object):
+    """Spreads messages over several destinations, by consistent hashing of
+    their key.
+
+    A message whose destination is not healthy goes to the next healthy
+    destination on the ring instead. Destinations found unhealthy are
+    marked down on a L{HealthTrackedRing}, which caches the failovers of
+    their keys, and marked up once they are found healthy again.
+    """
+
+    def __init__(self, destinations, strategy="ring", order=None):
+        """
+        @param destinations: A dict mapping a destination name to a tuple of
+            its sender and a function telling whether it is healthy.
+        @param strategy: C{ring} or C{jump}, which takes the destinations in
+            the order of C{order}.
+        @param order: The destination names in order, sorted by default.
+        """
+        self.destinations = destinations
+        if order is None:
+            order = sorted(destinations)
+        if strategy == "ring":
+            ring = ConsistentHashRing(sorted(destinations))
+        elif strategy == "jump":
+            ring = JumpHashRing(list(order))
+        else:
+            raise ValueError("unknown strategy %s" % (strategy,))
+        self.ring = HealthTrackedRing(ring)
+
+    def get_sender(self, key):
+        """Returns the sender for the metric C{key}."""
+        ring = self.ring
+        name = ring.ring.get_node(key)
+        primary, healthy = self.destinations[name]
+        if name not in ring.down:
+            if healthy():
+                return primary
+            ring.mark_down(name)
+        elif healthy():
+            ring.mark_up(name)
+            return primary
+        while True:
+            failover = ring.get_node(key)
+            if failover == name:
+                return primary
+            sender, healthy = self.destinations[failover]
+            if healthy():
+                return sender
+            # Not a failover after all: look further along the ring.
+            ring.failovers -= 1
+            ring.mark_down(failover)
+
+    def report_stats(self):
+        """Return and reset the number of messages sent to a failover."""
+        stats = {"failovers": self.ring.failovers}
+        self.ring.failovers = 0
+        return stats
+
+
 class TCPRedirectService(Service):
 
     def __init__(self, host, port, factory, reactor=None):
@@ -84,32 +240,62 @@ class TCPRedirectService(Service):
 
     def stopService(self):
         self.factory.stopTrying()
+        self.factory.buffer.close()
         if self.factory.protocol:
             self.factory.protocol.transport.loseConnection()
         return Service.stopService(self)
 
 
 class TCPRedirectClientFactory(ReconnectingClientFactory):
+    """Keeps a connection for redirecting messages over tcp.
 
-    def __init__(self, callback=None, reactor=None):
+    Messages written while disconnected or while the transport is paused
+    are kept in a L{MessageBuffer} and replayed once it can write again.
+    """
+
+    def __init__(self, callback=None, reactor=None, buffer=None):
         self.callback = callback
         self.protocol = None
         if reactor is None:
             from twisted.internet import reactor
         self.reactor = reactor
+        if buffer is None:
+            buffer = MessageBuffer(reactor=reactor)
+        self.buffer = buffer
 
     def buildProtocol(self, addr):
         self.resetDelay()
         self.protocol = TCPRedirectProtocol()
+        self.protocol.factory = self
         if self.callback:
             self.reactor.callLater(0, self.callback)
             self.callback = None
 
         return self.protocol
 
+    def clientConnectionLost(self, connector, reason):
+        self.protocol = None
+        self.buffer.stop_replay()
+        ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason)
+
+    def writable(self):
+        """Whether messages can be written to the connection right now."""
+        return self.protocol is not None and not self.protocol.paused
+
+    def replay(self):
+        """Start writing the buffered messages to the connection."""
+        if self.buffer.has_pending():
+            self.buffer.replay(self.protocol.write, self.writable)
+
     def write(self, data):
-        if self.protocol:
+        if self.writable() and not self.buffer.has_pending():
             self.protocol.write(data)
+        else:
+            self.buffer.append(data)
+
+    def report_stats(self):
+        return self.buffer.report_stats()
 
 
 class TCPRedirectProtocol(Protocol):
@@ -118,17 +304,20 @@ class TCPRedirectProtocol(Protocol):
 
     implements(interfaces.IPushProducer)
 
+    factory = None
+
     def __init__(self):
         self.paused = False
         self.last_paused = None
-        self.dropped = 0
 
     def connectionMade(self):
         """
         A connection has been made, register ourselves as a producer for the
-        bound transport.
+        bound transport, and replay anything buffered while disconnected.
         """
         self.transport.registerProducer(self, True)
+        if self.factory is not None:
+            self.factory.replay()
 
     def pauseProducing(self):
         """Pause producing messages, since the buffer is full."""
@@ -140,18 +329,17 @@ class TCPRedirectProtocol(Protocol):
     def resumeProducing(self):
         """We can write to the transport again. Yay!."""
         time_now = int(time.time())
-        log("Resumed TCP redirect. "
-            "Dropped %s messages during %s seconds ",
-                self.dropped, time_now - self.last_paused)
+        if self.last_paused is not None and self.factory is not None:
+            log.msg("Resumed TCP redirect after %s seconds, "
+                    "%s messages buffered." % (
+                        time_now - self.last_paused,
+                        len(self.factory.buffer)))
         self.paused = False
-        self.dropped = 0
         self.last_paused = None
+        if self.factory is not None:
+            self.factory.replay()
 
     def write(self, line):
-        if self.paused:
-            self.dropped += 1
-            return
-
         if line[-2:] != "\r\n":
             if line[-1] == "\r":
                 line += "\n"
@@ -162,18 +350,37 @@ class TCPRedirectProtocol(Protocol):
 
 class Router(BaseMessageProcessor):
 
-    def __init__(self, message_processor, rules_config, service=None):
+    def __init__(self, message_processor, rules_config, service=None,
+                 cache_size=100000):
         """Configure a router with rules_config.
 
         rules_config is a new_line separeted list of rules.
+
+        cache_size is the number of (metric type, key) routing decisions to
+        keep, 0 disables the cache.
         """
         self.rules_config = rules_config
         self.message_processor = message_processor
         self.flush = message_processor.flush
         self.ready = defer.succeed(None)
         self.service = service
+        self.decisions = LRUCache(cache_size)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.senders = {}
         self.rules = self.build_rules(rules_config)
 
+    def _get_rules(self):
+        return self._rules
+
+    def _set_rules(self, rules):
+        """Replace the rules, discarding the decisions made with the old ones.
+        """
+        self._rules = rules
+        self.decisions.clear()
+
+    rules = property(_get_rules, _set_rules)
+
     def build_condition(self, condition):
         condition_parts = [
             p.strip() for p in condition.split(" ") if p]
@@ -206,12 +413,68 @@ class Router(BaseMessageProcessor):
 
             rules.append((
                 condition_function,
+                target_parts[0],
                 target_factory(*target_parts[1:])))
-        return rules
+        return self.compile_rules(rules)
+
+    def compile_rules(self, rules):
+        """Turn a list of (condition, target name, target) into the
+        (condition, target, mode) rules evaluated by L{route}.
+
+        Runs of consecutive drop rules with mergeable conditions are
+        collapsed into a single rule, and conditions that always match are
+        replaced by C{None} so they are not evaluated at all.
+        """
+        compiled = []
+        run = []
+        for condition, target_name, target in rules:
+            if target_name == "drop" and is_mergeable(condition):
+                run.append(condition)
+                continue
+            if run:
+                compiled.append((self.merge_conditions(run),
+                                 self.build_target_drop(), TRANSFORM))
+                run = []
+            if getattr(condition, "always", False):
+                condition = None
+            compiled.append((condition, target,
+                             getattr(target, "mode", TRANSFORM)))
+        if run:
+            compiled.append((self.merge_conditions(run),
+                             self.build_target_drop(), TRANSFORM))
+        return compiled
+
+    def merge_conditions(self, conditions):
+        """Returns a condition that matches if any of C{conditions} does.
+
+        Returns C{None} if any of them always matches.
+        """
+        patterns = []
+        metric_types = set()
+        for condition in conditions:
+            if getattr(condition, "always", False):
+                return None
+            patterns.extend(getattr(condition, "patterns", ()))
+            metric_types.update(getattr(condition, "metric_types", ()))
+
+        metric_types = frozenset(metric_types)
+        if not patterns:
+            return self.build_condition_metric_type(*metric_types)
+
+        match = compile_globs(patterns).match
+
+        def merged_condition(metric_type, key, fields):
+            return (metric_type in metric_types or
+                    match(key) is not None)
+        merged_condition.patterns = tuple(patterns)
+        merged_condition.metric_types = metric_types
+        return merged_condition
 
     def build_condition_any(self):
         """Returns a condition that always matches."""
-        return lambda *args: True
+        any_condition = lambda *args: True
+        any_condition.always = True
+        return any_condition
 
     def build_condition_not(self, *args):
         """
@@ -225,13 +488,20 @@ class Router(BaseMessageProcessor):
 
     def build_condition_metric_type(self, *metric_types):
         """Returns a condition that matched on metric kind."""
+        metric_types = frozenset(metric_types)
+
         def metric_type_condition(metric_type, key, fields):
             return (metric_type in metric_types)
+        metric_type_condition.metric_types = metric_types
         return metric_type_condition
 
     def build_condition_path_like(self, pattern):
+        """Returns a condition that matches the path with fnmatch."""
+        match = compile_globs([pattern]).match
+
         def path_like_condition(metric_type, key, fields):
-            return fnmatch.fnmatch(key, pattern)
+            return match(key) is not None
+        path_like_condition.patterns = (pattern,)
         return path_like_condition
 
     def build_target_drop(self):
@@ -242,26 +512,35 @@ class Router(BaseMessageProcessor):
 
     def build_target_rewrite(self, pattern, repl, dup="no-dup"):
         rexp = re.compile(pattern)
+        sub = rexp.sub
 
-        def rewrite_target(metric_type, key, fields):
-            if dup == "dup" and rexp.match(key) is not None:
-                yield metric_type, key, fields
-            key = rexp.sub(repl, key)
-            yield metric_type, key, fields
+        if dup == "dup":
+            match = rexp.match
+
+            def rewrite_dup_target(metric_type, key, fields):
+                if match(key) is not None:
+                    return [(metric_type, key, fields),
+                            (metric_type, sub(repl, key), fields)]
+                return [(metric_type, sub(repl, key), fields)]
+            return rewrite_dup_target
 
+        def rewrite_target(metric_type, key, fields):
+            return [(metric_type, sub(repl, key), fields)]
         return rewrite_target
 
     def build_target_set_metric_type(self, metric_type, dup="no-dup"):
+        if dup == "dup":
+            def set_metric_type_dup(_, key, fields):
+                return [(_, key, fields), (metric_type, key, fields)]
+            return set_metric_type_dup
+
         def set_metric_type(_, key, fields):
-            if dup == "dup":
-                yield _, key, fields
-            yield metric_type, key, fields
+            return [(metric_type, key, fields)]
         return set_metric_type
 
-    def build_target_redirect_udp(self, host, port):
-        if self.service is None:
-            return lambda *args: True
-
+    def build_udp_sender(self, host, port, max_size=0, delay=50):
+        """Returns a client sending to (host, port) by udp, and a function
+        telling whether it can send."""
         port = int(port)
         d = defer.Deferred()
         self.ready.addCallback(lambda _: d)
@@ -273,46 +552,230 @@ class Router(BaseMessageProcessor):
         udp_service = UDPServer(0, protocol)
         udp_service.setServiceParent(self.service)
 
-        def redirect_udp_target(metric_type, key, fields):
-            message = self.rebuild_message(metric_type, key, fields)
-            client.write(message)
-            yield metric_type, key, fields
-        return redirect_udp_target
-
-    def build_target_redirect_tcp(self, host, port):
-        if self.service is None:
-            return lambda *args: True
-
+        def healthy():
+            return (client.transport is not None and
+                    client.transport_gateway is not None)
+
+        if int(max_size):
+            batching = BatchingClient(client, int(max_size),
+                                      int(delay) / 1000.0)
+            self.senders["redirect_udp.%s_%s" % (
+                host.replace(".", "_"), port)] = batching
+            return batching, healthy
+        return client, healthy
+
+    def build_tcp_sender(self, host, port, buffer_size=10000,
+                         spill_path=None, replay_batch=1000):
+        """Returns a factory sending to (host, port) by tcp, and a function
+        telling whether it is connected."""
         port = int(port)
         d = defer.Deferred()
         self.ready.addCallback(lambda _: d)
-        factory = TCPRedirectClientFactory(lambda: d.callback(None))
+        buffer = MessageBuffer(limit=int(buffer_size), spill_path=spill_path,
+                               replay_batch=int(replay_batch))
+        factory = TCPRedirectClientFactory(lambda: d.callback(None),
+                                           buffer=buffer)
+        self.senders["redirect_tcp.%s_%s" % (
+            host.replace(".", "_"), port)] = factory
 
         redirect_service = TCPRedirectService(host, port, factory)
         redirect_service.setServiceParent(self.service)
+        return factory, lambda: factory.protocol is not None
 
-        def redirect_tcp_target(metric_type, key, fields):
-            message = self.rebuild_message(metric_type, key, fields)
+    def build_target_redirect_udp(self, host, port, max_size=0, delay=50):
+        if self.service is None:
+            return redirect(lambda *args: None)
+
+        client, _ = self.build_udp_sender(host, port, max_size, delay)
+
+        @redirect
+        def redirect_udp_target(metric_type, key, fields, message):
+            client.write(message)
+        return redirect_udp_target
+
+    def build_target_redirect_tcp(self, host, port, buffer_size=10000,
+                                  spill_path=None, replay_batch=1000):
+        if self.service is None:
+            return redirect(lambda *args: None)
+
+        factory, _ = self.build_tcp_sender(host, port, buffer_size,
+                                           spill_path, replay_batch)
+
+        @redirect
+        def redirect_tcp_target(metric_type, key, fields, message):
             factory.write(message)
-            yield metric_type, key, fields
         return redirect_tcp_target
 
-    def process_message(self, message, metric_type, key, fields):
+    def build_target_redirect_hash(self, protocol, *endpoints):
+        if self.service is None:
+            return redirect(lambda *args: None)
+
+        if protocol == "udp":
+            build_sender = lambda host, port: self.build_udp_sender(
+                host, port, max_size=512)
+        elif protocol == "tcp":
+            build_sender = self.build_tcp_sender
+        else:
+            raise ValueError("unknown protocol %s" % (protocol,))
+
+        strategy = "ring"
+        if endpoints and endpoints[0] in ("ring", "jump"):
+            strategy, endpoints = endpoints[0], endpoints[1:]
+
+        destinations = {}
+        for endpoint in endpoints:
+            host, port = endpoint.rsplit(":", 1)
+            destinations[endpoint] = build_sender(host, port)
+        hash_redirect = HashRedirect(destinations, strategy, endpoints)
+        index = len([name for name in self.senders
+                     if name.startswith("redirect_hash.")])
+        self.senders["redirect_hash.%s_%d" % (protocol, index)] = hash_redirect
+
+        @redirect
+        def redirect_hash_target(metric_type, key, fields, message):
+            hash_redirect.get_sender(key).write(message)
+        return redirect_hash_target
+
+    def build_target_sample(self, rate):
+        """Returns a target that passes a C{rate} fraction of the matching
+        counters and meters to the message processor, with the sample rate
+        of counters adjusted and meters scaled up. Messages of other types
+        are passed on unsampled.
+
+        Messages are picked by keeping a credit per bucket of keys, so hot
+        keys are sampled evenly without calling random() for each message.
+        """
+        rate = float(rate)
+        if not 0 < rate <= 1:
+            raise ValueError("sample rate must be in (0, 1]: %s" % (rate,))
+        credits = [0.0] * 1024
+
+        @consume
+        def sample_target(metric_type, key, fields, message):
+            if metric_type != "c" and metric_type != "m":
+                self.message_processor.process_message(message, metric_type,
+                                                       key, fields)
+                return
+            bucket = hash(key) & 1023
+            credit = credits[bucket] + rate
+            # Allow for rounding errors adding up the rate.
+            if credit < 1 - 1e-9:
+                credits[bucket] = credit
+                return
+            credits[bucket] = credit - 1
+
+            if metric_type == "c":
+                fields = with_sample_rate(fields, rate)
+            else:
+                # The processor ignores the sample rate of meters.
+                try:
+                    value = float(fields[0]) / rate
+                except ValueError:
+                    value = fields[0]
+                fields = ["%s" % (value,)] + fields[1:]
+            message = self.rebuild_message(metric_type, key, fields)
+            self.message_processor.process_message(message, metric_type,
+                                                   key, fields)
+        return sample_target
+
+    def route(self, metric_type, key, fields):
+        """Apply the rules to a metric.
+
+        Returns the redirects and consuming targets to call for every
+        message, as a list of (target, metric), and the resulting metrics.
+        """
         metrics = [(metric_type, key, fields)]
-        if self.rules:
-            for condition, target in self.rules:
-                pending, metrics = metrics, []
-                if not pending:
-                    return
-                for metric_type, key, fields in pending:
-                    if not condition(metric_type, key, fields):
-                        metrics.append((metric_type, key, fields))
-                        continue
-                    result = target(metric_type, key, fields)
-                    if result is not None:
+        redirects = []
+        for condition, target, mode in self.rules:
+            pending, metrics = metrics, []
+            for metric in pending:
+                if condition is not None and not condition(*metric):
+                    metrics.append(metric)
+                elif mode:
+                    redirects.append((target, metric))
+                    if mode == REDIRECT:
+                        metrics.append(metric)
+                else:
+                    result = target(*metric)
+                    if result:
                         metrics.extend(result)
+            if not metrics:
+                break
+        return redirects, metrics
+
+    def decide(self, metric_type, key, fields):
+        """Return the routing decision for a metric type and key.
+
+        The decision is a tuple of the redirects, as (redirect, type, key,
+        same key), and the resulting metrics, as (type, key, same key), where
+        same key tells whether the message can be passed on unchanged.
+        """
+        cache_key = (metric_type, key)
+        decision = self.decisions.get(cache_key)
+        if decision is not None:
+            self.cache_hits += 1
+            return decision
+
+        self.cache_misses += 1
+        redirects, metrics = self.route(metric_type, key, fields)
+        decision = (
+            tuple((target, metric[0], metric[1], metric[1] == key)
+                  for target, metric in redirects),
+            tuple((metric[0], metric[1], metric[1] == key)
+                  for metric in metrics))
+        self.decisions[cache_key] = decision
+        return decision
 
-        for (metric_type, key, fields) in metrics:
+    def process_message(self, message, metric_type, key, fields):
+        # The message is passed on as received, unless its key was
+        # normalized, it has surrounding whitespace or a rule rewrites the
+        # key. The metric type is part of the fields, so changing it alone
+        # doesn't change the message.
+        if message[-1:].isspace() or not message.startswith(key + ":"):
             message = self.rebuild_message(metric_type, key, fields)
-            self.message_processor.process_message(message, metric_type,
-                                                   key, fields)
+
+        if not self.rules:
+            return self.message_processor.process_message(
+                message, metric_type, key, fields)
+
+        redirects, metrics = self.decide(metric_type, key, fields)
+        rebuilt = None
+        for target, metric_type, new_key, same_key in redirects:
+            if same_key:
+                target(metric_type, new_key, fields, message)
+                continue
+            if rebuilt is None:
+                rebuilt = {}
+            new_message = rebuilt.get(new_key)
+            if new_message is None:
+                new_message = rebuilt[new_key] = self.rebuild_message(
+                    metric_type, new_key, fields)
+            target(metric_type, new_key, fields, new_message)
+
+        for metric_type, new_key, same_key in metrics:
+            if same_key:
+                new_message = message
+            elif rebuilt is not None and new_key in rebuilt:
+                new_message = rebuilt[new_key]
+            else:
+                new_message = self.rebuild_message(metric_type, new_key,
+                                                   fields)
+            self.message_processor.process_message(
+                new_message, metric_type, new_key, fields)
+
+    def report_stats(self):
+        """Return and reset the routing decision cache and redirect
+        statistics."""
+        lookups = self.cache_hits + self.cache_misses
+        stats = {
+            "router.cache.hits": self.cache_hits,
+            "router.cache.misses": self.cache_misses,
+            "router.cache.size": len(self.decisions),
+            "router.cache.hit_rate": (
+                float(self.cache_hits) / lookups if lookups else 0)}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        for name, sender in self.senders.items():
+            for stat, value in sender.report_stats().items():
+                stats["router.%s.%s" % (name, stat)] = value
+        return stats
@@ -0,0 +1,172 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""An on-disk spool of datapoints, made of append-only segment files."""
+
+import mmap
+import os
+
+
+class SegmentSpool(object):
+    """Keeps datapoints on disk while a destination can't take them.
+
+    Datapoints are appended as plaintext protocol lines to segment files of
+    about C{segment_size} bytes in the C{path} directory. When the spool
+    grows over C{max_size} bytes the oldest segments are evicted. Datapoints
+    are read back oldest first, memory-mapping one segment at a time, and
+    each segment is deleted once fully read. Segments left over by a previous
+    run are read back too; since the read offset isn't saved, a segment that
+    was partially read may be sent twice, which carbon takes as overwrites.
+    A line left incomplete at the end of a segment is dropped.
+    """
+
+    def __init__(self, path, segment_size=16 * 1024 * 1024,
+                 max_size=1024 * 1024 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.segments = []
+        self.size = 0
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".spool"):
+                self.segments.append(name)
+                self.size += os.path.getsize(os.path.join(path, name))
+        self.sequence = (int(self.segments[-1].split(".")[0]) + 1
+                         if self.segments else 0)
+
+        self.writer = None
+        self.writer_size = 0
+        self.reader = None
+        self.reader_offset = 0
+
+        self.spooled = 0
+        self.replayed = 0
+        self.evicted = 0
+
+    def __len__(self):
+        """The number of bytes in the spool that haven't been read yet."""
+        return self.size - self.reader_offset
+
+    def append(self, datapoints):
+        """Append a list of (metric, (timestamp, value)) datapoints."""
+        if self.writer is None or self.writer_size >= self.segment_size:
+            self.roll()
+        data = "".join(["%s %s %s\n" % (metric, value, timestamp)
+                        for metric, (timestamp, value) in datapoints])
+        self.writer.write(data)
+        self.writer_size += len(data)
+        self.size += len(data)
+        self.spooled += len(datapoints)
+        while self.size > self.max_size and len(self.segments) > 1:
+            self.evict()
+
+    def roll(self):
+        """Close the segment being written and start a new one."""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        name = "%020d.spool" % (self.sequence,)
+        self.sequence += 1
+        self.writer = open(os.path.join(self.path, name), "ab")
+        self.writer_size = 0
+        self.segments.append(name)
+
+    def evict(self):
+        """Delete the oldest segment."""
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        name = self.segments.pop(0)
+        filename = os.path.join(self.path, name)
+        size = os.path.getsize(filename)
+        os.remove(filename)
+        self.size -= size
+        self.reader_offset = 0
+        self.evicted += size
+
+    def read(self, count):
+        """Read and remove up to C{count} of the oldest datapoints."""
+        datapoints = []
+        while len(datapoints) < count and len(self):
+            if self.reader is None and not self.open_reader():
+                break
+            end = self.reader_offset
+            while len(datapoints) < count:
+                start, end = end, self.reader.find("\n", end) + 1
+                if not end:
+                    # Past the last line, dropping the end of a line left
+                    # incomplete by a crash while it was written.
+                    end = self.reader.size()
+                    break
+                metric, value, timestamp = self.reader[start:end].split()
+                datapoints.append((metric, (float(timestamp), float(value))))
+            if end < self.reader.size():
+                self.reader_offset = end
+            else:
+                self.finish_segment()
+        self.replayed += len(datapoints)
+        return datapoints
+
+    def open_reader(self):
+        """Map the oldest segment, rolling over the one being written."""
+        if self.writer is not None and len(self.segments) == 1:
+            self.writer.close()
+            self.writer = None
+        filename = os.path.join(self.path, self.segments[0])
+        if not os.path.getsize(filename):
+            self.finish_segment()
+            return False
+        with open(filename, "rb") as segment:
+            self.reader = mmap.mmap(segment.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        self.reader_offset = 0
+        return True
+
+    def finish_segment(self):
+        """Delete the oldest segment, once all of it was read."""
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        name = self.segments.pop(0)
+        filename = os.path.join(self.path, name)
+        self.size -= os.path.getsize(filename)
+        os.remove(filename)
+        self.reader_offset = 0
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def report_stats(self):
+        """Return and reset the spool statistics."""
+        stats = {
+            "spool.size": len(self),
+            "spool.spooled": self.spooled,
+            "spool.replayed": self.replayed,
+            "spool.evicted_bytes": self.evicted}
+        self.spooled = self.replayed = self.evicted = 0
+        return stats
@@ -20,13 +20,17 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import getopt
+import os
+import stat
 import sys
 import time
 import ConfigParser
 import platform
 import functools
+from itertools import islice
 
-from twisted.application.internet import UDPServer, TCPServer
+from twisted.application.internet import (
+    UDPServer, TCPServer, UNIXDatagramServer)
 from twisted.application.service import MultiService
 from twisted.python import usage, log
 from twisted.plugin import getPlugins
@@ -38,8 +42,9 @@ from txstatsd.server.processor import MessageProcessor
 from txstatsd.server.configurableprocessor import ConfigurableMessageProcessor
 from txstatsd.server.loggingprocessor import LoggingMessageProcessor
 from txstatsd.server.protocol import (
-    StatsDServerProtocol, StatsDTCPServerFactory)
+    StatsDServerProtocol, StatsDTCPServerFactory, StatsDUnixServerProtocol)
 from txstatsd.server.router import Router
+from txstatsd.server.carbonsender import CarbonSenderManager, build_router
 from txstatsd.server import httpinfo
 from txstatsd.report import ReportingService, ReactorInspectorService
 from txstatsd.itxstatsd import IMetricFactory
@@ -177,12 +182,42 @@ class StatsDOptions(OptionsGlue):
          " before passing them to carbon.", int],
         ["routing", "g", "",
          "Routing rules", str],
+        ["routing-cache-size", "G", 100000,
+         "Number of routing decisions to cache, 0 to disable.", int],
         ["listen-tcp-port", "t", None,
          "The TCP port where we will listen.", int],
+        ["listen-unix-path", None, None,
+         "The Unix datagram socket path where we will listen.", str],
+        ["listen-unix-mode", None, 0o666,
+         "The permissions of the Unix datagram socket, in octal.",
+         functools.partial(int, base=8)],
+        ["listen-unix-buffer", None, None,
+         "The receive buffer size of the Unix datagram socket, in bytes.",
+         int],
         ["max-queue-size", "Q", 20000,
          "Maximum send queue size per destination.", int],
         ["max-datapoints-per-message", "M", 1000,
          "Maximum datapoints per message to carbon-cache.", int],
+        ["carbon-router", None, "consistent-hashing",
+         "How metrics are spread over carbon-caches"
+         " {consistent-hashing|jump|relay|replicate}.", str],
+        ["carbon-relay-rules", None, None,
+         "Rules for the relay carbon router, as 'prefix host:port[:instance]"
+         " ...' separated by semicolons, with a '*' default prefix.", str],
+        ["carbon-client", None, "carbon",
+         "Client sending datapoints to carbon-cache {carbon|native}.", str],
+        ["carbon-protocol", None, "pickle",
+         "Protocol used by the native carbon client {pickle|line}.", str],
+        ["carbon-high-water", None, 1024 * 1024,
+         "Write buffer size, in bytes, over which the native carbon client"
+         " queues datapoints.", int],
+        ["carbon-spool-path", None, None,
+         "Directory where the native carbon client spools datapoints that"
+         " don't fit in its queue.", str],
+        ["carbon-spool-size", None, 1024 * 1024 * 1024,
+         "Maximum size of the spool of each destination, in bytes.", int],
+        ["carbon-spool-replay-rate", None, 10000,
+         "Datapoints per second replayed from the spool.", int],
         ["http-port", "P", None,
          "The httpinfo port.", int],
         ]
@@ -206,31 +241,70 @@ class StatsDOptions(OptionsGlue):
 
 class StatsDService(Service):
 
-    def __init__(self, carbon_client, processor, flush_interval, clock=None):
+    def __init__(self, carbon_client, processor, flush_interval, clock=None,
+                 max_datapoints=1000):
         self.carbon_client = carbon_client
         self.processor = processor
         self.flush_interval = flush_interval
+        self.max_datapoints = max_datapoints
         self.flush_task = task.LoopingCall(self.flushProcessor)
         self.coop = task.Cooperator()
         if clock is not None:
             self.flush_task.clock = clock
+        self.flushed = 0
+        self.flush_duration = 0
 
     def flushProcessor(self):
-        """Flush messages queued in the processor to Graphite."""
+        """Flush messages queued in the processor to Graphite.
+
+        Datapoints are handed to the carbon client in chunks of
+        C{max_datapoints}, through its C{sendDatapoints} method when it has
+        one.
+        """
         start = time.time()
         interval = self.flush_interval
-        flush = self.processor.flush
+        max_datapoints = self.max_datapoints
+        datapoints = ((metric, (timestamp, value))
+                      for metric, value, timestamp
+                      in self.processor.flush(interval=interval))
+        send_datapoints = getattr(self.carbon_client, "sendDatapoints", None)
+        if send_datapoints is None:
+            send_datapoint = self.carbon_client.sendDatapoint
+
+            def send_datapoints(chunk):
+                for metric, datapoint in chunk:
+                    send_datapoint(metric, datapoint)
 
         def doWork():
             flushed = 0
-            for metric, value, timestamp in flush(interval=interval):
-                yield self.carbon_client.sendDatapoint(
-                    metric, (timestamp, value))
-                flushed += 1
-            log.msg("Flushed total %d metrics in %.6f" %
-                    (flushed, time.time() - start))
-
-        self.coop.coiterate(doWork())
+            while True:
+                chunk = list(islice(datapoints, max_datapoints))
+                if not chunk:
+                    break
+                yield send_datapoints(chunk)
+                flushed += len(chunk)
+            duration = time.time() - start
+            self.flushed += flushed
+            self.flush_duration += duration
+            log.msg("Flushed total %d metrics in %.6f (%d datapoints/s)" %
+                    (flushed, duration, flushed / duration if duration else 0))
+
+        # A failed flush is logged, so that it doesn't stop the flush task.
+        d = self.coop.coiterate(doWork())
+        d.addErrback(log.err, "Error while flushing metrics")
+        return d
+
+    def report_stats(self):
+        """Return and reset the flush throughput statistics."""
+        stats = {
+            "flush.datapoints": self.flushed,
+            "flush.duration": self.flush_duration,
+            "flush.datapoints_per_second": (
+                self.flushed / self.flush_duration
+                if self.flush_duration else 0)}
+        self.flushed = 0
+        self.flush_duration = 0
+        return stats
 
     def startService(self):
         self.flush_task.start(self.flush_interval / 1000, False)
@@ -254,13 +328,6 @@ def report_client_manager_stats():
 
 def createService(options, reactor=None):
     """Create a txStatsD service."""
-    from carbon.routers import ConsistentHashingRouter
-    from carbon.client import CarbonClientManager
-    from carbon.conf import settings
-
-    settings.MAX_QUEUE_SIZE = options["max-queue-size"]
-    settings.MAX_DATAPOINTS_PER_MESSAGE = options["max-datapoints-per-message"]
-
     root_service = MultiService()
     root_service.setName("statsd")
 
@@ -288,7 +355,8 @@ def createService(options, reactor=None):
 
     if options["statsd-compliance"]:
         processor = (processor or MessageProcessor)(plugins=plugin_metrics)
-        input_router = Router(processor, options['routing'], root_service)
+        input_router = Router(processor, options['routing'], root_service,
+                              cache_size=options['routing-cache-size'])
         connection = InternalClient(input_router)
         metrics = Metrics(connection)
     else:
@@ -296,7 +364,8 @@ def createService(options, reactor=None):
             message_prefix=prefix,
             internal_metrics_prefix=prefix + "." + instance_name + ".",
             plugins=plugin_metrics)
-        input_router = Router(processor, options['routing'], root_service)
+        input_router = Router(processor, options['routing'], root_service,
+                              cache_size=options['routing-cache-size'])
         connection = InternalClient(input_router)
         metrics = ExtendedMetrics(connection)
 
@@ -310,9 +379,10 @@ def createService(options, reactor=None):
     reporting = ReportingService(instance_name)
     reporting.setServiceParent(root_service)
 
-    reporting.schedule(report_client_manager_stats,
-                       options["flush-interval"] / 1000,
-                       metrics.gauge)
+    if input_router.rules:
+        reporting.schedule(input_router.report_stats,
+                           options["flush-interval"] / 1000,
+                           metrics.gauge)
 
     if options["report"] is not None:
         from txstatsd import process
@@ -332,9 +402,33 @@ def createService(options, reactor=None):
                                     report_name.upper(), ()):
                 reporting.schedule(reporter, 60, metrics.gauge)
 
-    # XXX Make this configurable.
-    router = ConsistentHashingRouter()
-    carbon_client = CarbonClientManager(router)
+    router = build_router(options["carbon-router"],
+                          options["carbon-relay-rules"])
+    if options["carbon-client"] == "native":
+        carbon_client = CarbonSenderManager(
+            router, reactor=reactor,
+            protocol=options["carbon-protocol"],
+            max_queue_size=options["max-queue-size"],
+            max_datapoints_per_message=options["max-datapoints-per-message"],
+            high_water=options["carbon-high-water"],
+            spool_path=options["carbon-spool-path"],
+            spool_size=options["carbon-spool-size"],
+            replay_rate=options["carbon-spool-replay-rate"])
+        reporting.schedule(carbon_client.report_stats,
+                           options["flush-interval"] / 1000,
+                           metrics.gauge)
+    else:
+        from carbon.conf import settings
+        from txstatsd.server.carbonclient import BulkCarbonClientManager
+
+        settings.MAX_QUEUE_SIZE = options["max-queue-size"]
+        settings.MAX_DATAPOINTS_PER_MESSAGE = options[
+            "max-datapoints-per-message"]
+
+        carbon_client = BulkCarbonClientManager(router)
+        reporting.schedule(report_client_manager_stats,
+                           options["flush-interval"] / 1000,
+                           metrics.gauge)
     carbon_client.setServiceParent(root_service)
 
     for host, port, name in zip(options["carbon-cache-host"],
@@ -342,10 +436,15 @@ def createService(options, reactor=None):
                                 options["carbon-cache-name"]):
         carbon_client.startClient((host, port, name))
 
-    statsd_service = StatsDService(carbon_client, input_router,
-                                   options["flush-interval"])
+    statsd_service = StatsDService(
+        carbon_client, input_router, options["flush-interval"],
+        max_datapoints=options["max-datapoints-per-message"])
     statsd_service.setServiceParent(root_service)
 
+    reporting.schedule(statsd_service.report_stats,
+                       options["flush-interval"] / 1000,
+                       metrics.gauge)
+
     statsd_server_protocol = StatsDServerProtocol(
         input_router,
         monitor_message=options["monitor-message"],
@@ -364,6 +463,26 @@ def createService(options, reactor=None):
                              statsd_tcp_server_factory)
         listener.setServiceParent(root_service)
 
+    if options["listen-unix-path"] is not None:
+        path = options["listen-unix-path"]
+        # Remove the socket left behind by a previous run.
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+
+        statsd_unix_server_protocol = StatsDUnixServerProtocol(
+            input_router,
+            monitor_message=options["monitor-message"],
+            monitor_response=options["monitor-response"],
+            receive_buffer=options["listen-unix-buffer"])
+        reporting.schedule(statsd_unix_server_protocol.report_stats,
+                           options["flush-interval"] / 1000,
+                           metrics.gauge)
+
+        listener = UNIXDatagramServer(path, statsd_unix_server_protocol,
+                                      maxPacketSize=65536,
+                                      mode=options["listen-unix-mode"])
+        listener.setServiceParent(root_service)
+
     httpinfo_service = httpinfo.makeService(options, processor, statsd_service)
     httpinfo_service.setServiceParent(root_service)
 
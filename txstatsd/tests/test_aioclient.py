@@ -0,0 +1,127 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Tests for the asyncio client."""
+
+import socket
+
+from twisted.trial.unittest import TestCase
+
+from txstatsd.metrics.extendedmetrics import ExtendedMetrics
+from txstatsd.metrics.metrics import Metrics
+
+try:
+    from txstatsd.aioclient import (
+        AsyncioStatsDClient, StatsDDatagramProtocol, asyncio)
+except ImportError:
+    asyncio = None
+
+
+class AsyncioStatsDClientTest(TestCase):
+
+    if asyncio is None:
+        skip = "asyncio and trollius are not available"
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.settimeout(5)
+        self.addCleanup(self.server.close)
+        self.client = AsyncioStatsDClient(
+            "localhost", self.server.getsockname()[1], loop=self.loop,
+            max_size=20, buffer_size=5)
+        self.addCleanup(self.client.disconnect)
+
+    def run_loop(self, until=lambda: True):
+        """Run the loop until C{until()} after an iteration."""
+        for i in range(500):
+            self.loop.run_until_complete(asyncio.sleep(0.001))
+            if until():
+                return
+        self.fail("timed out")
+
+    def connect(self):
+        self.client.connect()
+        self.run_loop(lambda: self.client.transport is not None)
+
+    def test_batches_per_iteration(self):
+        """Metrics written during an iteration are packed into datagrams
+        sent on the next one."""
+        self.connect()
+        for i in range(3):
+            self.client.write(b"foo:%d|c" % i)
+        self.assertEqual(self.client.packets, 0)
+        self.run_loop()
+        self.assertEqual(self.server.recv(1024), b"foo:0|c\nfoo:1|c")
+        self.assertEqual(self.server.recv(1024), b"foo:2|c")
+        self.assertEqual(self.client.report_stats(),
+                         {"messages": 3, "packets": 2, "drops": 0,
+                          "errors": 0, "resolve_failures": 0})
+
+    def test_buffers_until_connected(self):
+        """Metrics written before the endpoint is ready are sent once it
+        is, and those that don't fit in the buffer are dropped."""
+        for i in range(7):
+            self.client.write(b"foo:%d|c" % i)
+        self.connect()
+        self.run_loop(lambda: not self.client.buffer)
+        self.assertEqual(self.server.recv(1024), b"foo:0|c\nfoo:1|c")
+        self.assertEqual(self.server.recv(1024), b"foo:2|c\nfoo:3|c")
+        self.assertEqual(self.server.recv(1024), b"foo:4|c")
+        self.assertEqual(self.client.report_stats()["drops"], 2)
+
+    def test_holds_metrics_while_paused(self):
+        """Nothing is sent while the transport is paused."""
+        self.connect()
+        protocol = StatsDDatagramProtocol(self.client)
+        protocol.pause_writing()
+        self.client.write(b"foo:1|c")
+        self.run_loop()
+        self.assertEqual(len(self.client.buffer), 1)
+        protocol.resume_writing()
+        self.run_loop(lambda: not self.client.buffer)
+        self.assertEqual(self.server.recv(1024), b"foo:1|c")
+
+    def test_resolve_failure(self):
+        """A host that cannot be resolved is counted."""
+        failed = asyncio.Future(loop=self.loop)
+        failed.set_exception(socket.gaierror("lookup failed"))
+        self.loop.getaddrinfo = lambda *args, **kwargs: failed
+        self.client.connect()
+        self.run_loop(lambda: self.client.resolve_failures)
+        self.assertTrue(self.client.transport is None)
+        self.assertEqual(self.client.report_stats()["resolve_failures"], 1)
+
+    def test_metrics(self):
+        """The client is a connection for L{Metrics} and
+        L{ExtendedMetrics}."""
+        self.connect()
+        Metrics(self.client, "txstatsd").increment("foo")
+        extended = ExtendedMetrics(self.client, "txstatsd")
+        extended.increment("bar", 2)
+        extended.increment("bar", 3)
+        self.run_loop(lambda: self.client.packets == 3)
+        self.assertEqual(
+            [self.server.recv(1024) for i in range(3)],
+            [b"txstatsd.foo:1|c", b"txstatsd.bar:2|c", b"txstatsd.bar:5|c"])
@@ -0,0 +1,75 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Tests for the LRU cache."""
+
+from twisted.trial.unittest import TestCase
+
+from txstatsd.cache import LRUCache
+
+
+class LRUCacheTest(TestCase):
+
+    def test_get(self):
+        """Stored values can be retrieved."""
+        cache = LRUCache(2)
+        cache["a"] = 1
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("b", 2), 2)
+        self.assertTrue("a" in cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_discards_least_recently_used(self):
+        """When full, the least recently used entry is discarded."""
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache.get("a")
+        cache["c"] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertFalse("b" in cache)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_replace(self):
+        """Setting an existing key replaces its value and marks it used."""
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache["a"] = 3
+        cache["c"] = 4
+        self.assertEqual(cache.get("a"), 3)
+        self.assertFalse("b" in cache)
+
+    def test_clear(self):
+        """All entries can be discarded."""
+        cache = LRUCache(2)
+        cache["a"] = 1
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        cache["b"] = 2
+        self.assertEqual(cache.get("b"), 2)
+
+    def test_disabled(self):
+        """A cache of size 0 stores nothing."""
+        cache = LRUCache(0)
+        cache["a"] = 1
+        self.assertEqual(len(cache), 0)
@@ -0,0 +1,83 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Tests for the bulk carbon client."""
+
+from twisted.trial.unittest import TestCase
+
+from carbon.instrumentation import stats
+from carbon.routers import ConsistentHashingRouter
+
+from txstatsd.server.carbonclient import BulkCarbonClientManager
+
+
+class FakeProtocol(object):
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.paused = False
+        self.sent = []
+
+    def sendDatapoint(self, metric, datapoint):
+        self.factory.enqueue(metric, datapoint)
+
+    def _sendDatapoints(self, datapoints):
+        self.sent.append(datapoints)
+
+
+class BulkCarbonClientManagerTest(TestCase):
+
+    def setUp(self):
+        saved_stats = stats.copy()
+        self.addCleanup(stats.update, saved_stats)
+        self.addCleanup(stats.clear)
+        self.manager = BulkCarbonClientManager(ConsistentHashingRouter())
+        self.destinations = [("127.0.0.1", 2004, "a"),
+                             ("127.0.0.1", 2005, "b")]
+        for destination in self.destinations:
+            self.manager.startClient(destination)
+        self.datapoints = [("foo%d" % i, (1, i)) for i in range(20)]
+
+    def test_connected_destinations_get_one_message(self):
+        """
+        The datapoints for a connected destination are sent in one message.
+        """
+        protocols = []
+        for factory in self.manager.client_factories.values():
+            factory.connectedProtocol = FakeProtocol(factory)
+            protocols.append(factory.connectedProtocol)
+        self.manager.sendDatapoints(self.datapoints)
+        self.assertEqual([len(protocol.sent) for protocol in protocols],
+                         [1, 1])
+        self.assertEqual(
+            sorted(protocols[0].sent[0] + protocols[1].sent[0]),
+            sorted(self.datapoints))
+
+    def test_disconnected_destinations_queue(self):
+        """
+        Datapoints for a disconnected or paused destination are queued.
+        """
+        factory_a = self.manager.client_factories[self.destinations[0]]
+        factory_b = self.manager.client_factories[self.destinations[1]]
+        factory_b.connectedProtocol = FakeProtocol(factory_b)
+        factory_b.connectedProtocol.paused = True
+        self.manager.sendDatapoints(self.datapoints)
+        self.assertEqual(sorted(factory_a.queue + factory_b.queue),
+                         sorted(self.datapoints))
@@ -0,0 +1,349 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Tests for the native carbon sender and its spool."""
+
+import cPickle
+import os
+import struct
+
+from twisted.test.proto_helpers import MemoryReactorClock, StringTransport
+from twisted.trial.unittest import SkipTest, TestCase
+
+from txstatsd.server.carbonsender import (
+    CarbonSenderFactory, CarbonSenderManager, ConsistentHashingRouter,
+    build_router, encode_pickle, encode_plaintext)
+from txstatsd.server.spool import SegmentSpool
+
+
+def decode_pickle(data):
+    messages = []
+    while data:
+        length, = struct.unpack("!L", data[:4])
+        messages.append(cPickle.loads(data[4:4 + length]))
+        data = data[4 + length:]
+    return messages
+
+
+class EncodeTest(TestCase):
+
+    def test_pickle(self):
+        """
+        Pickle messages are a length-prefixed pickled list of datapoints.
+        """
+        datapoints = [("foo", (1, 2.5)), ("bar", (1, 3))]
+        self.assertEqual(decode_pickle(encode_pickle(datapoints)),
+                         [datapoints])
+
+    def test_plaintext(self):
+        """
+        Plaintext messages have a line per datapoint.
+        """
+        self.assertEqual(
+            encode_plaintext([("foo", (1, 2.5)), ("bar", (1, 3))]),
+            "foo 2.5 1\nbar 3 1\n")
+
+
+class ConsistentHashingRouterTest(TestCase):
+
+    def test_same_destinations_as_carbon(self):
+        """
+        Metrics are routed to the same destinations as with carbon's
+        router.
+        """
+        try:
+            from carbon.routers import (
+                ConsistentHashingRouter as CarbonRouter)
+        except ImportError:
+            raise SkipTest("carbon is not installed")
+
+        router = ConsistentHashingRouter()
+        carbon_router = CarbonRouter()
+        for destination in [("127.0.0.1", 2004, "a"),
+                            ("127.0.0.1", 2104, "b"),
+                            ("127.0.0.2", 2004, None)]:
+            router.addDestination(destination)
+            carbon_router.addDestination(destination)
+        for i in range(200):
+            metric = "some.metric.%d" % i
+            self.assertEqual(router.getDestinations(metric),
+                             list(carbon_router.getDestinations(metric)))
+
+
+class CarbonSenderFactoryTest(TestCase):
+
+    def setUp(self):
+        self.reactor = MemoryReactorClock()
+        self.factory = CarbonSenderFactory(
+            ("127.0.0.1", 2004, None), max_queue_size=5,
+            max_datapoints_per_message=2, reactor=self.reactor)
+        self.datapoints = [("foo%d" % i, (1, i)) for i in range(3)]
+
+    def connect(self):
+        self.factory.startConnecting()
+        protocol = self.factory.buildProtocol(None)
+        self.transport = StringTransport()
+        protocol.makeConnection(self.transport)
+        return protocol
+
+    def test_send_in_batches(self):
+        """
+        Datapoints are written in messages of at most
+        C{max_datapoints_per_message} datapoints.
+        """
+        self.connect()
+        self.factory.sendDatapoints(self.datapoints)
+        self.assertEqual(decode_pickle(self.transport.value()),
+                         [self.datapoints[:2], self.datapoints[2:]])
+        self.assertEqual(self.factory.report_stats()["sent"], 3)
+
+    def test_queue_until_connected(self):
+        """
+        Datapoints are queued until the connection is made, and the time
+        they spent in the queue is reported.
+        """
+        self.factory.sendDatapoints(self.datapoints)
+        self.reactor.advance(2)
+        self.connect()
+        self.assertEqual(decode_pickle(self.transport.value()),
+                         [self.datapoints[:2], self.datapoints[2:]])
+        stats = self.factory.report_stats()
+        self.assertEqual(stats["queued"], 0)
+        self.assertEqual(stats["relayMaxQueueLength"], 3)
+        self.assertEqual(stats["queueLatencyMax"], 2)
+
+    def test_queue_while_paused(self):
+        """
+        Datapoints are queued while the transport buffer is over its
+        high-water mark, and written once it resumes.
+        """
+        protocol = self.connect()
+        self.assertEqual(self.transport.bufferSize, self.factory.high_water)
+        protocol.pauseProducing()
+        self.factory.sendDatapoints(self.datapoints)
+        self.assertEqual(self.transport.value(), "")
+        protocol.resumeProducing()
+        self.assertEqual(len(decode_pickle(self.transport.value())), 2)
+
+    def test_full_queue_drops(self):
+        """
+        Datapoints that don't fit in the queue are dropped and counted.
+        """
+        self.factory.sendDatapoints(self.datapoints)
+        self.factory.sendDatapoints(self.datapoints)
+        stats = self.factory.report_stats()
+        self.assertEqual(stats["queued"], 5)
+        self.assertEqual(stats["fullQueueDrops"], 1)
+
+
+class CarbonSenderManagerTest(TestCase):
+
+    def test_report_stats(self):
+        """
+        Statistics are reported per destination.
+        """
+        manager = CarbonSenderManager(ConsistentHashingRouter(),
+                                      reactor=MemoryReactorClock())
+        manager.startClient(("127.0.0.1", 2004, "a"))
+        manager.startClient(("127.0.0.1", 2005, "b"))
+        manager.sendDatapoints([("foo%d" % i, (1, i)) for i in range(10)])
+        stats = manager.report_stats()
+        self.assertEqual(
+            stats["destinations.127_0_0_1_2004_a.queued"] +
+            stats["destinations.127_0_0_1_2005_b.queued"], 10)
+
+
+class SpoolTest(TestCase):
+
+    def setUp(self):
+        self.reactor = MemoryReactorClock()
+        self.spool = SegmentSpool(self.mktemp(), segment_size=100)
+        self.factory = CarbonSenderFactory(
+            ("127.0.0.1", 2004, None), protocol="line", max_queue_size=2,
+            spool=self.spool, replay_rate=20, reactor=self.reactor)
+        self.datapoints = [("foo%d" % i, (1, i)) for i in range(5)]
+
+    def connect(self):
+        self.factory.startConnecting()
+        protocol = self.factory.buildProtocol(None)
+        self.transport = StringTransport()
+        protocol.makeConnection(self.transport)
+        return protocol
+
+    def test_spool_overflow(self):
+        """
+        Datapoints that don't fit in the queue are spooled to disk instead
+        of dropped, and replayed at the configured rate after the queue.
+        """
+        self.factory.sendDatapoints(self.datapoints)
+        self.assertEqual(self.factory.queue_size, 2)
+        self.assertEqual(self.factory.drops, 0)
+        self.connect()
+        self.assertEqual(self.transport.value(), "foo0 0 1\nfoo1 1 1\n")
+        self.transport.clear()
+        self.reactor.advance(0.1)
+        self.assertEqual(self.transport.value(),
+                         "foo2 2.0 1.0\nfoo3 3.0 1.0\n")
+        self.reactor.advance(0.1)
+        self.assertEqual(self.transport.value(),
+                         "foo2 2.0 1.0\nfoo3 3.0 1.0\nfoo4 4.0 1.0\n")
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(self.factory.replaying, None)
+
+    def test_live_datapoints_first(self):
+        """
+        The spool isn't replayed while live datapoints are queued.
+        """
+        self.factory.sendDatapoints(self.datapoints)
+        protocol = self.connect()
+        protocol.pauseProducing()
+        self.factory.sendDatapoints(self.datapoints[:1])
+        self.transport.clear()
+        self.reactor.advance(0.1)
+        self.assertEqual(self.transport.value(), "")
+        protocol.resumeProducing()
+        self.assertEqual(self.transport.value(), "foo0 0 1\n")
+
+    def test_replay_after_pause(self):
+        """
+        Datapoints spooled while connected but paused are replayed once
+        the connection resumes, without waiting for a reconnection.
+        """
+        protocol = self.connect()
+        protocol.pauseProducing()
+        self.factory.sendDatapoints(self.datapoints)
+        self.assertEqual(len(self.spool), 27)
+        protocol.resumeProducing()
+        self.transport.clear()
+        self.reactor.advance(0.1)
+        self.reactor.advance(0.1)
+        self.assertEqual(self.transport.value(),
+                         "foo2 2.0 1.0\nfoo3 3.0 1.0\nfoo4 4.0 1.0\n")
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(self.factory.replaying, None)
+
+    def test_torn_last_line(self):
+        """
+        A line left incomplete at the end of a segment by a crash is
+        dropped, and the segment is still read and removed.
+        """
+        path = self.mktemp()
+        os.makedirs(path)
+        with open(os.path.join(path, "%020d.spool" % (0,)), "wb") as f:
+            f.write("foo0 0 1\nfoo1 1")
+        spool = SegmentSpool(path)
+        spool.append(self.datapoints[2:3])
+        self.assertEqual(spool.read(100),
+                         [("foo0", (1.0, 0.0)), ("foo2", (1.0, 2.0))])
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(os.listdir(path), [])
+
+    def test_eviction(self):
+        """
+        The oldest segments are evicted when the spool goes over its size.
+        """
+        spool = SegmentSpool(self.mktemp(), segment_size=20, max_size=40)
+        for i in range(10):
+            spool.append([("foo%d" % i, (1, i))])
+        datapoints = spool.read(100)
+        self.assertEqual([metric for metric, _ in datapoints],
+                         ["foo6", "foo7", "foo8", "foo9"])
+        self.assertTrue(spool.report_stats()["spool.evicted_bytes"] > 0)
+
+    def test_survives_restart(self):
+        """
+        Spooled datapoints are read back by a new spool on the same path.
+        """
+        path = self.mktemp()
+        spool = SegmentSpool(path, segment_size=20)
+        spool.append(self.datapoints)
+        spool.append(self.datapoints[:1])
+        spool.close()
+        spool = SegmentSpool(path, segment_size=20)
+        self.assertEqual(len(spool.read(100)), 6)
+        self.assertEqual(os.listdir(path), [])
+
+
+class RouterTest(TestCase):
+
+    def setUp(self):
+        self.destinations = [("127.0.0.1", 2004, "a"),
+                             ("127.0.0.1", 2104, "b"),
+                             ("127.0.0.2", 2004, None)]
+
+    def add_destinations(self, router):
+        for destination in self.destinations:
+            router.addDestination(destination)
+        return router
+
+    def test_jump(self):
+        """
+        The jump router spreads metrics over all destinations.
+        """
+        router = self.add_destinations(build_router("jump"))
+        destinations = set()
+        for i in range(100):
+            destinations.update(router.getDestinations("metric.%d" % i))
+        self.assertEqual(destinations, set(self.destinations))
+
+    def test_replicate(self):
+        """
+        The replicating router sends every metric everywhere.
+        """
+        router = self.add_destinations(build_router("replicate"))
+        self.assertEqual(router.getDestinations("foo"), self.destinations)
+
+    def test_relay(self):
+        """
+        The relay router picks destinations by prefix, skipping the ones
+        that aren't configured.
+        """
+        router = self.add_destinations(build_router(
+            "relay", "heavy. 127.0.0.1:2104:b 127.0.0.3:2004;"
+                     "* 127.0.0.1:2004:a 127.0.0.2:2004"))
+        self.assertEqual(router.getDestinations("heavy.metric"),
+                         [("127.0.0.1", 2104, "b")])
+        self.assertEqual(router.getDestinations("light.metric"),
+                         [("127.0.0.1", 2004, "a"),
+                          ("127.0.0.2", 2004, None)])
+
+    def test_relay_needs_default(self):
+        self.assertRaises(ValueError, build_router, "relay",
+                          "heavy. 127.0.0.1:2104:b")
+
+    def test_unknown_router(self):
+        self.assertRaises(ValueError, build_router, "random")
+
+    def test_independent_queues(self):
+        """
+        A destination that is down doesn't hold back the others.
+        """
+        reactor = MemoryReactorClock()
+        manager = CarbonSenderManager(build_router("replicate"),
+                                      reactor=reactor, protocol="line")
+        for destination in self.destinations[:2]:
+            manager.startClient(destination)
+        up = manager.client_factories[self.destinations[0]]
+        down = manager.client_factories[self.destinations[1]]
+        transport = StringTransport()
+        up.buildProtocol(None).makeConnection(transport)
+        manager.sendDatapoints([("foo", (1, 2))])
+        self.assertEqual(transport.value(), "foo 2 1\n")
+        self.assertEqual(down.queue_size, 1)
@@ -20,11 +20,18 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """Tests for the various client classes."""
 
+import os
+import socket
 import sys
+import threading
+import time
 
-from mock import Mock, call
+from mock import Mock
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.defer import inlineCallbacks, Deferred, fail, succeed
+from twisted.internet.error import DNSLookupError
+from twisted.internet.task import Clock, deferLater
+from twisted.test.proto_helpers import StringTransport
 from twisted.python import log
 from twisted.trial.unittest import TestCase
 
@@ -34,9 +41,11 @@ import txstatsd.metrics.metrics
 from txstatsd.metrics.metric import Metric
 from txstatsd.client import (
     StatsDClientProtocol, TwistedStatsDClient, UdpStatsDClient,
-    ConsistentHashingClient
+    ConsistentHashingClient, BatchingClient, TCPStatsDClient
 )
-from txstatsd.protocol import DataQueue, TransportGateway
+from txstatsd.server.protocol import (
+    StatsDServerProtocol, StatsDTCPServerFactory)
+from txstatsd.protocol import DataQueue, TransportGateway, MessageBuffer
 
 
 class FakeClient(object):
@@ -53,6 +62,7 @@ class FakeClient(object):
 
     def write(self, data):
         self.data.append(data)
+        return len(data)
 
     def connect(self):
         self.connect_called = True
@@ -302,14 +312,13 @@ class TestClient(TestCase):
         self.client.data_queue.write('data 2', 'callback 2')
         self.client.data_queue.write('data 3', 'callback 3')
 
-        mock_gateway_write = Mock()
-        self.patch(TransportGateway, 'write', mock_gateway_write)
+        mock_gateway_write_many = Mock()
+        self.patch(TransportGateway, 'write_many', mock_gateway_write_many)
         self.client.host_resolved('127.0.0.1')
-        self.assertTrue(mock_gateway_write.call_count, 3)
-        expected = [call('data 1', 'callback 1'),
-                    call('data 2', 'callback 2'),
-                    call('data 3', 'callback 3')]
-        self.assertEqual(mock_gateway_write.call_args_list, expected)
+        mock_gateway_write_many.assert_called_once_with(
+            [('data 1', 'callback 1'),
+             ('data 2', 'callback 2'),
+             ('data 3', 'callback 3')])
 
     def test_sets_client_transport_when_connected(self):
         """Set the transport as an attribute of the client."""
@@ -377,6 +386,984 @@ class DataQueueTest(TestCase):
 
         self.assertTrue(queue._limit > 0)
 
+    def test_coalesces_counters_and_meters(self):
+        """Counter and meter updates to the same metric share a slot."""
+        for i in range(10):
+            self.queue.write('foo:1|c', None)
+            self.queue.write('bar:0.5|m', None)
+        self.queue.write('foo:-3|c', None)
+
+        self.assertEqual(self.queue.flush(), [('foo:7|c', None),
+                                              ('bar:5.0|m', None)])
+        self.assertEqual(self.queue.report_stats(),
+                         {"drops": 0, "coalesced": 19})
+
+    def test_does_not_coalesce_other_messages(self):
+        """Sampled counters, other metric types, messages with callbacks
+        and packed payloads are queued as they are."""
+        queue = DataQueue(limit=10)
+        messages = [('foo:1|c|@0.1', None), ('foo:1|c|@0.1', None),
+                    ('foo:1|ms', None), ('foo:1|ms', None),
+                    ('foo:1|c', 'callback'), ('foo:1|c', 'callback'),
+                    ('foo:1|c\nfoo:1|c', None), ('foo:1|c\nfoo:1|c', None)]
+        for data, callback in messages:
+            queue.write(data, callback)
+
+        self.assertEqual(queue.flush(), messages)
+
+    def test_coalescing_restarts_after_flush(self):
+        """Messages queued after a flush get new slots."""
+        self.queue.write('foo:1|c', None)
+        self.queue.flush()
+        self.queue.write('foo:2|c', None)
+        self.queue.write('foo:2|c', None)
+
+        self.assertEqual(self.queue.flush(), [('foo:4|c', None)])
+
+    def test_threads(self):
+        """Messages written from several threads while the queue is being
+        flushed are all kept."""
+        queue = DataQueue(limit=100000)
+
+        def writer(n):
+            for i in range(2000):
+                queue.write('foo%d.%d:1|ms' % (n, i), None)
+                queue.write('bar%d:1|c' % (i % 10,), None)
+
+        threads = [threading.Thread(target=writer, args=(n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        items = []
+        while any(thread.is_alive() for thread in threads):
+            items.extend(queue.flush())
+        for thread in threads:
+            thread.join()
+        items.extend(queue.flush())
+
+        timings = [data for data, _ in items if data.endswith('|ms')]
+        self.assertEqual(len(timings), 16000)
+        self.assertEqual(len(set(timings)), 16000)
+        self.assertEqual(
+            sum(int(data.split(':')[1].split('|')[0])
+                for data, _ in items if data.endswith('|c')), 16000)
+        self.assertEqual(queue.report_stats()["drops"], 0)
+
+    def test_counts_drops(self):
+        """Messages that don't fit are counted, but coalesced ones fit."""
+        self.queue.write('foo:1|c', None)
+        self.queue.write('bar:1|c', None)
+        self.queue.write('baz:1|c', None)
+        self.queue.write('foo:1|c', None)
+
+        self.assertEqual(self.queue.flush(), [('foo:2|c', None),
+                                              ('bar:1|c', None)])
+        self.assertEqual(self.queue.report_stats(),
+                         {"drops": 1, "coalesced": 1})
+        self.assertEqual(self.queue.report_stats(),
+                         {"drops": 0, "coalesced": 0})
+
+
+class ThreadReactor(Clock):
+    """A Clock recording the calls scheduled from other threads."""
+
+    def __init__(self):
+        Clock.__init__(self)
+        self.from_thread = []
+
+    def callFromThread(self, f, *args):
+        self.from_thread.append((f, args))
+
+    def run_from_thread(self):
+        calls, self.from_thread = self.from_thread, []
+        for f, args in calls:
+            f(*args)
+        return len(calls)
+
+
+class CollectingTransport(object):
+
+    def __init__(self, fail=False):
+        self.datagrams = []
+        self.fail = fail
+
+    def write(self, data, addr):
+        if self.fail:
+            raise socket.error("refused")
+        self.datagrams.append(data)
+        return len(data)
+
+
+class TransportGatewayTest(TestCase):
+
+    def setUp(self):
+        super(TransportGatewayTest, self).setUp()
+        self.reactor = ThreadReactor()
+        self.transport = CollectingTransport()
+        self.gateway = TransportGateway(self.transport, self.reactor,
+                                        "127.0.0.1", 8125, buffer_size=5)
+
+    def test_one_wakeup_per_batch(self):
+        """Metrics written before the reactor wakes up are sent in a single
+        wakeup, as a datagram each."""
+        sent = []
+        for i in range(3):
+            self.gateway.write("foo:%d|c" % i, sent.append)
+        self.assertEqual(self.transport.datagrams, [])
+        self.assertEqual(self.reactor.run_from_thread(), 1)
+        self.assertEqual(self.transport.datagrams,
+                         ["foo:0|c", "foo:1|c", "foo:2|c"])
+        self.assertEqual(sent, [7, 7, 7])
+
+        self.gateway.write("foo:3|c", None)
+        self.assertEqual(self.reactor.run_from_thread(), 1)
+        self.assertEqual(self.gateway.report_stats(),
+                         {"wakeups": 2, "packets": 4, "drops": 0,
+                          "overflows": 0})
+
+    def test_packs_datagrams(self):
+        """With a C{max_size}, buffered metrics are packed into
+        datagrams and each callback gets its own size."""
+        self.gateway.max_size = 16
+        sent = []
+        for i in range(5):
+            self.gateway.write("foo:%d|c" % i, sent.append)
+        self.reactor.run_from_thread()
+        self.assertEqual(self.transport.datagrams,
+                         ["foo:0|c\nfoo:1|c", "foo:2|c\nfoo:3|c", "foo:4|c"])
+        self.assertEqual(sent, [7] * 5)
+        self.assertEqual(self.gateway.report_stats()["packets"], 3)
+
+    def test_overflow(self):
+        """Metrics written while the buffer is full are dropped, counted
+        and called back with C{None}."""
+        sent = []
+        for i in range(7):
+            self.gateway.write("foo:%d|c" % i, sent.append)
+        self.reactor.run_from_thread()
+        self.assertEqual(len(self.transport.datagrams), 5)
+        self.assertEqual(sorted(sent), [None, None, 7, 7, 7, 7, 7])
+        self.assertEqual(self.gateway.report_stats()["overflows"], 2)
+
+    def test_drops(self):
+        """Failed datagrams are counted and called back with C{None}."""
+        self.transport.fail = True
+        sent = []
+        self.gateway.max_size = 512
+        self.gateway.write("foo:1|c", sent.append)
+        self.gateway.write("foo:2|c", sent.append)
+        self.reactor.run_from_thread()
+        self.assertEqual(sent, [None, None])
+        self.assertEqual(self.gateway.report_stats()["drops"], 1)
+
+    def test_concurrent_writers(self):
+        """No metric is lost when written from several threads."""
+        self.gateway.buffer_size = 100000
+
+        def produce(n):
+            for i in range(1000):
+                self.gateway.write("t%d:%d|c" % (n, i), None)
+        threads = [threading.Thread(target=produce, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wakeups = self.reactor.run_from_thread()
+        self.assertEqual(sorted(self.transport.datagrams),
+                         sorted("t%d:%d|c" % (n, i)
+                                for n in range(4) for i in range(1000)))
+        self.assertTrue(wakeups < 4000)
+
+    def test_write_many(self):
+        """Several metrics are buffered with a single wakeup, and those
+        that don't fit are counted as overflows."""
+        sent = []
+        self.gateway.write_many([("foo:%d|c" % i, sent.append)
+                                 for i in range(7)])
+        self.assertEqual(self.reactor.run_from_thread(), 3)
+        self.assertEqual(self.transport.datagrams,
+                         ["foo:%d|c" % i for i in range(5)])
+        self.assertEqual(sent, [None, None] + [7] * 5)
+        self.assertEqual(self.gateway.report_stats()["overflows"], 2)
+
+    def test_replays_startup_burst(self):
+        """A burst written before the host resolves is coalesced and
+        replayed with a single wakeup."""
+        client = TwistedStatsDClient("localhost", 8125, reactor=self.reactor)
+        client.connect(self.transport)
+        for i in range(10000):
+            client.write("foo.%d:1|c" % (i % 3))
+        client.write("bar:1|g")
+        client.host_resolved("127.0.0.1")
+        self.assertEqual(self.reactor.run_from_thread(), 1)
+        self.assertEqual(sorted(self.transport.datagrams),
+                         ["bar:1|g", "foo.0:3334|c", "foo.1:3333|c",
+                          "foo.2:3333|c"])
+        self.assertEqual(client.report_stats()["queue_coalesced"], 9997)
+
+    def test_drops_parent_data_after_fork(self):
+        """Data queued or buffered before a fork is only sent by the
+        parent."""
+        client = TwistedStatsDClient("localhost", 8125, reactor=self.reactor)
+        client.connect(self.transport)
+        client.write("queued:1|c")
+        client.host_resolved("127.0.0.1")
+        client.write("buffered:1|c")
+        client.pid = -1
+        client.write("child:1|c")
+        self.reactor.run_from_thread()
+        self.assertEqual(self.transport.datagrams, ["child:1|c"])
+        self.assertEqual(len(client.data_queue), 0)
+
+    def test_client_stats(self):
+        """The client reports the counters of its gateway."""
+        client = TwistedStatsDClient("127.0.0.1", 8125, reactor=self.reactor,
+                                     max_size=512, buffer_size=5)
+        client.connect(self.transport)
+        self.assertEqual(client.transport_gateway.max_size, 512)
+        client.write("foo:1|c")
+        self.reactor.run_from_thread()
+        self.assertEqual(client.report_stats(),
+                         {"wakeups": 1, "packets": 1, "drops": 0,
+                          "overflows": 0, "queue_drops": 0,
+                          "queue_coalesced": 0, "resolve_failures": 0,
+                          "address_changes": 0})
+
+
+class CallbackClient(object):
+
+    def __init__(self, bytes_sent=True):
+        self.data = []
+        self.bytes_sent = bytes_sent
+
+    def write(self, data, callback=None):
+        self.data.append(data)
+        if callback is not None:
+            callback(len(data) if self.bytes_sent else None)
+
+
+class BatchingClientTest(TestCase):
+
+    def setUp(self):
+        super(BatchingClientTest, self).setUp()
+        self.clock = Clock()
+        self.client = CallbackClient()
+        self.batching = BatchingClient(self.client, max_size=20,
+                                       delay=0.1, reactor=self.clock)
+
+    def test_packs_until_full(self):
+        """Messages are joined with newlines up to the maximum size."""
+        for i in range(5):
+            self.batching.write("foo:%d|c" % i)
+        self.assertEqual(self.client.data, ["foo:0|c\nfoo:1|c",
+                                            "foo:2|c\nfoo:3|c"])
+        self.batching.flush()
+        self.assertEqual(self.client.data, ["foo:0|c\nfoo:1|c",
+                                            "foo:2|c\nfoo:3|c",
+                                            "foo:4|c"])
+
+    def test_flushes_after_delay(self):
+        """A partial payload is written after the delay."""
+        self.batching.write("foo:1|c")
+        self.clock.advance(0.05)
+        self.batching.write("bar:1|c")
+        self.assertEqual(self.client.data, [])
+        self.clock.advance(0.05)
+        self.assertEqual(self.client.data, ["foo:1|c\nbar:1|c"])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_large_message_sent_alone(self):
+        """A message larger than the maximum size is sent on its own."""
+        self.batching.write("foo:1|c")
+        self.batching.write("x" * 30)
+        self.assertEqual(self.client.data, ["foo:1|c", "x" * 30])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_report_stats(self):
+        """Messages, packets and bytes are counted and reset."""
+        for i in range(3):
+            self.batching.write("foo:%d|c" % i)
+        self.batching.flush()
+        self.assertEqual(self.batching.report_stats(),
+                         {"messages": 3, "packets": 2,
+                          "bytes": 22, "drops": 0})
+        self.assertEqual(self.batching.report_stats(),
+                         {"messages": 0, "packets": 0,
+                          "bytes": 0, "drops": 0})
+
+    def test_counts_drops(self):
+        """Messages in payloads that could not be sent are dropped."""
+        self.client.bytes_sent = False
+        for i in range(3):
+            self.batching.write("foo:%d|c" % i)
+        self.batching.flush()
+        self.assertEqual(self.batching.report_stats()["drops"], 3)
+
+
+class BatchingUdpStatsDClientTest(TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.settimeout(1)
+        self.addCleanup(self.server.close)
+        self.client = self.build_client(delay=5)
+
+    def build_client(self, delay):
+        client = UdpStatsDClient("127.0.0.1", self.server.getsockname()[1],
+                                 max_size=20, delay=delay)
+        client.connect()
+        self.addCleanup(client.disconnect)
+        return client
+
+    def test_batches_up_to_max_size(self):
+        """
+        Metrics are packed into datagrams of up to C{max_size} bytes.
+        """
+        for i in range(4):
+            self.client.write("foo:%d|c" % i)
+        self.assertEqual(self.server.recv(100), "foo:0|c\nfoo:1|c")
+        self.client.flush()
+        self.assertEqual(self.server.recv(100), "foo:2|c\nfoo:3|c")
+        self.assertEqual(self.client.report_stats(),
+                         {"messages": 4, "packets": 2, "drops": 0,
+                          "resolve_failures": 0, "address_changes": 0})
+
+    def test_sent_after_delay(self):
+        """
+        Metrics held back are sent after C{delay} seconds.
+        """
+        client = self.build_client(delay=0.01)
+        client.write("foo:1|c")
+        self.assertEqual(self.server.recv(100), "foo:1|c")
+
+    def test_drops(self):
+        """
+        Metrics in a datagram that can't be sent are counted as dropped.
+        """
+        self.client.socket = Mock()
+        self.client.socket.sendto.side_effect = socket.error()
+        self.client.write("foo:1|c")
+        self.client.write("foo:2|c")
+        self.client.flush()
+        self.assertEqual(self.client.report_stats()["drops"], 2)
+
+    def test_write_result(self):
+        """
+        Writes return the size of the metric held back, or C{None} when
+        the datagram they completed can't be sent.
+        """
+        self.assertEqual(self.client.write("foo:1|c"), 7)
+        self.assertEqual(self.client.write("foo:2|c"), 7)
+        self.client.socket = Mock()
+        self.client.socket.sendto.side_effect = socket.error()
+        self.assertEqual(self.client.write("foo:3|c"), None)
+        self.client.disconnect()
+        self.assertEqual(self.client.write("foo:4|c"), None)
+
+    def test_healthy(self):
+        """
+        The client is healthy while connected.
+        """
+        self.assertTrue(self.client.healthy())
+        self.client.disconnect()
+        self.assertFalse(self.client.healthy())
+
+    def test_threads(self):
+        """
+        Metrics written from several threads are all sent, once.
+        """
+        def write(n):
+            for i in range(50):
+                self.client.write("t%d:%d|c" % (n, i))
+        threads = [threading.Thread(target=write, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.client.flush()
+        received = []
+        while len(received) < 200:
+            received.extend(self.server.recv(100).split("\n"))
+        self.assertEqual(sorted(received),
+                         sorted("t%d:%d|c" % (n, i)
+                                for n in range(4) for i in range(50)))
+
+
+class ForkingUdpStatsDClientTest(TestCase):
+
+    def setUp(self):
+        super(ForkingUdpStatsDClientTest, self).setUp()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.settimeout(5)
+        self.addCleanup(self.server.close)
+
+    def fork(self, child):
+        """Run C{child} in a forked process and wait for it."""
+        pid = os.fork()
+        if pid == 0:
+            try:
+                child()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+    def test_batch_not_sent_twice(self):
+        """A forked process doesn't send the batch of its parent, and uses
+        its own socket."""
+        client = UdpStatsDClient("127.0.0.1", self.server.getsockname()[1],
+                                 max_size=512, delay=60)
+        client.connect()
+        self.addCleanup(client.disconnect)
+        client.write("parent:1|c")
+        parent_socket = client.socket
+
+        def child():
+            client.write("child:1|c")
+            if client.socket is parent_socket:
+                client.write("child:shared|c")
+            client.flush()
+        self.fork(child)
+
+        self.assertEqual(self.server.recv(1024), "child:1|c")
+        client.flush()
+        self.assertEqual(self.server.recv(1024), "parent:1|c")
+        self.assertEqual(client.report_stats()["messages"], 1)
+
+
+class UnixStatsDClientTest(TestCase):
+
+    def setUp(self):
+        super(UnixStatsDClientTest, self).setUp()
+        self.path = self.mktemp()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.server.bind(self.path)
+        self.server.settimeout(1)
+        self.addCleanup(self.server.close)
+
+    def build_client(self, path, **kwargs):
+        # The module may have been reloaded by an earlier test.
+        client = txstatsd.client.UnixStatsDClient(path, **kwargs)
+        client.connect()
+        self.addCleanup(client.disconnect)
+        return client
+
+    def test_write(self):
+        """A datagram is sent per metric to the server socket."""
+        client = self.build_client(self.path)
+        client.write("foo:1|c")
+        client.write("bar:2|c")
+        self.assertEqual(self.server.recv(100), "foo:1|c")
+        self.assertEqual(self.server.recv(100), "bar:2|c")
+        self.assertEqual(str(client), self.path)
+
+    def test_batches(self):
+        """Metrics are batched as with UDP."""
+        client = self.build_client(self.path, max_size=512, delay=60)
+        client.write("foo:1|c")
+        client.write("bar:2|c")
+        client.flush()
+        self.assertEqual(self.server.recv(100), "foo:1|c\nbar:2|c")
+        self.assertEqual(client.report_stats()["packets"], 1)
+
+    def test_no_server(self):
+        """Metrics are counted as dropped when nothing listens."""
+        client = self.build_client(self.mktemp())
+        client.write("foo:1|c")
+        self.assertEqual(client.report_stats()["drops"], 1)
+
+    def test_full_receive_buffer(self):
+        """Metrics are counted as dropped, instead of silently lost, when
+        the server doesn't keep up."""
+        client = self.build_client(self.path)
+        sent = 0
+        while client.report_stats()["drops"] == 0:
+            client.write("foo:%d|c" % sent)
+            sent += 1
+        self.assertTrue(sent > 1)
+
+
+class ResolvingUdpStatsDClientTest(TestCase):
+
+    def setUp(self):
+        super(ResolvingUdpStatsDClientTest, self).setUp()
+        self.addresses = ["10.0.0.1"]
+        self.patch(socket, "getaddrinfo", self.getaddrinfo)
+        self.client = UdpStatsDClient("statsd.local", 8125,
+                                      resolve_interval=0.01)
+
+    def getaddrinfo(self, host, port, *args):
+        self.assertEqual(host, "statsd.local")
+        address = self.addresses.pop(0) if self.addresses else None
+        if address is None:
+            raise socket.gaierror("lookup failed")
+        return [(socket.AF_INET, socket.SOCK_DGRAM, socket.SOL_UDP, "",
+                 (address, port))]
+
+    def test_resolve(self):
+        """The host is resolved again, keeping the last address when
+        resolution fails."""
+        self.assertEqual(self.client.host, "10.0.0.1")
+        self.addresses = ["10.0.0.1", "10.0.0.2", None]
+        for i in range(3):
+            self.client.resolve()
+        self.assertEqual(self.client.host, "10.0.0.2")
+        self.assertEqual(self.client.port, 8125)
+        stats = self.client.report_stats()
+        self.assertEqual(stats["address_changes"], 1)
+        self.assertEqual(stats["resolve_failures"], 1)
+
+    def test_resolves_in_background(self):
+        """While connected, the host is resolved in a background thread."""
+        self.addresses = ["10.0.0.2"]
+        self.client.connect()
+        self.addCleanup(self.client.disconnect)
+        for i in range(200):
+            if self.client.host == "10.0.0.2":
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.client.host, "10.0.0.2")
+
+    def test_stops_resolving_on_disconnect(self):
+        """The resolver thread stops when the client is disconnected."""
+        self.client.connect()
+        stopped = self.client.resolver_stopped
+        self.client.disconnect()
+        self.assertTrue(stopped.is_set())
+        self.assertTrue(self.client.resolver_stopped is None)
+
+
+class ResolvingReactor(Clock):
+    """A Clock resolving names to a list of results."""
+
+    def __init__(self, addresses):
+        Clock.__init__(self)
+        self.addresses = addresses
+
+    def resolve(self, name):
+        address = self.addresses.pop(0)
+        if address is None:
+            return fail(DNSLookupError(name))
+        return succeed(address)
+
+
+class ResolvingTwistedStatsDClientTest(TestCase):
+
+    def test_resolves_periodically(self):
+        """The host is resolved again every C{resolve_interval} seconds,
+        keeping the last address when resolution fails."""
+        reactor = ResolvingReactor(["10.0.0.1", "10.0.0.1", None, "10.0.0.2"])
+        client = TwistedStatsDClient.create("statsd.local", 8125,
+                                            reactor=reactor,
+                                            resolve_interval=30)
+        client.connect(CollectingTransport())
+        self.assertEqual(client.host, "10.0.0.1")
+        reactor.advance(30)
+        reactor.advance(30)
+        self.assertEqual(client.host, "10.0.0.1")
+        reactor.advance(30)
+        self.assertEqual(client.host, "10.0.0.2")
+        self.assertEqual(client.transport_gateway.host, "10.0.0.2")
+        stats = client.report_stats()
+        self.assertEqual(stats["address_changes"], 1)
+        self.assertEqual(stats["resolve_failures"], 1)
+
+        client.disconnect()
+        self.assertEqual(reactor.getDelayedCalls(), [])
+
+    def test_retries_initial_resolution(self):
+        """A host that could not be resolved at first is resolved by the
+        periodic resolution."""
+        reactor = ResolvingReactor([None, "10.0.0.1"])
+        client = TwistedStatsDClient.create("statsd.local", 8125,
+                                            reactor=reactor,
+                                            resolver_errback=lambda f: None,
+                                            resolve_interval=30)
+        self.assertTrue(client.transport_gateway is None)
+        reactor.advance(30)
+        self.assertEqual(client.transport_gateway.host, "10.0.0.1")
+
+
+class UdpStatsDClientBenchmark(TestCase):
+
+    def test_overhead_per_metric(self):
+        """
+        Report the time the application spends writing a metric, with and
+        without batching.
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        self.addCleanup(server.close)
+        for max_size in (0, 512, 1400):
+            client = UdpStatsDClient("127.0.0.1", server.getsockname()[1],
+                                     max_size=max_size)
+            client.connect()
+            count = 200000
+            start = time.time()
+            for i in range(count):
+                client.write("some.metric.name:1|c")
+            client.flush()
+            elapsed = time.time() - start
+            client.disconnect()
+            sys.stdout.write("max_size %4d: %.2f us per metric\n" %
+                             (max_size, elapsed / count * 1e6))
+    test_overhead_per_metric.skip = "benchmark, run manually"
+
+
+class MessageBufferTest(TestCase):
+
+    def setUp(self):
+        super(MessageBufferTest, self).setUp()
+        self.clock = Clock()
+        self.written = []
+        self.writable = True
+
+    def replay(self, buffer):
+        buffer.replay(self.written.append, lambda: self.writable)
+
+    def test_drops_when_full(self):
+        """Without a spill file, messages beyond the limit are dropped."""
+        buffer = MessageBuffer(limit=2, reactor=self.clock)
+        for i in range(3):
+            buffer.append("foo:%d|c" % i)
+        self.assertEqual(len(buffer), 2)
+        self.replay(buffer)
+        self.assertEqual(self.written, ["foo:0|c", "foo:1|c"])
+        self.assertEqual(buffer.report_stats(),
+                         {"depth": 0, "spilled_bytes": 0,
+                          "drops": 1, "replayed": 2})
+
+    def test_spills_to_disk(self):
+        """Messages that don't fit in memory are spilled and replayed in
+        order."""
+        path = self.mktemp()
+        buffer = MessageBuffer(limit=2, spill_path=path, reactor=self.clock)
+        for i in range(4):
+            buffer.append("foo:%d|c" % i)
+        self.assertEqual(len(buffer), 2)
+        self.assertEqual(buffer.spilled, 16)
+        self.replay(buffer)
+        self.assertEqual(self.written,
+                         ["foo:%d|c" % i for i in range(4)])
+        self.assertFalse(buffer.has_pending())
+        buffer.close()
+        self.assertEqual(open(path).read(), "")
+
+    def test_spill_limit(self):
+        """Spilling stops at the spill limit."""
+        buffer = MessageBuffer(limit=1, spill_path=self.mktemp(),
+                               spill_limit=10, reactor=self.clock)
+        for i in range(3):
+            buffer.append("foo:%d|c" % i)
+        self.assertEqual(buffer.spilled, 8)
+        self.assertEqual(buffer.drops, 1)
+
+    def test_keeps_spill_across_restarts(self):
+        """Spilled messages not yet replayed are kept on close."""
+        path = self.mktemp()
+        buffer = MessageBuffer(limit=0, spill_path=path, reactor=self.clock)
+        buffer.append("foo:1|c")
+        buffer.close()
+        buffer = MessageBuffer(limit=0, spill_path=path, reactor=self.clock)
+        self.assertTrue(buffer.has_pending())
+        self.assertEqual(buffer.pop(), "foo:1|c")
+        buffer.close()
+
+    def test_keeps_only_unreplayed_spill_across_restarts(self):
+        """Spilled messages already replayed are not replayed again after
+        a restart."""
+        path = self.mktemp()
+        buffer = MessageBuffer(limit=0, spill_path=path, reactor=self.clock)
+        for i in range(3):
+            buffer.append("foo:%d|c" % i)
+        self.assertEqual(buffer.pop(), "foo:0|c")
+        buffer.close()
+        buffer = MessageBuffer(limit=0, spill_path=path, reactor=self.clock)
+        self.assertEqual(buffer.spilled, 16)
+        self.replay(buffer)
+        self.assertEqual(self.written, ["foo:1|c", "foo:2|c"])
+        buffer.close()
+
+    def test_replay_batches(self):
+        """Replay writes a batch per reactor iteration, without waiting."""
+        buffer = MessageBuffer(replay_batch=2, reactor=self.clock)
+        for i in range(5):
+            buffer.append("foo:%d|c" % i)
+        self.replay(buffer)
+        self.assertEqual(len(self.written), 2)
+        [call] = self.clock.getDelayedCalls()
+        self.assertEqual(call.getTime(), self.clock.seconds())
+        self.clock.advance(0)
+        self.assertEqual(len(self.written), 5)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_replay_drains_until_paused(self):
+        """Replay isn't held to a rate: it writes until the destination
+        can't take more."""
+        buffer = MessageBuffer(limit=100000, replay_batch=1000,
+                               reactor=self.clock)
+        for i in range(50000):
+            buffer.append("foo:%d|c" % i)
+
+        def write(data):
+            self.written.append(data)
+            if len(self.written) == 30000:
+                self.writable = False
+        buffer.replay(write, lambda: self.writable)
+        while self.clock.getDelayedCalls():
+            self.clock.advance(0)
+        self.assertEqual(len(self.written), 30000)
+        self.assertEqual(len(buffer), 20000)
+
+    def test_replay_stops_when_not_writable(self):
+        """Replay stops when the destination can't take more messages."""
+        buffer = MessageBuffer(reactor=self.clock)
+        buffer.append("foo:1|c")
+        self.writable = False
+        self.replay(buffer)
+        self.assertEqual(self.written, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(len(buffer), 1)
+
+
+class CollectingProcessor(object):
+
+    def __init__(self, count):
+        self.messages = []
+        self.count = count
+        self.done = Deferred()
+
+    def process(self, message):
+        self.messages.append(message)
+        if len(self.messages) == self.count:
+            self.done.callback(self.messages)
+
+
+class TCPStatsDClientTest(TestCase):
+
+    def setUp(self):
+        super(TCPStatsDClientTest, self).setUp()
+        self.clock = Clock()
+        self.paused = []
+        self.client = TCPStatsDClient(
+            "127.0.0.1", 8125, max_size=20, buffer_size=3,
+            pause_callback=lambda: self.paused.append(True),
+            resume_callback=lambda: self.paused.append(False),
+            reactor=self.clock)
+
+    def connect(self, client=None):
+        client = client or self.client
+        transport = StringTransport()
+        client.buildProtocol(None).makeConnection(transport)
+        return transport
+
+    def test_one_write_per_iteration(self):
+        """Messages written during a reactor iteration are written to the
+        transport at once."""
+        transport = self.connect()
+        self.client.write("foo:1|c")
+        self.client.write("bar:1|c")
+        self.assertEqual(transport.value(), "")
+        self.clock.advance(0)
+        self.assertEqual(transport.value(), "foo:1|c\r\nbar:1|c\r\n")
+        stats = self.client.report_stats()
+        self.assertEqual(stats["messages"], 2)
+        self.assertEqual(stats["writes"], 1)
+        self.assertEqual(stats["bytes"], 18)
+        self.assertEqual(stats["connects"], 1)
+
+    def test_writes_when_full(self):
+        """A payload reaching C{max_size} is written right away."""
+        transport = self.connect()
+        for i in range(3):
+            self.client.write("foo:%d|c" % i)
+        self.assertEqual(transport.value(),
+                         "foo:0|c\r\nfoo:1|c\r\nfoo:2|c\r\n")
+
+    def test_buffers_while_disconnected(self):
+        """Messages written while disconnected are buffered, up to
+        C{buffer_size}, and replayed on connection."""
+        for i in range(4):
+            self.client.write("foo:%d|c" % i)
+        self.clock.advance(0)
+        transport = self.connect()
+        self.assertEqual(transport.value(),
+                         "foo:0|c\r\nfoo:1|c\r\nfoo:2|c\r\n")
+        stats = self.client.report_stats()
+        self.assertEqual(stats["drops"], 1)
+        self.assertEqual(stats["replayed"], 3)
+
+    def test_healthy(self):
+        """The client is healthy while connected."""
+        self.assertFalse(self.client.healthy())
+        self.connect()
+        self.assertTrue(self.client.healthy())
+        self.assertTrue(self.client.write("foo:1|c"))
+
+    def test_backpressure(self):
+        """The callbacks are called as the transport pauses and resumes,
+        and messages written meanwhile are replayed in order."""
+        transport = self.connect()
+        protocol = self.client.protocol
+        protocol.pauseProducing()
+        self.assertEqual(self.paused, [True])
+        self.client.write("foo:1|c")
+        self.clock.advance(0)
+        self.assertEqual(transport.value(), "")
+        protocol.resumeProducing()
+        self.assertEqual(self.paused, [True, False])
+        self.client.write("foo:2|c")
+        self.clock.advance(0)
+        self.assertEqual(transport.value(), "foo:1|c\r\nfoo:2|c\r\n")
+
+    def lose_connection(self):
+        self.client.protocol.stopProducing()
+        self.client.clientConnectionLost(Mock(), None)
+
+    def test_connection_lost_is_not_a_pause(self):
+        """Losing the connection doesn't call the pause callback."""
+        self.connect()
+        self.lose_connection()
+        self.assertEqual(self.paused, [])
+        self.connect()
+        self.assertEqual(self.paused, [])
+
+    def test_resumes_on_reconnect(self):
+        """A pause outstanding when the connection is lost ends once the
+        client reconnects, and messages written meanwhile are replayed."""
+        self.connect()
+        self.client.protocol.pauseProducing()
+        self.lose_connection()
+        self.client.write("foo:1|c")
+        self.clock.advance(0)
+        self.assertEqual(self.paused, [True])
+        transport = self.connect()
+        self.assertEqual(self.paused, [True, False])
+        self.assertEqual(transport.value(), "foo:1|c\r\n")
+
+    def test_spill(self):
+        """Messages that don't fit in memory are spilled to disk."""
+        path = self.mktemp()
+        client = TCPStatsDClient("127.0.0.1", 8125, buffer_size=1,
+                                 spill_path=path, reactor=self.clock)
+        self.addCleanup(client.buffer.close)
+        for i in range(3):
+            client.write("foo:%d|c" % i)
+        client.flush()
+        self.assertEqual(client.report_stats()["spilled_bytes"], 16)
+        transport = self.connect(client)
+        self.assertEqual(transport.value(),
+                         "foo:0|c\r\nfoo:1|c\r\nfoo:2|c\r\n")
+
+    def test_disconnect_keeps_unreplayed_spill(self):
+        """Disconnecting closes the buffer, leaving only the messages not
+        replayed yet in the spill file."""
+        path = self.mktemp()
+        client = TCPStatsDClient("127.0.0.1", 8125, buffer_size=0,
+                                 spill_path=path, reactor=self.clock)
+        client.buffer.replay_batch = 1
+        for i in range(3):
+            client.write("foo:%d|c" % i)
+        client.flush()
+        transport = self.connect(client)
+        self.assertEqual(transport.value(), "foo:0|c\r\n")
+        client.disconnect()
+        self.assertEqual(client.buffer.spill_file, None)
+        self.assertEqual(open(path).read(), "foo:1|c\nfoo:2|c\n")
+
+    def test_consistent_hashing(self):
+        """TCP clients can be spread over with a
+        L{ConsistentHashingClient}."""
+        clients = [TCPStatsDClient("127.0.0.1", port, reactor=self.clock)
+                   for port in (8125, 8126)]
+        transports = [self.connect(client) for client in clients]
+        hashing = ConsistentHashingClient(clients)
+        for i in range(20):
+            hashing.write("foo.%d:1|c" % i)
+        self.clock.advance(0)
+        lines = [line for transport in transports
+                 for line in transport.value().split("\r\n") if line]
+        self.assertEqual(sorted(lines),
+                         sorted("foo.%d:1|c" % i for i in range(20)))
+        self.assertTrue(all(transport.value() for transport in transports))
+
+    def test_delivers_to_server(self):
+        """Messages reach a L{StatsDTCPServerProtocol}, including those
+        written before the connection is made."""
+        processor = CollectingProcessor(200)
+        port = reactor.listenTCP(0, StatsDTCPServerFactory(processor),
+                                 interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        client = TCPStatsDClient("127.0.0.1", port.getHost().port,
+                                 max_size=512)
+        client.connect()
+        self.addCleanup(client.disconnect)
+        for i in range(200):
+            client.write("foo:%d|c" % i)
+
+        def check(messages):
+            self.assertEqual(messages, ["foo:%d|c" % i for i in range(200)])
+        return processor.done.addCallback(check)
+
+
+class TCPStatsDClientBenchmark(TestCase):
+
+    @inlineCallbacks
+    def test_throughput(self):
+        """Report the metrics per second processed by the server over TCP,
+        writing while the transport isn't paused, and the metrics per
+        second sent over UDP."""
+        count = 200000
+        processor = CollectingProcessor(count)
+        port = reactor.listenTCP(0, StatsDTCPServerFactory(processor),
+                                 interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        paused = []
+        client = TCPStatsDClient(
+            "127.0.0.1", port.getHost().port,
+            pause_callback=lambda: paused.append(True),
+            resume_callback=paused.pop)
+        client.connect()
+        self.addCleanup(client.disconnect)
+        while not client.writable():
+            yield deferLater(reactor, 0.01, lambda: None)
+        start = time.time()
+        written = 0
+        while written < count:
+            while written < count and not paused:
+                client.write("some.metric.name:1|c")
+                written += 1
+            yield deferLater(reactor, 0, lambda: None)
+        yield processor.done
+        stats = client.report_stats()
+        sys.stdout.write("tcp: %d metrics per second processed, "
+                         "%d dropped\n" %
+                         (count / (time.time() - start), stats["drops"]))
+
+        processor = CollectingProcessor(count)
+        port = reactor.listenUDP(0, StatsDServerProtocol(processor),
+                                 interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        client = TwistedStatsDClient("127.0.0.1", port.getHost().port,
+                                     max_size=1400)
+        udp_port = reactor.listenUDP(0, StatsDClientProtocol(client))
+        self.addCleanup(udp_port.stopListening)
+        start = time.time()
+        for i in range(count // 1000):
+            for j in range(1000):
+                client.write("some.metric.name:1|c")
+            yield deferLater(reactor, 0, lambda: None)
+        yield deferLater(reactor, 1, lambda: None)
+        elapsed = time.time() - start - 1
+        sys.stdout.write("udp: %d metrics per second processed, "
+                         "%d lost\n" %
+                         (len(processor.messages) / elapsed,
+                          count - len(processor.messages)))
+    test_throughput.skip = "benchmark, run manually"
+
 
 class TestConsistentHashingClient(TestCase):
 
@@ -428,6 +1415,18 @@ class TestConsistentHashingClient(TestCase):
         self.assertEqual(clients[1].data, ["foo:1"])
         self.assertEqual(clients[2].data, ["dba:1"])
 
+    def test_jump_hash_with_three_clients(self):
+        clients = [
+            FakeClient("127.0.0.1", 10001),
+            FakeClient("127.0.0.1", 10002),
+            FakeClient("127.0.0.1", 10003),
+            ]
+        client = ConsistentHashingClient(clients, strategy="jump")
+        for i in range(30):
+            Metric(client, "foo%d" % i).send("1")
+        self.assertEqual(sum(len(c.data) for c in clients), 30)
+        self.assertTrue(all(c.data for c in clients))
+
     def test_connect_with_two_clients(self):
         clients = [
             FakeClient("127.0.0.1", 10001),
@@ -449,6 +1448,142 @@ class TestConsistentHashingClient(TestCase):
         self.assertTrue(clients[1].disconnect_called)
 
 
+class FailingClient(FakeClient):
+
+    def __init__(self, host, port):
+        FakeClient.__init__(self, host, port)
+        self.failing = False
+
+    def write(self, data):
+        if self.failing:
+            raise socket.error("connection refused")
+        return FakeClient.write(self, data)
+
+
+class HealthTrackingConsistentHashingClientTest(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.clients = [FailingClient("127.0.0.1", 10001 + i)
+                        for i in range(3)]
+        self.healthy = set(self.clients)
+        self.client = ConsistentHashingClient(
+            self.clients, failure_threshold=2, retry_interval=10,
+            heartbeat=self.healthy.__contains__,
+            wall_time_func=lambda: self.now)
+
+    def send(self, count=30):
+        for i in range(count):
+            Metric(self.client, "foo%d" % i).send("1")
+
+    def test_failing_client_routed_around(self):
+        """
+        A client whose writes fail is marked down, and its metrics go to
+        the next clients, counted as failovers.
+        """
+        self.send()
+        before = [len(c.data) for c in self.clients]
+        for c in self.clients:
+            c.data = []
+        self.clients[0].failing = True
+        self.send()
+        self.assertEqual(self.client.ring.down, set([self.clients[0]]))
+        self.assertEqual(self.clients[0].data, [])
+        self.assertEqual(sum(len(c.data) for c in self.clients), 29)
+        self.assertEqual(self.client.report_stats(),
+                         {"failovers": before[0] - 1,
+                          "write_failures": 2, "nodes_down": 1})
+
+    def test_failures_in_a_row(self):
+        """
+        Only failures in a row mark a client down.
+        """
+        node = self.client.ring.get_node("bar")
+        self.client.write_failed(node)
+        self.client.write(b"bar:1|c")
+        self.client.write_failed(node)
+        self.assertEqual(self.client.ring.down, set())
+
+    def test_restored_after_retry_interval(self):
+        """
+        A client marked down is marked up again after the retry interval
+        when its heartbeat succeeds, and tried again later otherwise.
+        """
+        self.client.mark_down(self.clients[0])
+        self.healthy.discard(self.clients[0])
+        self.now = 10
+        self.send()
+        self.assertEqual(self.clients[0].data, [])
+        self.healthy.add(self.clients[0])
+        self.now = 15
+        self.send()
+        self.assertEqual(self.clients[0].data, [])
+        self.now = 20
+        self.send()
+        self.assertNotEqual(self.clients[0].data, [])
+        self.assertEqual(self.client.ring.down, set())
+        self.assertEqual(self.client.next_retry, None)
+
+    def test_check_health(self):
+        """
+        Clients are marked up or down according to their heartbeat.
+        """
+        self.healthy.discard(self.clients[1])
+        self.client.check_health()
+        self.assertEqual(self.client.ring.down, set([self.clients[1]]))
+        self.healthy.add(self.clients[1])
+        self.client.check_health()
+        self.assertEqual(self.client.ring.down, set())
+
+    def test_dropped_write_is_a_failure(self):
+        """
+        A client returning C{None} from a write dropped the metric, which
+        counts as a failure like an exception does.
+        """
+        self.clients[0].write = lambda data: None
+        self.send()
+        self.assertEqual(self.client.ring.down, set([self.clients[0]]))
+        self.assertEqual(sum(len(c.data) for c in self.clients), 29)
+        self.assertEqual(self.client.report_stats()["write_failures"], 2)
+
+    def test_health_checks(self):
+        """
+        Health checks run every interval until disconnected, reporting
+        the statistics if asked to.
+        """
+        clock = Clock()
+        reported = []
+        self.client.start_health_checks(
+            5, report_function=lambda name, value: reported.append(
+                (name, value)),
+            clock=clock)
+        self.healthy.discard(self.clients[2])
+        clock.advance(4)
+        self.assertEqual(self.client.ring.down, set())
+        clock.advance(1)
+        self.assertEqual(self.client.ring.down, set([self.clients[2]]))
+        self.assertEqual(sorted(reported),
+                         [("failovers", 0), ("nodes_down", 1),
+                          ("write_failures", 0)])
+        self.client.disconnect()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_default_heartbeat(self):
+        """
+        By default, clients are healthy according to their C{healthy}
+        method, if they have one.
+        """
+        clients = [txstatsd.client.UdpStatsDClient("127.0.0.1", 8125),
+                   FakeClient("127.0.0.1", 10001)]
+        client = ConsistentHashingClient(clients)
+        client.check_health()
+        self.assertEqual(client.ring.down, set([clients[0]]))
+        clients[0].connect()
+        self.addCleanup(clients[0].disconnect)
+        client.check_health()
+        self.assertEqual(client.ring.down, set())
+
+
 class DummyTransport(object):
     def stopListening(self):
         pass
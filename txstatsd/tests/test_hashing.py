@@ -0,0 +1,233 @@
+# Copyright (C) 2011-2012 Canonical Services Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Tests for the consistent hash rings."""
+
+import bisect
+from hashlib import md5
+
+from twisted.trial.unittest import TestCase
+
+from txstatsd.hashing import (
+    ConsistentHashRing, HealthTrackedRing, JumpHashRing, jump_hash)
+
+
+def reference_ring(nodes, replica_count):
+    """Build a ring the way it used to be built, one insort at a time."""
+    ring = []
+    for node in nodes:
+        for i in range(replica_count):
+            replica_key = "%s:%d" % (node, i)
+            position = int(md5(replica_key).hexdigest()[:8], 16)
+            bisect.insort(ring, (position, node))
+    return ring
+
+
+def count_nodes(ring, keys):
+    """Count the keys going to each node of C{ring}."""
+    counts = {}
+    for key in keys:
+        node = ring.get_node(key)
+        counts[node] = counts.get(node, 0) + 1
+    return counts
+
+
+class ConsistentHashRingTest(TestCase):
+
+    def setUp(self):
+        self.nodes = ["node%d" % i for i in range(5)]
+
+    def test_md5_compatible(self):
+        """
+        With md5 hashing, the ring is the same as it always was.
+        """
+        ring = ConsistentHashRing(self.nodes, replica_count=64)
+        self.assertEqual(ring.ring, reference_ring(self.nodes, 64))
+
+    def test_get_nodes(self):
+        """
+        All the nodes are returned, starting with the one for the key.
+        """
+        ring = ConsistentHashRing(self.nodes)
+        for i in range(100):
+            key = "some.metric.%d" % i
+            nodes = ring.get_nodes(key)
+            self.assertEqual(nodes[0], ring.get_node(key))
+            self.assertEqual(sorted(nodes), self.nodes)
+
+    def test_crc32_distribution(self):
+        """
+        Keys are spread evenly with crc32 hashing.
+        """
+        ring = ConsistentHashRing(self.nodes, hash_type="crc32")
+        counts = count_nodes(ring, ("some.metric.%d" % i
+                                    for i in range(10000)))
+        self.assertEqual(sorted(counts), self.nodes)
+        for count in counts.values():
+            self.assertTrue(1500 < count < 2500, counts)
+
+    def test_unknown_hash_type(self):
+        """
+        Unknown hash types are rejected.
+        """
+        self.assertRaises(ValueError, ConsistentHashRing, self.nodes,
+                          hash_type="sha1")
+
+    def test_bounded_cache(self):
+        """
+        The lookup cache doesn't grow over its size.
+        """
+        ring = ConsistentHashRing(self.nodes, cache_size=10)
+        for i in range(25):
+            ring.get_node("some.metric.%d" % i)
+        self.assertTrue(len(ring.cache) <= 10)
+
+    def test_remove_node_clears_cache(self):
+        """
+        Keys are looked up again when nodes change.
+        """
+        ring = ConsistentHashRing(self.nodes)
+        node = ring.get_node("foo")
+        ring.remove_node(node)
+        self.assertNotEqual(ring.get_node("foo"), node)
+
+
+class JumpHashRingTest(TestCase):
+
+    def setUp(self):
+        self.nodes = ["node%d" % i for i in range(10)]
+        self.keys = ["some.metric.%d" % i for i in range(20000)]
+
+    def test_distribution(self):
+        """
+        Keys are spread evenly over the nodes.
+        """
+        ring = JumpHashRing(self.nodes)
+        counts = count_nodes(ring, self.keys)
+        self.assertEqual(sorted(counts), self.nodes)
+        expected = len(self.keys) / len(self.nodes)
+        for count in counts.values():
+            self.assertTrue(abs(count - expected) < expected * 0.05, counts)
+
+    def test_remap_fraction(self):
+        """
+        Adding a node only moves the keys it takes over, about 1/(N + 1)
+        of them.
+        """
+        ring = JumpHashRing(self.nodes)
+        before = [ring.get_node(key) for key in self.keys]
+        ring.add_node("node10")
+        after = [ring.get_node(key) for key in self.keys]
+        moved = [new for old, new in zip(before, after) if old != new]
+        self.assertEqual(set(moved), set(["node10"]))
+        fraction = float(len(moved)) / len(self.keys)
+        self.assertTrue(abs(fraction - 1 / 11.0) < 0.01, fraction)
+
+    def test_get_nodes(self):
+        """
+        All the nodes are returned, starting with the one for the key.
+        """
+        ring = JumpHashRing(self.nodes)
+        for key in self.keys[:100]:
+            nodes = ring.get_nodes(key)
+            self.assertEqual(nodes[0], ring.get_node(key))
+            self.assertEqual(sorted(nodes), sorted(self.nodes))
+
+    def test_jump_hash(self):
+        """
+        The buckets match the reference C++ implementation.
+        """
+        self.assertEqual([jump_hash(key, 1000) for key in (1, 2, 3, 2 ** 40)],
+                         [549, 338, 961, 145])
+
+
+class HealthTrackedRingTest(TestCase):
+
+    def setUp(self):
+        self.nodes = ["node%d" % i for i in range(5)]
+        self.keys = ["some.metric.%d" % i for i in range(1000)]
+        self.ring = HealthTrackedRing(ConsistentHashRing(self.nodes))
+
+    def test_only_keys_of_down_node_move(self):
+        """
+        The keys of a node marked down go to their next node, the others
+        stay put, and the ring is not rebuilt.
+        """
+        before = dict((key, self.ring.get_node(key)) for key in self.keys)
+        positions = self.ring.ring.positions
+        self.ring.mark_down("node2")
+        for key in self.keys:
+            node = self.ring.get_node(key)
+            if before[key] == "node2":
+                self.assertEqual(node, [n for n in self.ring.ring.get_nodes(
+                    key) if n != "node2"][0])
+            else:
+                self.assertEqual(node, before[key])
+        self.assertTrue(self.ring.ring.positions is positions)
+        self.assertEqual(
+            self.ring.failovers,
+            len([key for key in self.keys if before[key] == "node2"]))
+
+    def test_mark_up(self):
+        """
+        Keys go back to a node marked up.
+        """
+        before = [self.ring.get_node(key) for key in self.keys]
+        self.ring.mark_down("node2")
+        self.ring.mark_down("node3")
+        self.ring.mark_up("node2")
+        self.ring.mark_up("node3")
+        self.assertEqual([self.ring.get_node(key) for key in self.keys],
+                         before)
+
+    def test_all_down(self):
+        """
+        When all the nodes are down, keys go to their own node.
+        """
+        for node in self.nodes:
+            self.ring.mark_down(node)
+        self.assertEqual(self.ring.get_node("foo"),
+                         self.ring.ring.get_node("foo"))
+        self.assertEqual(self.ring.failovers, 0)
+
+    def test_get_nodes(self):
+        """
+        The nodes that are up come first.
+        """
+        self.ring.mark_down("node2")
+        nodes = self.ring.get_nodes("foo")
+        self.assertEqual(sorted(nodes), self.nodes)
+        self.assertEqual(nodes[-1], "node2")
+
+    def test_jump_hash(self):
+        """
+        Jump hash rings are supported.
+        """
+        ring = HealthTrackedRing(JumpHashRing(self.nodes))
+        node = ring.get_node("foo")
+        ring.mark_down(node)
+        self.assertEqual(ring.get_node("foo"), ring.ring.get_nodes("foo")[1])
+
+    def test_unknown_node(self):
+        """
+        Nodes that aren't on the ring can't be marked down.
+        """
+        self.ring.mark_down("node9")
+        self.assertEqual(self.ring.down, set())
@@ -20,11 +20,20 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """Tests for the Metrics convenience class."""
 
+import os
+import random
 import re
+import sys
 import time
 from unittest import TestCase
+
+from twisted.trial.unittest import TestCase as TxTestCase
+
+from txstatsd.metrics.adaptivemetrics import AdaptiveMetrics
+from txstatsd.metrics.aggregatingmetrics import AggregatingMetrics
 from txstatsd.metrics.extendedmetrics import ExtendedMetrics
 from txstatsd.metrics.metrics import Metrics
+from txstatsd.server.processor import MessageProcessor
 
 
 class FakeStatsDClient(object):
@@ -42,6 +51,16 @@ class FakeStatsDClient(object):
         self.data = data
 
 
+class CollectingStatsDClient(FakeStatsDClient):
+
+    def __init__(self):
+        self.messages = []
+
+    def write(self, data):
+        """Collect the metric sent to the StatsD server."""
+        self.messages.append(data)
+
+
 class TestMetrics(TestCase):
 
     def setUp(self):
@@ -131,6 +150,35 @@ class TestMetrics(TestCase):
                          b'gauge:413|g')
 
 
+    def test_handles(self):
+        """Handles report the same messages as the reporting methods."""
+        self.metrics.counter_handle('counter').mark(18)
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.counter:18|c')
+        self.metrics.gauge_handle('gauge').mark(102)
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.gauge:102|g')
+        self.metrics.meter_handle('meter').mark()
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.meter:1|m')
+        self.metrics.timing_handle('timing').mark(0.5)
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.timing:500.0|ms')
+
+    def test_handle_sample_rate(self):
+        """Handles append their sample rate to the messages sent."""
+        self.addCleanup(setattr, random, 'random', random.random)
+        handle = self.metrics.gauge_handle('gauge', sample_rate=0.5)
+        random.random = lambda: 0.4
+        handle.mark(1)
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.gauge:1|g|@0.5')
+        random.random = lambda: 0.6
+        handle.mark(2)
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.gauge:1|g|@0.5')
+
+
 class TestExtendedMetrics(TestMetrics):
     def setUp(self):
         super(TestExtendedMetrics, self).setUp()
@@ -145,6 +193,24 @@ class TestExtendedMetrics(TestMetrics):
         self.assertEqual(self.connection.data,
                          b'txstatsd.tests.counter:9|c')
 
+    def test_counter_handle(self):
+        """The counter handle shares the cumulative count."""
+        handle = self.metrics.counter_handle('counter')
+        handle.mark(18)
+        self.metrics.decrement('counter', 9)
+        handle.mark()
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.counter:10|c')
+
+    def test_handles(self):
+        """Handles report the same messages as the reporting methods."""
+        self.metrics.counter_handle('counter').mark(18)
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.counter:18|c')
+        self.metrics.timing_handle('timing').mark(0.5)
+        self.assertEqual(self.connection.data,
+                         b'txstatsd.tests.timing:500.0|ms')
+
     def test_sli(self):
         """Test SLI call."""
         self.metrics.sli('users', 100)
@@ -158,3 +224,312 @@ class TestExtendedMetrics(TestMetrics):
         self.metrics.sli_error('users')
         self.assertEqual(self.connection.data,
                          b'txstatsd.tests.users:error|sli')
+
+
+class TestAggregatingMetrics(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.connection = CollectingStatsDClient()
+        self.metrics = AggregatingMetrics(
+            self.connection, 'txstatsd.tests', flush_interval=10,
+            reservoir_size=5, wall_time_func=lambda: self.now)
+
+    def test_nothing_sent_before_interval(self):
+        """Samples are held back until the flush interval elapsed."""
+        self.metrics.increment('counter')
+        self.metrics.gauge('gauge', 1)
+        self.metrics.meter('meter')
+        self.metrics.timing('timing', 0.1)
+        self.now = 9
+        self.metrics.increment('counter')
+        self.assertEqual(self.connection.messages, [])
+
+    def test_counters_and_meters_summed(self):
+        """Counters and meters are reported once with their sum."""
+        for i in range(1000):
+            self.metrics.increment('counter', 2)
+            self.metrics.meter('meter')
+        self.metrics.decrement('counter', 500)
+        self.metrics.flush()
+        self.assertEqual(sorted(self.connection.messages),
+                         [b'txstatsd.tests.counter:1500|c',
+                          b'txstatsd.tests.meter:1000|m'])
+
+    def test_gauge_keeps_last_value(self):
+        """Only the last reading of a gauge is reported."""
+        self.metrics.gauge('gauge', 102)
+        self.metrics.gauge('gauge', 7)
+        self.metrics.flush()
+        self.assertEqual(self.connection.messages,
+                         [b'txstatsd.tests.gauge:7|g'])
+
+    def test_timings_below_reservoir_size(self):
+        """Timings are all reported while they fit in the reservoir."""
+        self.metrics.timing('timing', 0.5)
+        self.metrics.timing('timing', 2)
+        self.metrics.flush()
+        self.assertEqual(self.connection.messages,
+                         [b'txstatsd.tests.timing:500.0|ms',
+                          b'txstatsd.tests.timing:2000|ms'])
+
+    def test_timings_sampled(self):
+        """Beyond the reservoir size, a sample of the timings is reported
+        with the matching sample rate."""
+        for i in range(20):
+            self.metrics.timing('timing', i)
+        self.metrics.flush()
+        self.assertEqual(len(self.connection.messages), 5)
+        for message in self.connection.messages:
+            name, value, kind, rate = message.split(b"|")[0].split(b":") + \
+                message.split(b"|")[1:]
+            self.assertEqual(name, b'txstatsd.tests.timing')
+            self.assertTrue(0 <= float(value) < 20000)
+            self.assertEqual(kind, b'ms')
+            self.assertEqual(rate, b'@0.25')
+
+    def test_timings_sampled_at_low_rate(self):
+        """Sample rates below 1e-4 are reported without the exponent
+        notation."""
+        for i in range(100000):
+            self.metrics.timing('timing', 0.001)
+        self.metrics.flush()
+        self.assertEqual(self.connection.messages,
+                         [b'txstatsd.tests.timing:1.0|ms|@0.00005'] * 5)
+
+    def test_flush_on_interval(self):
+        """Aggregates are reported by the first call after the interval
+        and reset."""
+        self.metrics.increment('counter')
+        self.now = 10
+        self.metrics.increment('counter')
+        self.assertEqual(self.connection.messages,
+                         [b'txstatsd.tests.counter:2|c'])
+        self.metrics.flush()
+        self.assertEqual(self.connection.messages,
+                         [b'txstatsd.tests.counter:2|c'])
+        self.now = 15
+        self.metrics.gauge('gauge', 3)
+        self.now = 20
+        self.metrics.increment('counter')
+        self.assertEqual(self.connection.messages[0],
+                         b'txstatsd.tests.counter:2|c')
+        self.assertEqual(sorted(self.connection.messages[1:]),
+                         [b'txstatsd.tests.counter:1|c',
+                          b'txstatsd.tests.gauge:3|g'])
+
+    def test_handles(self):
+        """Samples marked on handles are aggregated too."""
+        counter = self.metrics.counter_handle('counter')
+        for i in range(10):
+            counter.mark()
+        self.metrics.increment('counter', 5)
+        self.metrics.gauge_handle('gauge').mark(3)
+        self.metrics.meter_handle('meter').mark(2)
+        self.metrics.timing_handle('timing').mark(0.5)
+        self.metrics.flush()
+        self.assertEqual(sorted(self.connection.messages),
+                         [b'txstatsd.tests.counter:15|c',
+                          b'txstatsd.tests.gauge:3|g',
+                          b'txstatsd.tests.meter:2|m',
+                          b'txstatsd.tests.timing:500.0|ms'])
+
+    def test_flush_when_idle(self):
+        """Aggregates are reported once the interval elapsed even if no
+        more samples come in."""
+        metrics = AggregatingMetrics(
+            self.connection, 'txstatsd.tests', flush_interval=0.05)
+        metrics.increment('counter')
+        deadline = time.time() + 5
+        while not self.connection.messages and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.connection.messages,
+                         [b'txstatsd.tests.counter:1|c'])
+
+    def test_fork(self):
+        """A forked process reports its own aggregates only."""
+        self.metrics.increment('counter', 5)
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_end)
+                self.connection.messages = []
+                self.metrics.increment('counter', 2)
+                self.metrics.flush()
+                os.write(write_end, b"\n".join(self.connection.messages))
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        os.waitpid(pid, 0)
+        child_messages = os.read(read_end, 1024)
+        os.close(read_end)
+
+        self.assertEqual(child_messages, b'txstatsd.tests.counter:2|c')
+        self.metrics.flush()
+        self.assertEqual(self.connection.messages,
+                         [b'txstatsd.tests.counter:5|c'])
+
+    def test_passthrough(self):
+        """Metrics without local aggregation are sent right away."""
+        self.metrics.report('users', "pepe", "pd")
+        self.assertEqual(self.connection.messages,
+                         [b'txstatsd.tests.users:pepe|pd'])
+
+
+class TestAdaptiveMetrics(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.connection = CollectingStatsDClient()
+        self.metrics = AdaptiveMetrics(
+            self.connection, 'txstatsd.tests', budget=10, window=1,
+            wall_time_func=lambda: self.now)
+        self.metrics.random.seed(0)
+
+    def test_within_budget(self):
+        """Metrics within their budget are all sent, without a rate."""
+        for i in range(10):
+            self.metrics.increment('counter')
+            self.metrics.timing('timing', 0.1)
+        self.now = 1
+        for i in range(10):
+            self.metrics.increment('counter')
+        self.assertEqual(self.connection.messages.count(
+            b'txstatsd.tests.counter:1|c'), 20)
+        self.assertEqual(self.connection.messages.count(
+            b'txstatsd.tests.timing:100.0|ms'), 10)
+        self.assertEqual(self.metrics.sample_rate('txstatsd.tests.counter'),
+                         1)
+
+    def test_spike_within_window(self):
+        """A metric that spends its budget early in the window is sampled
+        right away, and its samples are tagged with the rate."""
+        for i in range(10):
+            self.metrics.increment('counter')
+        self.now = 0.1
+        for i in range(1000):
+            self.metrics.increment('counter')
+        rate = self.metrics.sample_rate('txstatsd.tests.counter')
+        self.assertTrue(rate <= 10 / 110.)
+        self.assertTrue(len(self.connection.messages) < 40)
+        for message in self.connection.messages[10:]:
+            self.assertTrue(
+                re.match(br'txstatsd.tests.counter:1\|c\|@0\.\d+$', message),
+                message)
+
+    def test_rate_follows_last_window(self):
+        """The rate is set from the samples seen in the last window, and
+        goes back up when the traffic drops."""
+        for i in range(100):
+            self.metrics.increment('counter')
+        self.now = 1
+        self.metrics.increment('counter')
+        self.assertEqual(self.metrics.sample_rate('txstatsd.tests.counter'),
+                         0.1)
+        self.now = 2
+        self.metrics.increment('counter')
+        self.assertEqual(self.metrics.sample_rate('txstatsd.tests.counter'),
+                         1)
+        self.now = 2.5
+        for i in range(100):
+            self.metrics.increment('counter')
+        self.now = 4
+        self.metrics.increment('counter')
+        self.assertEqual(self.metrics.sample_rate('txstatsd.tests.counter'),
+                         1)
+        self.assertEqual(self.connection.messages[-1],
+                         b'txstatsd.tests.counter:1|c')
+
+    def test_metrics_sampled_separately(self):
+        """Each metric has its own budget."""
+        for i in range(100):
+            self.metrics.increment('busy')
+        self.metrics.increment('quiet')
+        self.assertEqual(self.connection.messages[-1],
+                         b'txstatsd.tests.quiet:1|c')
+        self.assertEqual(self.metrics.sample_rate('txstatsd.tests.quiet'), 1)
+
+    def test_server_counters_stay_correct(self):
+        """Counters and meters sent at 10 times the budget add up on the
+        server, from about the budget of messages per window."""
+        self.metrics.budget = 100
+        processor = MessageProcessor()
+        meters = 0
+        counter = self.metrics.counter_handle('handle')
+        for i in range(10000):
+            self.now = i / 1000.
+            self.metrics.increment('counter', 2)
+            self.metrics.meter('meter')
+            counter.mark()
+        for message in self.connection.messages:
+            message = message.decode('utf-8')
+            if message.endswith('|m'):
+                meters += float(message.split(':')[1][:-2])
+            else:
+                processor.process(message)
+        self.assertTrue(len(self.connection.messages) < 3 * 2 * 100 * 10)
+        counters = processor.counter_metrics
+        self.assertTrue(
+            18000 < counters['txstatsd.tests.counter'] < 22000, counters)
+        self.assertTrue(9000 < counters['txstatsd.tests.handle'] < 11000,
+                        counters)
+        self.assertTrue(9000 < meters < 11000, meters)
+
+    def test_low_rates_without_exponent(self):
+        """Rates below 1e-4 are sent without the exponent notation, so that
+        the server scales the samples by the right rate."""
+        self.metrics.sample = lambda name: 0.00001
+        self.metrics.increment('counter', 2)
+        self.metrics.timing('timing', 0.5)
+        self.assertEqual(self.connection.messages,
+                         [b'txstatsd.tests.counter:2|c|@0.00001',
+                          b'txstatsd.tests.timing:500.0|ms|@0.00001'])
+        processor = MessageProcessor()
+        processor.process(self.connection.messages[0].decode('utf-8'))
+        self.assertEqual(
+            round(processor.counter_metrics['txstatsd.tests.counter']),
+            200000)
+
+    def test_sampled_formats(self):
+        """Sampled timings are tagged with the rate, sampled meters are
+        scaled up and sampled gauges are sent as they are."""
+        for i in range(1000):
+            self.metrics.timing('timing', 0.1)
+            self.metrics.meter('meter', 2)
+            self.metrics.gauge('gauge', 3)
+        self.now = 1
+        self.metrics.random.random = lambda: 0
+        self.metrics.timing('timing', 0.1)
+        self.metrics.meter('meter', 2)
+        self.metrics.gauge('gauge', 3)
+        self.assertEqual(self.connection.messages[-3:],
+                         [b'txstatsd.tests.timing:100.0|ms|@0.01',
+                          b'txstatsd.tests.meter:200.0|m',
+                          b'txstatsd.tests.gauge:3|g'])
+
+
+class MetricsBenchmark(TxTestCase):
+
+    def test_calls_per_second(self):
+        """Report the calls per second of the reporting methods and of the
+        equivalent handles."""
+        count = 200000
+        for cls in (Metrics, ExtendedMetrics, AggregatingMetrics,
+                    AdaptiveMetrics):
+            metrics = cls(FakeStatsDClient(), 'txstatsd.tests')
+            counter = metrics.counter_handle('counter')
+            timing = metrics.timing_handle('timing')
+            for label, call in (
+                    ("increment", lambda: metrics.increment('counter')),
+                    ("counter_handle", lambda: counter.mark()),
+                    ("timing", lambda: metrics.timing('timing', 0.1)),
+                    ("timing_handle", lambda: timing.mark(0.1))):
+                start = time.time()
+                for i in range(count):
+                    call()
+                elapsed = time.time() - start
+                sys.stdout.write("%s.%s: %d calls per second\n" %
+                                 (cls.__name__, label, count / elapsed))
+
+    test_calls_per_second.skip = "benchmark, run manually"
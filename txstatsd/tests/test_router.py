@@ -19,16 +19,25 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import sys
+import time
 from unittest import TestCase
 
 from twisted.internet.protocol import DatagramProtocol, Factory
+from twisted.plugin import getPlugins
 from twisted.protocols.basic import LineReceiver
 from twisted.application.service import MultiService
 from twisted.internet import reactor, defer
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial.unittest import TestCase as TxTestCase
 
+from txstatsd.itxstatsd import IMetricFactory
+from txstatsd.protocol import MessageBuffer
 from txstatsd.server.processor import MessageProcessor
-from txstatsd.server.router import Router
+from txstatsd.server.router import (
+    Router, HashRedirect, TCPRedirectClientFactory, TCPRedirectService,
+    compile_globs, redirect, with_sample_rate)
 
 
 class TestMessageProcessor(object):
@@ -171,6 +180,529 @@ class RouteMessagesTest(TestCase):
         self.assertEqual(self.processor.messages[0][2], "gorets")
 
 
+class CompileRulesTest(TestCase):
+
+    def setUp(self):
+        self.processor = TestMessageProcessor()
+        self.router = Router(self.processor, "")
+
+    def test_compile_globs(self):
+        """
+        Several glob expressions are compiled into a single expression that
+        matches if any of them does.
+        """
+        match = compile_globs(["goret*", "glork.?"]).match
+        self.assertTrue(match("gorets"))
+        self.assertTrue(match("glork.a"))
+        self.assertFalse(match("glork.ab"))
+        self.assertFalse(match("nomatch"))
+
+    def test_merge_consecutive_drops(self):
+        """
+        Consecutive drop rules are merged into a single rule.
+        """
+        rules = self.router.build_rules(
+            "path_like goret* => drop\n"
+            "path_like glork* => drop\n"
+            "metric_type ms => drop\n")
+        self.assertEqual(len(rules), 1)
+        self.router.rules = rules
+        self.router.process("gorets:1|c")
+        self.router.process("glork:1|c")
+        self.router.process("timer:1|ms")
+        self.router.process("nomatch:1|c")
+        self.assertEqual(len(self.processor.messages), 1)
+        self.assertEqual(self.processor.messages[0][2], "nomatch")
+
+    def test_merge_preserves_order(self):
+        """
+        Drop rules are not merged across other rules, so a rewrite still
+        sees the metrics dropped before and after it in order.
+        """
+        rules = self.router.build_rules(
+            "path_like goret* => drop\n"
+            "any => rewrite (nomatch) goret.\\1\n"
+            "path_like glork* => drop\n")
+        self.assertEqual(len(rules), 3)
+        self.router.rules = rules
+        self.router.process("gorets:1|c")
+        self.router.process("nomatch:1|c")
+        self.assertEqual(len(self.processor.messages), 1)
+        self.assertEqual(self.processor.messages[0][2], "goret.nomatch")
+
+    def test_merge_not_condition(self):
+        """
+        Negated conditions are kept as separate rules.
+        """
+        rules = self.router.build_rules(
+            "path_like goret* => drop\n"
+            "not metric_type c => drop\n")
+        self.assertEqual(len(rules), 2)
+        self.router.rules = rules
+        self.router.process("gorets:1|c")
+        self.router.process("timer:1|ms")
+        self.router.process("nomatch:1|c")
+        self.assertEqual(len(self.processor.messages), 1)
+        self.assertEqual(self.processor.messages[0][2], "nomatch")
+
+    def test_any_is_not_evaluated(self):
+        """
+        Conditions that always match are compiled away.
+        """
+        rules = self.router.build_rules("any => set_metric_type d")
+        self.assertEqual(rules[0][0], None)
+
+
+class SampleTest(TestCase):
+
+    def setUp(self):
+        self.processor = TestMessageProcessor()
+
+    def test_sample(self):
+        """
+        Only the sampled fraction of the messages is processed, with the
+        sample rate set.
+        """
+        router = Router(self.processor, "path_like gorets => sample 0.25")
+        for i in range(100):
+            router.process("gorets:1|c")
+            router.process("glork:1|c")
+        gorets = [m for m in self.processor.messages if m[2] == "gorets"]
+        self.assertEqual(len(gorets), 25)
+        self.assertEqual(gorets[0][0], "gorets:1|c|@0.25")
+        self.assertEqual(gorets[0][3], ["1", "c", "@0.25"])
+        self.assertEqual(len(self.processor.messages), 125)
+
+    def test_sample_stops_processing(self):
+        """
+        Sampled messages are not passed on to further rules.
+        """
+        router = Router(self.processor, "any => sample 0.5\nany => drop")
+        router.process("gorets:1|c")
+        router.process("gorets:1|c")
+        self.assertEqual(len(self.processor.messages), 1)
+
+    def test_sample_keys_evenly(self):
+        """
+        Interleaved keys are all sampled.
+        """
+        router = Router(self.processor, "any => sample 0.5")
+        for i in range(10):
+            router.process("gorets:1|c")
+            router.process("glork:1|c")
+        keys = [m[2] for m in self.processor.messages]
+        self.assertEqual(keys.count("gorets"), 5)
+        self.assertEqual(keys.count("glork"), 5)
+
+    def test_counter_scaled_back(self):
+        """
+        Counters sampled by the router are scaled back by the processor.
+        """
+        processor = MessageProcessor()
+        router = Router(processor, "any => sample 0.1")
+        for i in range(100):
+            router.process("gorets:1|c|@0.5")
+        self.assertAlmostEqual(processor.counter_metrics["gorets"], 200)
+
+    def test_meter_scaled_up(self):
+        """
+        Meters sampled by the router are scaled up, as the processor
+        ignores their sample rate.
+        """
+        router = Router(self.processor, "any => sample 0.25")
+        for i in range(100):
+            router.process("gorets:1|m")
+        self.assertEqual(len(self.processor.messages), 25)
+        self.assertEqual(self.processor.messages[0][0], "gorets:4.0|m")
+        self.assertEqual(self.processor.messages[0][3], ["4.0", "m"])
+
+    def test_meter_count_kept(self):
+        """
+        The meter count is kept by the processor.
+        """
+        processor = MessageProcessor()
+        router = Router(processor, "any => sample 0.25")
+        for i in range(100):
+            router.process("gorets:1|m")
+        self.assertEqual(processor.meter_metrics["gorets"].value, 100)
+
+    def test_other_types_not_sampled(self):
+        """
+        Timers, gauges and plugin metrics are passed on unchanged.
+        """
+        router = Router(self.processor, "any => sample 0.5\nany => drop")
+        for i in range(10):
+            router.process("timer:10|ms")
+            router.process("gauge:3|g")
+            router.process("sli:10|sli|200")
+        messages = self.processor.messages
+        self.assertEqual(len(messages), 30)
+        self.assertEqual(messages[:3],
+                         [("timer:10|ms", "ms", "timer", ["10", "ms"]),
+                          ("gauge:3|g", "g", "gauge", ["3", "g"]),
+                          ("sli:10|sli|200", "sli", "sli", ["10", "sli", "200"])])
+
+    def test_plugin_metric_processed(self):
+        """
+        Plugin metrics, whose third field isn't a sample rate, are
+        processed.
+        """
+        processor = MessageProcessor(plugins=getPlugins(IMetricFactory))
+        router = Router(processor, "any => sample 0.5")
+        router.process("sli:10|sli|200")
+        router.process("sli:10|sli|200")
+        self.assertEqual(processor.plugin_metrics["sli"].count, 2)
+
+    def test_with_sample_rate(self):
+        """
+        The sample rate is combined with the one already in the message.
+        """
+        self.assertEqual(with_sample_rate(["1", "c"], 0.1),
+                         ["1", "c", "@0.1"])
+        self.assertEqual(with_sample_rate(["1", "c", "@0.5"], 0.1),
+                         ["1", "c", "@0.05"])
+        self.assertEqual(with_sample_rate(["1", "c"], 0.00001),
+                         ["1", "c", "@0.00001"])
+
+    def test_invalid_rate(self):
+        """
+        The sample rate must be a fraction.
+        """
+        self.assertRaises(ValueError, Router, self.processor,
+                          "any => sample 2")
+        self.assertRaises(ValueError, Router, self.processor,
+                          "any => sample 0")
+
+
+class RecordingRouter(Router):
+
+    def __init__(self, *args, **kwargs):
+        self.recorded = []
+        self.recorded_messages = []
+        Router.__init__(self, *args, **kwargs)
+
+    def build_target_record(self):
+        @redirect
+        def record_target(metric_type, key, fields, message):
+            self.recorded.append((metric_type, key, fields))
+            self.recorded_messages.append(message)
+        return record_target
+
+
+class DecisionCacheTest(TestCase):
+
+    def setUp(self):
+        self.processor = TestMessageProcessor()
+        self.router = RecordingRouter(
+            self.processor,
+            "path_like goret* => rewrite (gorets) glork.\\1 dup\n"
+            "path_like glork* => record\n"
+            "metric_type ms => drop\n")
+
+    def test_repeated_keys_hit_cache(self):
+        """
+        The routing decision for a repeated key comes from the cache.
+        """
+        self.router.process("gorets:1|c")
+        self.router.process("gorets:2|c")
+        self.router.process("gorets:3|ms")
+        self.assertEqual(self.router.cache_misses, 2)
+        self.assertEqual(self.router.cache_hits, 1)
+        self.assertEqual(
+            [(m[1], m[2], m[3]) for m in self.processor.messages],
+            [("c", "gorets", ["1", "c"]),
+             ("c", "glork.gorets", ["1", "c"]),
+             ("c", "gorets", ["2", "c"]),
+             ("c", "glork.gorets", ["2", "c"])])
+
+    def test_redirects_run_for_every_message(self):
+        """
+        Redirects are performed for every message, cached or not.
+        """
+        self.router.process("gorets:1|c")
+        self.router.process("gorets:2|c")
+        self.assertEqual(self.router.recorded,
+                         [("c", "glork.gorets", ["1", "c"]),
+                          ("c", "glork.gorets", ["2", "c"])])
+
+    def test_setting_rules_clears_cache(self):
+        """
+        Replacing the rules discards the cached decisions.
+        """
+        self.router.process("gorets:1|c")
+        self.router.rules = self.router.build_rules("any => drop")
+        self.router.process("gorets:1|c")
+        self.assertEqual(len(self.processor.messages), 2)
+        self.assertEqual(self.router.cache_misses, 2)
+
+    def test_cache_disabled(self):
+        """
+        A cache size of 0 evaluates the rules for every message.
+        """
+        router = Router(self.processor, "any => drop", cache_size=0)
+        router.process("gorets:1|c")
+        router.process("gorets:1|c")
+        self.assertEqual(router.cache_misses, 2)
+        self.assertEqual(len(router.decisions), 0)
+
+    def test_report_stats(self):
+        """
+        The cache statistics are reported and reset.
+        """
+        self.router.process("gorets:1|c")
+        self.router.process("gorets:1|c")
+        self.router.process("gorets:1|c")
+        self.router.process("glork:1|c")
+        self.assertEqual(self.router.report_stats(),
+                         {"router.cache.hits": 2,
+                          "router.cache.misses": 2,
+                          "router.cache.size": 2,
+                          "router.cache.hit_rate": 0.5})
+        self.assertEqual(self.router.report_stats(),
+                         {"router.cache.hits": 0,
+                          "router.cache.misses": 0,
+                          "router.cache.size": 2,
+                          "router.cache.hit_rate": 0})
+
+
+class MessageReuseTest(TestCase):
+
+    def setUp(self):
+        self.processor = TestMessageProcessor()
+        self.router = RecordingRouter(
+            self.processor,
+            "path_like goret* => rewrite (gorets) glork.\\1 dup\n"
+            "path_like glork* => record\n"
+            "path_like gorets => set_metric_type g\n")
+        self.rebuilt = []
+        rebuild_message = self.router.rebuild_message
+
+        def counting_rebuild(metric_type, key, fields):
+            self.rebuilt.append(key)
+            return rebuild_message(metric_type, key, fields)
+        self.router.rebuild_message = counting_rebuild
+
+    def test_unchanged_key_reuses_message(self):
+        """
+        A message whose key is not rewritten is passed on as received, even
+        if its metric type changes.
+        """
+        message = "gorets:1|c"
+        self.router.process(message)
+        self.assertTrue(self.processor.messages[0][0] is message)
+        self.assertEqual(self.processor.messages[0][1], "g")
+        self.assertEqual(self.rebuilt, ["glork.gorets"])
+
+    def test_rewritten_key_rebuilds_message(self):
+        """
+        Redirects and the message processor get the message rebuilt with
+        the rewritten key.
+        """
+        self.router.process("gorets:1|c")
+        self.assertEqual(self.router.recorded_messages, ["glork.gorets:1|c"])
+        self.assertEqual(self.processor.messages[1][0], "glork.gorets:1|c")
+
+    def test_normalized_key_rebuilds_message(self):
+        """
+        A message with surrounding whitespace or a key that was normalized
+        is rebuilt before being passed on.
+        """
+        self.router.process("gor/ets:1|c\n")
+        self.router.process("gorets:1|c\n")
+        self.assertEqual(
+            [m[0] for m in self.processor.messages],
+            ["gor-ets:1|c", "gorets:1|c", "glork.gorets:1|c"])
+
+
+class HashRedirectTest(TestCase):
+
+    def setUp(self):
+        self.health = {"a": True, "b": True, "c": True}
+        self.hash_redirect = HashRedirect(dict(
+            (name, (name, lambda name=name: self.health[name]))
+            for name in self.health))
+        self.keys = ["metric%d" % i for i in range(100)]
+
+    def test_spreads_keys(self):
+        """
+        Keys are spread over all destinations, consistently.
+        """
+        senders = [self.hash_redirect.get_sender(key) for key in self.keys]
+        self.assertEqual(set(senders), set(["a", "b", "c"]))
+        self.assertEqual(
+            senders, [self.hash_redirect.get_sender(key)
+                      for key in self.keys])
+
+    def test_failover(self):
+        """
+        Only keys of an unhealthy destination move, to the next healthy
+        destination on the ring.
+        """
+        before = [self.hash_redirect.get_sender(key) for key in self.keys]
+        self.health["b"] = False
+        after = [self.hash_redirect.get_sender(key) for key in self.keys]
+        moved = 0
+        for key, old, new in zip(self.keys, before, after):
+            if old == "b":
+                moved += 1
+                self.assertEqual(
+                    new, [n for n in self.hash_redirect.ring.get_nodes(key)
+                          if n != "b"][0])
+            else:
+                self.assertEqual(old, new)
+        self.assertEqual(self.hash_redirect.report_stats(),
+                         {"failovers": moved})
+        self.assertEqual(self.hash_redirect.report_stats(),
+                         {"failovers": 0})
+
+    def test_no_healthy_destination(self):
+        """
+        When no destination is healthy, the primary one is used.
+        """
+        before = [self.hash_redirect.get_sender(key) for key in self.keys]
+        self.health.update(a=False, b=False, c=False)
+        after = [self.hash_redirect.get_sender(key) for key in self.keys]
+        self.assertEqual(before, after)
+
+    def test_failovers_cached(self):
+        """
+        The failovers of a key are looked up once while its destination is
+        unhealthy, and it goes back to it once healthy again.
+        """
+        before = [self.hash_redirect.get_sender(key) for key in self.keys]
+        ring = self.hash_redirect.ring.ring
+        lookups = []
+        get_nodes = ring.get_nodes
+
+        def counting_get_nodes(key):
+            lookups.append(key)
+            return get_nodes(key)
+        ring.get_nodes = counting_get_nodes
+        self.health["b"] = False
+        for i in range(3):
+            after = [self.hash_redirect.get_sender(key) for key in self.keys]
+        self.assertEqual(len(lookups), before.count("b"))
+        self.assertEqual(self.hash_redirect.report_stats(),
+                         {"failovers": 3 * before.count("b")})
+        self.health["b"] = True
+        self.assertEqual(
+            [self.hash_redirect.get_sender(key) for key in self.keys],
+            before)
+
+    def test_failover_unhealthy(self):
+        """
+        A failover found unhealthy is skipped, and not counted twice.
+        """
+        key = self.keys[0]
+        nodes = self.hash_redirect.ring.get_nodes(key)
+        self.health[nodes[0]] = self.health[nodes[1]] = False
+        self.assertEqual(self.hash_redirect.get_sender(key), nodes[2])
+        self.assertEqual(self.hash_redirect.report_stats(),
+                         {"failovers": 1})
+
+
+class JumpHashRedirectTest(HashRedirectTest):
+
+    def setUp(self):
+        self.health = {"a": True, "b": True, "c": True}
+        self.hash_redirect = HashRedirect(dict(
+            (name, (name, lambda name=name: self.health[name]))
+            for name in self.health), "jump", ["c", "a", "b"])
+        self.keys = ["metric%d" % i for i in range(100)]
+
+    def test_endpoint_order(self):
+        """
+        With jump, the endpoints are kept in the order they are listed.
+        """
+        endpoints = ["127.0.0.1:8127", "127.0.0.1:8125", "127.0.0.1:8126"]
+        router = Router(TestMessageProcessor(),
+                        "any => redirect_hash udp jump %s" % (
+                            " ".join(endpoints),),
+                        service=MultiService())
+        self.assertEqual(router.senders["redirect_hash.udp_0"].ring.nodes,
+                         endpoints)
+
+    def test_stats_per_rule(self):
+        """
+        Each redirect_hash rule reports its own failovers.
+        """
+        router = Router(TestMessageProcessor(),
+                        "path_like foo.* => redirect_hash udp 127.0.0.1:8125\n"
+                        "path_like bar.* => redirect_hash udp 127.0.0.1:8126",
+                        service=MultiService())
+        self.assertEqual(
+            sorted(name for name in router.senders
+                   if name.startswith("redirect_hash.")),
+            ["redirect_hash.udp_0", "redirect_hash.udp_1"])
+        stats = router.report_stats()
+        self.assertEqual(stats["router.redirect_hash.udp_0.failovers"], 0)
+        self.assertEqual(stats["router.redirect_hash.udp_1.failovers"], 0)
+
+
+class RouterBenchmark(TxTestCase):
+
+    def build_rules(self, count):
+        rules = []
+        for i in range(count):
+            if i % 3 == 0:
+                rules.append("path_like dropped%d.* => drop" % i)
+            elif i % 3 == 1:
+                rules.append("metric_type x%d => drop" % i)
+            else:
+                rules.append(r"path_like rewritten%d.* => "
+                             r"rewrite (rewritten) other" % i)
+        return "\n".join(rules)
+
+    def test_messages_per_second(self):
+        """
+        Report how many messages per second the router handles as the
+        number of rules grows.
+        """
+        messages = ["path.to.metric%d:1|c" % i for i in range(1000)]
+        for count in (0, 1, 10, 100, 1000):
+            for cache_size in (0, 100000):
+                router = Router(TestMessageProcessor(),
+                                self.build_rules(count),
+                                cache_size=cache_size)
+                start = time.time()
+                for i in range(100):
+                    for message in messages:
+                        router.process(message)
+                rate = len(messages) * 100 / (time.time() - start)
+                sys.stdout.write("%5d rules, cache %6d: %d messages/s\n" %
+                                 (count, cache_size, rate))
+    test_messages_per_second.skip = "benchmark, run manually"
+
+    def test_rebuilds_per_message(self):
+        """
+        Report how many messages per second are redirected, and how many
+        times a message is serialized again on the way.
+        """
+        messages = ["path.to.metric%d:1|c" % i for i in range(1000)]
+        router = RecordingRouter(TestMessageProcessor(),
+                                 "any => record\n"
+                                 "path_like *.metric1* => "
+                                 "rewrite (metric) other\n"
+                                 "any => record\n")
+        rebuilt = []
+        rebuild_message = router.rebuild_message
+
+        def counting_rebuild(metric_type, key, fields):
+            rebuilt.append(key)
+            return rebuild_message(metric_type, key, fields)
+        router.rebuild_message = counting_rebuild
+
+        start = time.time()
+        for i in range(100):
+            del router.recorded[:], router.recorded_messages[:]
+            for message in messages:
+                router.process(message)
+        rate = len(messages) * 100 / (time.time() - start)
+        sys.stdout.write("%d messages/s, %.3f rebuilds per message\n" %
+                         (rate, len(rebuilt) / (len(messages) * 100.0)))
+    test_rebuilds_per_message.skip = "benchmark, run manually"
+
+
 class TestUDPRedirect(TxTestCase):
 
     def setUp(self):
@@ -237,3 +769,165 @@ class TestTCPRedirect(TestUDPRedirect):
             service=self.service)
         self.service.startService()
         return self.router.ready
+
+    def test_buffered_while_paused(self):
+        """
+        Messages written while the transport is paused are buffered and
+        delivered once it resumes.
+        """
+        messages = ["gorets:1|c", "glork:2|c"]
+        received = []
+        d = defer.Deferred()
+
+        def got_data(data):
+            received.append(data)
+            if len(received) == len(messages):
+                self.assertEqual(received, messages)
+                d.callback(True)
+        self.got_data = got_data
+
+        factory = self.router.senders.values()[0]
+        factory.protocol.pauseProducing()
+        for message in messages:
+            self.router.process(message)
+        self.assertEqual(len(factory.buffer), 2)
+        factory.protocol.resumeProducing()
+        return d
+
+
+class TCPRedirectServiceTest(TxTestCase):
+
+    def test_stop_keeps_unreplayed_spill(self):
+        """
+        Stopping the service closes the buffer, leaving only the messages
+        not replayed yet in the spill file.
+        """
+        path = self.mktemp()
+        clock = Clock()
+        buffer = MessageBuffer(limit=0, spill_path=path, replay_batch=1,
+                               reactor=clock)
+        factory = TCPRedirectClientFactory(buffer=buffer, reactor=clock)
+        redirect_service = TCPRedirectService("127.0.0.1", 8125, factory,
+                                              reactor=clock)
+        for name in ("gorets", "glork", "gaugor"):
+            factory.write("%s:1|c" % (name,))
+        transport = StringTransport()
+        factory.buildProtocol(None).makeConnection(transport)
+        self.assertEqual(transport.value(), "gorets:1|c\r\n")
+
+        redirect_service.stopService()
+        self.assertEqual(buffer.spill_file, None)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        with open(path, "rb") as spill:
+            self.assertEqual(spill.read(), "glork:1|c\ngaugor:1|c\n")
+
+
+class TestBatchedUDPRedirect(TestUDPRedirect):
+
+    def setUp(self):
+        self.service = MultiService()
+        self.received = []
+
+        class Collect(DatagramProtocol):
+
+            def datagramReceived(cself, data, host_port):
+                self.got_data(data)
+
+        self.port = reactor.listenUDP(0, Collect())
+
+        self.processor = TestMessageProcessor()
+        self.router = Router(self.processor,
+            r"any => redirect_udp 127.0.0.1 %s 512 10" %
+            (self.port.getHost().port,),
+            service=self.service)
+        self.service.startService()
+        return self.router.ready
+
+    def test_redirect_batched(self):
+        """
+        Messages are packed into a single datagram.
+        """
+        d = defer.Deferred()
+
+        def got_data(data):
+            self.assertEqual(data, "gorets:1|c\nglork:2|c")
+            d.callback(True)
+        self.got_data = got_data
+        self.router.process("gorets:1|c")
+        self.router.process("glork:2|c")
+        return d
+
+    def test_report_stats(self):
+        """
+        The batched redirect statistics are reported by the router.
+        """
+        d = defer.Deferred()
+
+        def got_data(data):
+            stats = self.router.report_stats()
+            name = "router.redirect_udp.127_0_0_1_%s." % (
+                self.port.getHost().port,)
+            self.assertEqual(stats[name + "messages"], 1)
+            self.assertEqual(stats[name + "packets"], 1)
+            self.assertEqual(stats[name + "bytes"], len(data))
+            d.callback(True)
+        self.got_data = got_data
+        self.router.process("gorets:1|c")
+        return d
+
+
+class TestHashRedirect(TxTestCase):
+
+    def setUp(self):
+        self.service = MultiService()
+        self.received = {}
+        self.ports = []
+        for i in range(2):
+            received = self.received[i] = []
+
+            class Collect(DatagramProtocol):
+
+                def datagramReceived(cself, data, host_port,
+                                     received=received):
+                    received.extend(data.split("\n"))
+                    self.got_data()
+
+            self.ports.append(reactor.listenUDP(0, Collect()))
+
+        self.processor = TestMessageProcessor()
+        self.router = Router(self.processor,
+            "any => redirect_hash udp %s" % " ".join(
+                "127.0.0.1:%s" % port.getHost().port
+                for port in self.ports),
+            service=self.service)
+        self.service.startService()
+        return self.router.ready
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.service.stopService()
+        for port in self.ports:
+            port.stopListening()
+
+    def test_redirect(self):
+        """
+        Each message goes to the endpoint its key hashes to.
+        """
+        messages = ["metric%d:1|c" % i for i in range(20)]
+        hash_redirect = self.router.senders["redirect_hash.udp_0"]
+        expected = {}
+        for message in messages:
+            endpoint = hash_redirect.ring.get_node(message.split(":")[0])
+            port = int(endpoint.split(":")[1])
+            index = [p.getHost().port for p in self.ports].index(port)
+            expected.setdefault(index, []).append(message)
+        d = defer.Deferred()
+
+        def got_data():
+            if sum(len(r) for r in self.received.values()) == len(messages):
+                self.assertEqual(self.received, expected)
+                d.callback(True)
+        self.got_data = got_data
+        for message in messages:
+            self.router.process(message)
+        return d
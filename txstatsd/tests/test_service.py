@@ -19,6 +19,8 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
+import socket
 import tempfile
 try:
     import ConfigParser
@@ -32,12 +34,14 @@ from twisted.trial.unittest import TestCase
 from carbon.client import CarbonClientManager
 
 from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.task import Clock, Cooperator
 from twisted.internet.protocol import DatagramProtocol
-from twisted.application.internet import UDPServer
+from twisted.application.internet import UDPServer, UNIXDatagramServer
 
 from txstatsd import service
 from txstatsd.server.processor import MessageProcessor
-from txstatsd.server.protocol import StatsDServerProtocol
+from txstatsd.server.protocol import (
+    StatsDServerProtocol, StatsDUnixServerProtocol)
 from txstatsd.report import ReportingService
 
 
@@ -202,6 +206,164 @@ class ClientManagerStatsTestCase(TestCase):
                            "destinations.hawaii": 0}, stats)
 
 
+class FakeProcessor(object):
+
+    def flush(self, interval):
+        for i in range(5):
+            yield ("foo%d" % i, i, 42)
+
+
+class FakeCarbonClient(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def sendDatapoint(self, metric, datapoint):
+        self.sent.append((metric, datapoint))
+
+
+class BulkCarbonClient(FakeCarbonClient):
+
+    def __init__(self):
+        FakeCarbonClient.__init__(self)
+        self.chunks = []
+
+    def sendDatapoints(self, datapoints):
+        self.chunks.append(datapoints)
+
+
+class StatsDServiceTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def build_service(self, client):
+        statsd_service = service.StatsDService(
+            client, FakeProcessor(), 10000, max_datapoints=2)
+        statsd_service.coop = Cooperator(
+            scheduler=lambda work: self.clock.callLater(0, work))
+        return statsd_service
+
+    def test_flush_in_chunks(self):
+        """
+        Datapoints are sent to the carbon client in chunks.
+        """
+        client = BulkCarbonClient()
+        statsd_service = self.build_service(client)
+        statsd_service.flushProcessor()
+        self.clock.advance(1)
+        self.assertEqual(client.chunks, [
+            [("foo0", (42, 0)), ("foo1", (42, 1))],
+            [("foo2", (42, 2)), ("foo3", (42, 3))],
+            [("foo4", (42, 4))]])
+        self.assertEqual(client.sent, [])
+        self.assertEqual(statsd_service.report_stats()["flush.datapoints"],
+                         5)
+        self.assertEqual(statsd_service.report_stats()["flush.datapoints"],
+                         0)
+
+    def test_flush_one_by_one(self):
+        """
+        Datapoints are sent one at a time to carbon clients that can't take
+        them in bulk.
+        """
+        client = FakeCarbonClient()
+        statsd_service = self.build_service(client)
+        statsd_service.flushProcessor()
+        self.clock.advance(1)
+        self.assertEqual(client.sent,
+                         [("foo%d" % i, (42, i)) for i in range(5)])
+
+    def test_flush_after_failure(self):
+        """
+        A flush failing to send is logged, and doesn't stop later flushes.
+        """
+        client = BulkCarbonClient()
+        send_datapoints = client.sendDatapoints
+
+        def fail_once(datapoints):
+            client.sendDatapoints = send_datapoints
+            raise IOError("spool unavailable")
+        client.sendDatapoints = fail_once
+        statsd_service = self.build_service(client)
+        statsd_service.flush_task.clock = self.clock
+        statsd_service.startService()
+        self.addCleanup(statsd_service.stopService)
+        for i in range(25):
+            self.clock.advance(1)
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+        self.assertTrue(statsd_service.flush_task.running)
+        self.assertEqual(len(client.chunks), 3)
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.reactor = Clock()
+
+
+class StatsDServerProtocolTestCase(TestCase):
+
+    def test_multiple_messages_per_datagram(self):
+        """
+        A datagram can hold several newline separated messages.
+        """
+        processor = MessageProcessor()
+        protocol = StatsDServerProtocol(processor)
+        protocol.transport = FakeTransport()
+        protocol.datagramReceived("foo:1|c\nbar:2|c\n\nfoo:3|c",
+                                  ("127.0.0.1", 8125))
+        protocol.transport.reactor.advance(0)
+        self.assertEqual(processor.counter_metrics, {"foo": 4, "bar": 2})
+
+
+class StatsDUnixServerProtocolTestCase(TestCase):
+
+    def setUp(self):
+        self.processor = MessageProcessor()
+        self.protocol = StatsDUnixServerProtocol(
+            self.processor, monitor_message="ping", monitor_response="pong",
+            receive_buffer=65536)
+        self.protocol.transport = FakeTransport()
+        self.protocol.transport.socket = socket.socket(
+            socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(self.protocol.transport.socket.close)
+
+    def test_receive_buffer(self):
+        """
+        The receive buffer size is set when the protocol starts.
+        """
+        default = self.protocol.report_stats()["unix.receive_buffer"]
+        self.protocol.startProtocol()
+        size = self.protocol.report_stats()["unix.receive_buffer"]
+        self.assertNotEqual(size, default)
+        self.assertTrue(size >= 65536)
+
+    def test_datagrams(self):
+        """
+        Messages are processed, and datagrams and bytes counted.
+        """
+        self.protocol.datagramReceived("foo:1|c\nbar:2|c", None)
+        self.protocol.datagramReceived("foo:3|c", None)
+        self.protocol.transport.reactor.advance(0)
+        self.assertEqual(self.processor.counter_metrics,
+                         {"foo": 4, "bar": 2})
+        stats = self.protocol.report_stats()
+        self.assertEqual((stats["unix.datagrams"], stats["unix.bytes"]),
+                         (2, 22))
+        stats = self.protocol.report_stats()
+        self.assertEqual((stats["unix.datagrams"], stats["unix.bytes"]),
+                         (0, 0))
+
+    def test_monitor_message_from_unbound_socket(self):
+        """
+        A monitor message from an unbound socket, which has no address to
+        respond to, is ignored.
+        """
+        self.protocol.datagramReceived("ping", None)
+        self.assertEqual(self.processor.counter_metrics, {})
+
+
 class Agent(DatagramProtocol):
 
     def __init__(self):
@@ -227,6 +389,36 @@ class ServiceTestsBuilder(TestCase):
         self.assertTrue(isinstance(statsd, service.StatsDService))
         self.assertTrue(isinstance(udp, UDPServer))
 
+    def test_unix_listener(self):
+        """
+        The service listens on a Unix datagram socket when configured to,
+        replacing the socket left behind by a previous run.
+        """
+        path = self.mktemp()
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(path)
+        stale.close()
+
+        o = service.StatsDOptions()
+        o["listen-unix-path"] = path
+        o["listen-unix-mode"] = 0o660
+        o["listen-unix-buffer"] = 65536
+        s = service.createService(o)
+        listener = s.services[-2]
+        self.assertTrue(isinstance(listener, UNIXDatagramServer))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(listener.args[0], path)
+        self.assertEqual(listener.kwargs["mode"], 0o660)
+        self.assertEqual(listener.args[1].receive_buffer, 65536)
+
+    def test_unix_mode_option(self):
+        """
+        The Unix socket mode is given in octal.
+        """
+        o = service.StatsDOptions()
+        o.parseOptions(["--listen-unix-mode", "600"])
+        self.assertEqual(o["listen-unix-mode"], 0o600)
+
     def test_default_clients(self):
         """
         Test that default clients are created when none is specified.
@@ -264,6 +456,34 @@ class ServiceTestsBuilder(TestCase):
         self.assertEqual(settings.MAX_QUEUE_SIZE, 10001)
         self.assertEqual(settings.MAX_DATAPOINTS_PER_MESSAGE, 10002)
 
+    def test_native_carbon_client(self):
+        """
+        The native carbon client can be used instead of carbon's.
+        """
+        from txstatsd.server.carbonsender import CarbonSenderManager
+
+        o = service.StatsDOptions()
+        o["carbon-client"] = "native"
+        o["carbon-protocol"] = "line"
+        s = service.createService(o)
+        manager = s.services[1]
+        self.assertTrue(isinstance(manager, CarbonSenderManager))
+        self.assertEqual(sorted(manager.client_factories.keys()),
+                         [("127.0.0.1", 2004, None)])
+
+    def test_carbon_router(self):
+        """
+        The carbon router can be configured.
+        """
+        from txstatsd.server.carbonsender import RelayRulesRouter
+
+        o = service.StatsDOptions()
+        o["carbon-router"] = "relay"
+        o["carbon-relay-rules"] = "* 127.0.0.1:2004"
+        s = service.createService(o)
+        manager = s.services[1]
+        self.assertTrue(isinstance(manager.router, RelayRulesRouter))
+
     def test_monitor_response(self):
         """
         The StatsD service messages the expected response to the